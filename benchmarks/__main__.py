@@ -0,0 +1,100 @@
+"""
+Runs the whole benchmark suite.
+
+Results are printed, and also appended as one JSON line to the output
+file along with the current commit, so regressions between commits can
+be spotted by diffing or plotting that file.
+
+Run with: python -m benchmarks [--quick] [--only NAME ...] [--output PATH]
+"""
+import argparse
+import datetime
+import json
+from pathlib import Path
+import platform
+import subprocess
+import sys
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+
+from . import bench_db
+from . import bench_gui
+from . import bench_inotify
+from . import bench_logtail
+from . import bench_memory
+from . import bench_reactor
+from . import bench_split_commit
+from . import bench_startup
+from . import bench_tracing
+from . import bench_visual
+from . import bench_wakeup
+from .common import BenchResult
+
+
+def get_suite(args: argparse.Namespace) -> Dict[str, Callable[[], List[BenchResult]]]:
+    """Gets every benchmark in the suite, keyed by name."""
+    min_time = (0.05 if args.quick else 0.2)
+    return {
+        "reactor": (lambda: bench_reactor.run_benchmarks(min_time=min_time)),
+        "inotify": (lambda: bench_inotify.run_benchmarks(min_time=min_time)),
+        "logtail": (lambda: bench_logtail.run_benchmarks(min_time=min_time)),
+        "memory": (lambda: bench_memory.run_benchmarks(min_time=min_time)),
+        "db": (lambda: bench_db.run_benchmarks(large_runs=(1000 if args.quick else args.large_runs))),
+        "gui": (lambda: bench_gui.run_benchmarks(min_time=min_time)),
+        "split_commit": (lambda: bench_split_commit.run_benchmarks(split_count=(50 if args.quick else 200))),
+        "wakeup": (lambda: bench_wakeup.run_benchmarks(event_count=(50 if args.quick else 200))),
+        "visual": (lambda: bench_visual.run_benchmarks(min_time=min_time)),
+        "tracing": (lambda: bench_tracing.run_benchmarks(min_time=min_time)),
+        "startup": (lambda: bench_startup.run_benchmarks(repeats=(3 if args.quick else bench_startup.REPEATS))),
+    }
+
+
+def get_commit() -> str:
+    """Gets the current git commit, if we can."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL,
+        ).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="run smaller cases for a fast sanity check")
+    parser.add_argument("--only", metavar="NAME", nargs="+", help="only run these benchmarks")
+    parser.add_argument("--large-runs", type=int, default=100000, help="runs in the large database for the db benchmark")
+    parser.add_argument("--output", type=Path, default=Path("bench_results.jsonl"), help="file to append results to")
+    args = parser.parse_args()
+
+    suite = get_suite(args)
+    names = (args.only if args.only else list(suite.keys()))
+    for name in names:
+        if name not in suite:
+            parser.error(f"unknown benchmark {name!r}, expected one of {sorted(suite.keys())!r}")
+
+    results: List[BenchResult] = []
+    for name in names:
+        print(f"# {name}", file=sys.stderr)
+        for result in suite[name]():
+            print(result.format_line())
+            results.append(result)
+
+    record: Dict[str, Any] = {
+        "commit": get_commit(),
+        "time": datetime.datetime.utcnow().isoformat("T"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": [result.to_json() for result in results],
+    }
+    with open(args.output, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+    print(f"Results appended to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
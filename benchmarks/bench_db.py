@@ -0,0 +1,194 @@
+"""
+End-to-end cost of do_fuse_split against fresh and large databases.
+
+For each database, measures both the time do_fuse_split spends on the
+tick thread and the time until the split has been committed. The large
+database is bulk-filled with finished runs first, and is also used to
+time the history queries and opening a reactor on it.
+
+Run with: python -m benchmarks.bench_db
+"""
+import argparse
+from pathlib import Path
+import sqlite3
+import tempfile
+import time
+from typing import List
+
+from goodsplit.db import DB
+from goodsplit.games.system_shock_2 import SystemShock2Reactor
+from goodsplit.time_base import MonotonicFloatSeconds
+
+from .common import BenchResult
+from .common import SyntheticEventSource
+from .common import make_ss2_reactor
+
+MISSIONS_PER_RUN = 10
+RUNS_PER_CASE = 20
+
+
+def fill_history(path: Path, *, run_count: int) -> None:
+    """Bulk-fills a database with finished System Shock 2 runs."""
+    db = DB(path)
+    game_id = db.ensure_game_id(
+        game_key=SystemShock2Reactor.get_game_key(),
+        game_title=SystemShock2Reactor.get_game_title(),
+    )
+    time_base_id = db.ensure_time_base_id(
+        game_id=game_id,
+        type_key=MonotonicFloatSeconds.get_time_base_key(),
+    )
+    split_keys = (
+        ["$system:start"]
+        + [f"mission:bench{i}.mis" for i in range(MISSIONS_PER_RUN)]
+        + ["$system:finish"]
+    )
+    fuse_split_type_ids = [
+        db.ensure_fuse_split_type(game_id=game_id, type_key=split_key)
+        for split_key in split_keys
+    ]
+
+    conn = sqlite3.connect(str(path))
+    try:
+        with conn:
+            run_id_base = int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM runs").fetchone()[0])
+            split_id_base = int(conn.execute("SELECT COALESCE(MAX(id), 0) FROM splits").fetchone()[0])
+            conn.executemany(
+                "INSERT INTO runs (id, game_id, run_start_datetime) VALUES (?, ?, ?)",
+                (
+                    (run_id_base+r+1, game_id, f"1990-01-01T00:00:00.000000+{r:09d}")
+                    for r in range(run_count)
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO splits (id, run_id, fuse_split_type_id) VALUES (?, ?, ?)",
+                (
+                    (split_id_base + r*len(split_keys) + i + 1, run_id_base+r+1, fuse_split_type_id)
+                    for r in range(run_count)
+                    for i, fuse_split_type_id in enumerate(fuse_split_type_ids)
+                ),
+            )
+            conn.executemany(
+                "INSERT INTO time_stamps (split_id, time_base_id, value_microseconds) VALUES (?, ?, ?)",
+                (
+                    (split_id_base + r*len(split_keys) + i + 1, time_base_id, i*600*1000000 + r)
+                    for r in range(run_count)
+                    for i in range(len(split_keys))
+                ),
+            )
+    finally:
+        conn.close()
+
+    db.backfill_run_summaries()
+
+
+def run_case(*, label: str, root_dir: Path, db_path: Path) -> List[BenchResult]:
+    """Times splits through a reactor on the given database."""
+    reactor = make_ss2_reactor(
+        root_dir=root_dir,
+        db=DB(db_path),
+        event_sources=[SyntheticEventSource([])],
+    )
+    split_type_ids = [
+        reactor.intern_split_key(f"mission:bench{i}.mis")
+        for i in range(MISSIONS_PER_RUN)
+    ]
+
+    tick_secs = 0.0
+    commit_secs = 0.0
+    split_count = 0
+    for run_index in range(RUNS_PER_CASE):
+        reactor.start_run()
+        for split_type_id in split_type_ids:
+            ts = reactor.fetch_time_now()
+            time_beg = time.perf_counter()
+            reactor.do_fuse_split_type(ts, split_type_id)
+            time_queued = time.perf_counter()
+            reactor.flush_db()
+            time_committed = time.perf_counter()
+            tick_secs += time_queued - time_beg
+            commit_secs += time_committed - time_beg
+            split_count += 1
+        reactor.finish_run()
+
+    reactor.close()
+    return [BenchResult(
+        name="do_fuse_split",
+        params={"db": label},
+        metrics={
+            "us_on_tick": tick_secs*1e6/split_count,
+            "us_to_commit": commit_secs*1e6/split_count,
+        },
+    )]
+
+
+def run_history_case(*, label: str, root_dir: Path, db_path: Path) -> List[BenchResult]:
+    """Times the history queries, and opening a reactor which loads its comparisons."""
+    db = DB(db_path)
+    time_beg = time.perf_counter()
+    reactor = make_ss2_reactor(
+        root_dir=root_dir,
+        db=db,
+        event_sources=[SyntheticEventSource([])],
+    )
+    open_secs = time.perf_counter() - time_beg
+    reactor.close()
+
+    game_id = db.ensure_game_id(
+        game_key=SystemShock2Reactor.get_game_key(),
+        game_title=SystemShock2Reactor.get_game_title(),
+    )
+    time_base_id = db.ensure_time_base_id(
+        game_id=game_id,
+        type_key=MonotonicFloatSeconds.get_time_base_key(),
+    )
+    fuse_split_type_id = db.ensure_fuse_split_type(game_id=game_id, type_key="mission:bench0.mis")
+    queries = {
+        "best_runs": (lambda: db.get_best_runs(game_id=game_id, time_base_id=time_base_id, limit=10)),
+        "recent_runs": (lambda: db.get_recent_runs(game_id=game_id, limit=50)),
+        "split_times": (lambda: db.get_split_times(fuse_split_type_id=fuse_split_type_id, time_base_id=time_base_id)),
+    }
+
+    results = [BenchResult(
+        name="reactor_open",
+        params={"db": label},
+        metrics={"ms": open_secs*1000.0},
+    )]
+    for query_name, query in queries.items():
+        time_beg = time.perf_counter()
+        row_count = len(query())
+        query_secs = time.perf_counter() - time_beg
+        results.append(BenchResult(
+            name="history_query",
+            params={"db": label, "query": query_name},
+            metrics={"ms": query_secs*1000.0, "rows": float(row_count)},
+        ))
+    return results
+
+
+def run_benchmarks(*, large_runs: int = 100000) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = Path(tmp_dir) / "ss2"
+
+        fresh_path = Path(tmp_dir) / "fresh.sqlite3"
+        results += run_case(label="fresh", root_dir=root_dir, db_path=fresh_path)
+
+        large_path = Path(tmp_dir) / "large.sqlite3"
+        fill_history(large_path, run_count=large_runs)
+        results += run_case(label=f"{large_runs}_runs", root_dir=root_dir, db_path=large_path)
+        results += run_history_case(label=f"{large_runs}_runs", root_dir=root_dir, db_path=large_path)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--large-runs", type=int, default=100000, help="runs to put in the large database")
+    args = parser.parse_args()
+    for result in run_benchmarks(large_runs=args.large_runs):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
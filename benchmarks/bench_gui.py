@@ -0,0 +1,137 @@
+"""
+Per-tick cost of refreshing a TkGameWindow, using mock widgets.
+
+No X server is needed: the window is built without calling Tk, and its
+labels are replaced with objects that just count configure() calls.
+
+Run with: python -m benchmarks.bench_gui
+"""
+import argparse
+from pathlib import Path
+import tempfile
+import time
+from typing import Any
+from typing import List
+
+from goodsplit.db import DB
+from goodsplit.gui_tk.game import TkGameWindow
+from goodsplit.reactor import Reactor
+
+from .common import BenchResult
+from .common import SyntheticEventSource
+from .common import make_ss2_reactor
+from .common import time_per_call
+
+SPLIT_ROW_COUNT = 10
+SPLIT_TICKS = 1000
+
+
+class MockLabel:
+    """Stands in for a ttk.Label, counting how often it gets touched."""
+    __slots__ = (
+        "configure_count",
+        "text",
+    )
+
+    def __init__(self) -> None:
+        self.configure_count = 0
+        self.text = ""
+
+    def configure(self, **kwargs: Any) -> None:
+        self.configure_count += 1
+        self.text = kwargs.get("text", self.text)
+
+
+def make_mock_window(reactor: Reactor) -> TkGameWindow:
+    """Makes a game window which renders into mock labels."""
+    window = TkGameWindow.__new__(TkGameWindow)
+    window._reactor = reactor
+    window._is_dead = False
+    window._split_row_count = SPLIT_ROW_COUNT
+    window._split_labels_name = [MockLabel() for i in range(SPLIT_ROW_COUNT)]
+    window._split_labels_time = [MockLabel() for i in range(SPLIT_ROW_COUNT)]
+    window._split_labels_delta = [MockLabel() for i in range(SPLIT_ROW_COUNT)]
+    window._stat_time_value_label = MockLabel()
+    window._split_row_texts = [("-", "--:--.-", "",) for i in range(SPLIT_ROW_COUNT)]
+    window._rendered_split_version = -1
+    window._rendered_clock_tenths = None
+    window._rendered_split_origin_time = None
+    window._last_refresh_time = 0.0
+    window._is_refresh_pending = False
+    window._loop = None
+    window._request_pump = None
+    return window
+
+
+def count_configures(window: TkGameWindow) -> int:
+    """Counts the configure() calls made on a mock window so far."""
+    labels = window._split_labels_name + window._split_labels_time + window._split_labels_delta + [window._stat_time_value_label]
+    return sum(label.configure_count for label in labels)
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        reactor = make_ss2_reactor(
+            root_dir=Path(tmp_dir) / "ss2",
+            db=DB(Path(tmp_dir) / "bench.sqlite3"),
+            event_sources=[SyntheticEventSource([])],
+        )
+        reactor.start_run()
+        for i in range(SPLIT_ROW_COUNT*2):
+            reactor.do_fuse_split(reactor.fetch_time_now(), f"mission:bench{i}.mis")
+        window = make_mock_window(reactor)
+        window.refresh_display()
+
+        # Steady state: the clock runs, nothing else changes
+        configures_beg = count_configures(window)
+        ticks = [0]
+        def tick_steady() -> None:
+            window.refresh_display()
+            ticks[0] += 1
+        secs = time_per_call(tick_steady, min_time=min_time)
+        results.append(BenchResult(
+            name="gui_refresh",
+            params={"case": "steady"},
+            metrics={
+                "us_per_tick": secs*1e6,
+                "configures_per_tick": (count_configures(window) - configures_beg)/ticks[0],
+            },
+        ))
+
+        # Worst case: a new split lands on every tick
+        split_type_ids = [
+            reactor.intern_split_key(f"mission:tick{i}.mis")
+            for i in range(SPLIT_TICKS)
+        ]
+        configures_beg = count_configures(window)
+        time_beg = time.perf_counter()
+        for split_type_id in split_type_ids:
+            reactor.do_fuse_split_type(reactor.fetch_time_now(), split_type_id)
+            window.refresh_display()
+        secs = (time.perf_counter() - time_beg)/SPLIT_TICKS
+        results.append(BenchResult(
+            name="gui_refresh",
+            params={"case": "split_every_tick"},
+            metrics={
+                "us_per_tick": secs*1e6,
+                "configures_per_tick": (count_configures(window) - configures_beg)/SPLIT_TICKS,
+            },
+        ))
+
+        reactor.cancel_run()
+        reactor.close()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Cost of INotifyEventSource.pull_events on a real directory.
+
+Opens and closes a number of files in a temporary directory, then times
+a single pull of all the resulting events. Also times an empty pull, and
+pulls where every file is in the ignored names, or where the same file
+is opened over and over, as a game streaming its assets would.
+
+Run with: python -m benchmarks.bench_inotify
+"""
+import argparse
+from pathlib import Path
+import tempfile
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+
+from goodsplit.sources.inotify import INotifyEventSource
+
+from .common import BenchResult
+from .common import time_per_call
+
+FILE_OPENS_PER_PULL = [1, 10, 100, 1000]
+REPEATS = 20
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        watch_dir = Path(tmp_dir)
+        fpaths = [watch_dir / f"asset{i:04d}.bin" for i in range(max(FILE_OPENS_PER_PULL))]
+        for fpath in fpaths:
+            fpath.touch()
+
+        source = INotifyEventSource(fpaths=[watch_dir])
+        source.pull_events()
+
+        results.append(BenchResult(
+            name="inotify_pull",
+            params={"file_opens": 0},
+            metrics={"us_per_pull": time_per_call(source.pull_events, min_time=min_time)*1e6},
+        ))
+
+        for open_count in FILE_OPENS_PER_PULL:
+            results.append(time_pulls(source, fpaths[:open_count], params={"file_opens": open_count}))
+        source.close()
+
+        # Sources share the process' inotify file descriptor, so only one is open at a time
+        source = INotifyEventSource(fpaths=[watch_dir], ignore_names=[fpath.name for fpath in fpaths])
+        for open_count in FILE_OPENS_PER_PULL:
+            results.append(time_pulls(source, fpaths[:open_count], params={"file_opens": open_count, "files": "ignored"}))
+        source.close()
+
+        source = INotifyEventSource(fpaths=[watch_dir])
+        for open_count in FILE_OPENS_PER_PULL:
+            results.append(time_pulls(source, [fpaths[0]]*open_count, params={"file_opens": open_count, "files": "repeated"}))
+        source.close()
+
+    return results
+
+
+def time_pulls(source: INotifyEventSource, fpaths: List[Path], *, params: Dict[str, Any]) -> BenchResult:
+    """Opens and closes some files and times pulling the events, a few times over."""
+    pull_secs = 0.0
+    event_count = 0
+    for repeat in range(REPEATS):
+        for fpath in fpaths:
+            with open(fpath, "rb"):
+                pass
+        time_beg = time.perf_counter()
+        event_count += len(source.pull_events())
+        pull_secs += time.perf_counter() - time_beg
+
+    return BenchResult(
+        name="inotify_pull",
+        params=params,
+        metrics={
+            "us_per_pull": pull_secs*1e6/REPEATS,
+            "us_per_event": pull_secs*1e6/max(1, event_count),
+            "us_per_open": pull_secs*1e6/(REPEATS*len(fpaths)),
+            "events_per_pull": event_count/REPEATS,
+        },
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each timed case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Cost of LogTailEventSource.pull_events on a real log file.
+
+Appends a number of lines to a log in a temporary directory, a few of
+which match, then times pulling until everything has been read. Also
+times an empty pull.
+
+Run with: python -m benchmarks.bench_logtail
+"""
+import argparse
+from pathlib import Path
+import select
+import tempfile
+import time
+from typing import List
+
+from goodsplit.sources.logtail import LogTailEventSource
+
+from .common import BenchResult
+from .common import time_per_call
+
+LINES_PER_APPEND = [10, 1000, 10000]
+PATTERN_COUNTS = [1, 10, 50]
+REPEATS = 5
+MATCH_EVERY = 100
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fpath = Path(tmp_dir) / "game.log"
+        for pattern_count in PATTERN_COUNTS:
+            fpath.write_bytes(b"")
+            patterns = {
+                f"level{i}": rf"^\[\d+\] Loading level (?P<level>\w+) part {i}$"
+                for i in range(pattern_count)
+            }
+            source = LogTailEventSource(fpath, patterns)
+
+            if pattern_count == PATTERN_COUNTS[0]:
+                results.append(BenchResult(
+                    name="logtail_pull",
+                    params={"lines": 0, "patterns": pattern_count},
+                    metrics={"us_per_pull": time_per_call(source.pull_events, min_time=min_time)*1e6},
+                ))
+
+            for line_count in LINES_PER_APPEND:
+                lines = [
+                    (f"[{i}] Loading level medsci{i} part {i % pattern_count}\n" if i % MATCH_EVERY == 0
+                        else f"[{i}] Rendered frame {i} in 16.6ms with nothing much going on\n")
+                    for i in range(line_count)
+                ]
+                data = "".join(lines).encode("utf-8")
+                pull_secs = 0.0
+                max_pull_secs = 0.0
+                pull_count = 0
+                event_count = 0
+                for repeat in range(REPEATS):
+                    with open(fpath, "ab") as f:
+                        f.write(data)
+                    # Pull the way a tick would, for as long as the source says there's more
+                    while select.select([source.fileno()], [], [], 0)[0]:
+                        time_beg = time.perf_counter()
+                        event_count += len(source.pull_events())
+                        pull_time = time.perf_counter() - time_beg
+                        pull_secs += pull_time
+                        max_pull_secs = max(max_pull_secs, pull_time)
+                        pull_count += 1
+
+                results.append(BenchResult(
+                    name="logtail_pull",
+                    params={"lines": line_count, "patterns": pattern_count},
+                    metrics={
+                        "us_per_line": pull_secs*1e6/(line_count*REPEATS),
+                        "max_us_per_pull": max_pull_secs*1e6,
+                        "pulls": pull_count/REPEATS,
+                        "events": event_count/REPEATS,
+                    },
+                ))
+
+            source.close()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each timed case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
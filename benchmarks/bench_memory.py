@@ -0,0 +1,182 @@
+"""
+Cost of MemoryEventSource.pull_events against a child process.
+
+Starts a child Python process holding a buffer of values and a pointer
+to it, then times polls of a number of watches, both plain addresses
+and one-level pointer paths, where nothing has changed. Also times the
+/proc/<pid>/mem fallback.
+
+Before timing each method, it checks what the source actually emits:
+values as they change, values behind a pointer which gets moved, and
+batches with regions which aren't mapped or run off the end of a
+mapping. A wrong answer fails the benchmark with AssertionError.
+
+Run with: python -m benchmarks.bench_memory
+"""
+import argparse
+import struct
+import subprocess
+import sys
+from typing import IO
+from typing import List
+
+from goodsplit.sources import memory
+from goodsplit.sources.memory import MemoryEventSource
+from goodsplit.sources.memory import MemoryValueEvent
+from goodsplit.sources.memory import MemoryWatch
+from goodsplit.sources.memory import ProcessAttachEvent
+from goodsplit.sources.memory import ProcessMemoryReader
+
+from .common import BenchResult
+from .common import time_per_call
+
+WATCH_COUNTS = [1, 10, 100]
+MAX_WATCHES = max(WATCH_COUNTS)
+
+# An address which is never mapped
+UNMAPPED_ADDRESS = 16
+
+# Holds values, a pointer to them, and the end of a mapping with nothing after it.
+# Takes commands on stdin, answering each with a line once it's done.
+CHILD_SOURCE = f"""
+import ctypes, mmap, sys
+values = (ctypes.c_int32 * {MAX_WATCHES})()
+other = (ctypes.c_int32 * {MAX_WATCHES})()
+root = ctypes.c_void_p(ctypes.addressof(values))
+libc = ctypes.CDLL(None)
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.mmap.restype = ctypes.c_void_p
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+pages = libc.mmap(None, 2*mmap.PAGESIZE, mmap.PROT_READ|mmap.PROT_WRITE, mmap.MAP_PRIVATE|mmap.MAP_ANONYMOUS, -1, 0)
+libc.munmap(pages + mmap.PAGESIZE, mmap.PAGESIZE)
+print(ctypes.addressof(values), ctypes.addressof(root), pages + mmap.PAGESIZE, flush=True)
+for line in sys.stdin:
+    cmd, *args = line.split()
+    if cmd == "set":
+        values[int(args[0])] = int(args[1])
+    elif cmd == "set_other":
+        other[int(args[0])] = int(args[1])
+    elif cmd == "point_other":
+        root.value = ctypes.addressof(other)
+    elif cmd == "reset":
+        ctypes.memset(values, 0, ctypes.sizeof(values))
+        ctypes.memset(other, 0, ctypes.sizeof(other))
+        root.value = ctypes.addressof(values)
+    print("ok", flush=True)
+"""
+
+
+def send_command(child: "subprocess.Popen[bytes]", command: str) -> None:
+    """Has the child process run a command, and waits for it to be done."""
+    stdin: IO[bytes] = child.stdin # type: ignore
+    stdout: IO[bytes] = child.stdout # type: ignore
+    stdin.write(command.encode("ascii") + b"\n")
+    stdin.flush()
+    stdout.readline()
+
+
+def check_behaviour(child: "subprocess.Popen[bytes]", *, values_address: int, root_address: int, mapping_end: int) -> None:
+    """Checks the source and reader get the right answers from the child, with whichever method is in use."""
+    send_command(child, "reset")
+    source = MemoryEventSource([
+        MemoryWatch("plain", [values_address]),
+        MemoryWatch("pointer", [root_address, 4]),
+    ], pid=child.pid, poll_interval=0.0)
+    try:
+        events = source.pull_events()
+        assert events == [ProcessAttachEvent(pid=child.pid), MemoryValueEvent(key="plain", value=0), MemoryValueEvent(key="pointer", value=0)], events
+        assert source.pull_events() == []
+
+        send_command(child, "set 0 5")
+        events = source.pull_events()
+        assert events == [MemoryValueEvent(key="plain", value=5)], events
+        send_command(child, "set 1 -9")
+        events = source.pull_events()
+        assert events == [MemoryValueEvent(key="pointer", value=-9)], events
+
+        # Moving the pointer has the path walked again, and the value read from where it points now
+        send_command(child, "set_other 1 77")
+        send_command(child, "point_other")
+        events = source.pull_events()
+        assert events == [MemoryValueEvent(key="pointer", value=77)], events
+        send_command(child, "set 1 1000")
+        send_command(child, "set_other 1 78")
+        events = source.pull_events()
+        assert events == [MemoryValueEvent(key="pointer", value=78)], events
+        assert source.pull_events() == []
+    finally:
+        source.close()
+
+    # Regions which can't be read, first in a batch and straddling the end of a mapping,
+    # come back as None without losing the ones around them
+    send_command(child, "reset")
+    send_command(child, "set 0 11")
+    send_command(child, "set 1 22")
+    reader = ProcessMemoryReader(child.pid)
+    try:
+        regions = [
+            (UNMAPPED_ADDRESS, 4,),
+            (values_address, 4,),
+            (mapping_end - 2, 4,),
+            (values_address + 4, 4,),
+            (mapping_end - 4, 4,),
+        ]
+        buf, offsets = reader.read_regions(regions)
+        assert offsets[0] is None and offsets[2] is None, offsets
+        read_values = [
+            (None if offset is None else struct.unpack_from("<i", buf, offset)[0])
+            for offset in offsets
+        ]
+        assert read_values == [None, 11, None, 22, 0], read_values
+    finally:
+        reader.close()
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    child = subprocess.Popen([sys.executable, "-c", CHILD_SOURCE], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        assert child.stdout is not None
+        values_address, root_address, mapping_end = map(int, child.stdout.readline().split())
+        readv = memory._process_vm_readv
+        for method in ["process_vm_readv", "proc_mem"]:
+            if method == "proc_mem":
+                memory._process_vm_readv = None
+            elif readv is None:
+                continue
+            try:
+                check_behaviour(child, values_address=values_address, root_address=root_address, mapping_end=mapping_end)
+                send_command(child, "reset")
+                for watch_count in WATCH_COUNTS:
+                    for path_kind in ["address", "pointer"]:
+                        watches = [
+                            (MemoryWatch(f"v{i}", [values_address + i*4]) if path_kind == "address"
+                                else MemoryWatch(f"v{i}", [root_address, i*4]))
+                            for i in range(watch_count)
+                        ]
+                        source = MemoryEventSource(watches, pid=child.pid, poll_interval=0.0)
+                        source.pull_events()
+                        results.append(BenchResult(
+                            name="memory_poll",
+                            params={"method": method, "watches": watch_count, "path": path_kind},
+                            metrics={"us_per_poll": time_per_call(source.pull_events, min_time=min_time)*1e6},
+                        ))
+                        source.close()
+            finally:
+                memory._process_vm_readv = readv
+    finally:
+        child.communicate()
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each timed case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Reactor.update throughput with synthetic event sources.
+
+Feeds a System Shock 2 reactor a fixed batch of events on every update,
+for several batch sizes. The events are opens and closes of a file the
+reactor ignores, so this measures dispatch cost rather than DB cost.
+Sources either hand over event objects ("objects"), or write keyed
+records into the reactor's event ring ("records").
+
+Also times finding the split rule for an event, for rule sets of
+several sizes, which should stay flat as the rule count grows.
+
+Run with: python -m benchmarks.bench_reactor
+"""
+import argparse
+from pathlib import Path
+import tempfile
+from typing import Any
+from typing import List
+from typing import Tuple
+
+from goodsplit.db import DB
+from goodsplit.interface import Event
+from goodsplit.rules import RuleAction
+from goodsplit.rules import RuleSet
+from goodsplit.rules import SplitRule
+from goodsplit.interface import EventSource
+from goodsplit.sources.inotify import CLOSE_UNWRITEABLE_FILE_KIND
+from goodsplit.sources.inotify import CloseUnwriteableFileEvent
+from goodsplit.sources.inotify import OPEN_FILE_KIND
+from goodsplit.sources.inotify import OpenFileEvent
+
+from .common import BenchResult
+from .common import SyntheticEventSource
+from .common import SyntheticRecordSource
+from .common import make_ss2_reactor
+from .common import time_per_call
+
+EVENTS_PER_UPDATE = [0, 1, 10, 100, 1000]
+RULE_COUNTS = [10, 100, 1000]
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = Path(tmp_dir) / "ss2"
+        db = DB(Path(tmp_dir) / "bench.sqlite3")
+        for source_type in ["objects", "records"]:
+            for event_count in EVENTS_PER_UPDATE:
+                fpath = root_dir / "Data" / "allobjs.osm"
+                records: List[Tuple[int, Any]] = []
+                for i in range(event_count):
+                    if i % 2 == 0:
+                        records.append((OPEN_FILE_KIND, fpath,))
+                    else:
+                        records.append((CLOSE_UNWRITEABLE_FILE_KIND, fpath,))
+                source: EventSource
+                if source_type == "records":
+                    source = SyntheticRecordSource(records)
+                else:
+                    events: List[Event] = [
+                        (OpenFileEvent(fpath=key) if kind == OPEN_FILE_KIND else CloseUnwriteableFileEvent(fpath=key))
+                        for kind, key in records
+                    ]
+                    source = SyntheticEventSource(events)
+
+                reactor = make_ss2_reactor(
+                    root_dir=root_dir,
+                    db=db,
+                    event_sources=[source],
+                )
+                secs = time_per_call(reactor.update, min_time=min_time)
+                reactor.close()
+
+                metrics = {
+                    "us_per_update": secs*1e6,
+                    "updates_per_sec": 1.0/secs,
+                }
+                if event_count > 0:
+                    metrics["us_per_event"] = secs*1e6/event_count
+                    metrics["events_per_sec"] = event_count/secs
+                results.append(BenchResult(
+                    name="reactor_update",
+                    params={"events_per_update": event_count, "source": source_type},
+                    metrics=metrics,
+                ))
+
+    results += run_rule_benchmarks(min_time=min_time)
+    return results
+
+
+def run_rule_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    root_dir = Path("/games/ss2/Data")
+    for rule_count in RULE_COUNTS:
+        rules = [
+            SplitRule(OpenFileEvent, path=(root_dir / f"level{i}.mis"),
+                actions=[RuleAction.SPLIT], split_key=f"level{i}")
+            for i in range(rule_count)
+        ]
+        rules.append(SplitRule(OpenFileEvent, suffix=".avi",
+            actions=[RuleAction.SPLIT], split_prefix="cutscene"))
+        rule_set = RuleSet(rules)
+
+        cases = {
+            "path": OpenFileEvent(fpath=(root_dir / f"level{rule_count-1}.mis")),
+            "suffix": OpenFileEvent(fpath=(root_dir / "cs2.avi")),
+            "none": OpenFileEvent(fpath=(root_dir / "allobjs.osm")),
+        }
+        for match, ev in cases.items():
+            def find() -> None:
+                for i in range(100):
+                    rule_set.find_rule(ev, None)
+            secs = time_per_call(find, min_time=min_time)
+            results.append(BenchResult(
+                name="rule_dispatch",
+                params={"rules": rule_count, "match": match},
+                metrics={"us_per_event": secs*1e6/100},
+            ))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Microbenchmark for the cost of persisting one split.
+
+Compares the old pattern (an insert and a re-select per row, each on its
+own connection) against DB.commit_split (one transaction, lastrowid and a
+multi-row time stamp insert).
+
+Run with: python -m benchmarks.bench_split_commit
+"""
+import argparse
+from pathlib import Path
+import tempfile
+import time
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+import sqlalchemy
+import sqlalchemy as SQL
+import sqlalchemy.engine.url
+
+from goodsplit.db import DB
+from goodsplit.db import schema as S
+
+from .common import BenchResult
+
+
+def legacy_commit_split(engine: SQL.engine.Engine, run_id: int, fuse_split_type_id: int, time_stamps: List[Tuple[int, int]]) -> int:
+    """Persists a split the way do_fuse_split used to, for comparison."""
+    with engine.connect() as C:
+        C.execute(S.splits.insert()
+            .values(run_id=run_id, fuse_split_type_id=fuse_split_type_id))
+        rows = (C.execute(SQL.select([S.splits.c.id]).limit(1)
+            .where(S.splits.c.run_id == run_id)
+            .where(S.splits.c.fuse_split_type_id == fuse_split_type_id)))
+        split_id = int(rows.fetchone()[0])
+
+    for time_base_id, value_microseconds in time_stamps:
+        with engine.connect() as C:
+            C.execute(S.time_stamps.insert().values(
+                split_id=split_id,
+                time_base_id=time_base_id,
+                value_microseconds=value_microseconds,
+            ))
+            rows = (C.execute(SQL.select([S.time_stamps.c.id]).limit(1)
+                .where(S.time_stamps.c.split_id == split_id)
+                .where(S.time_stamps.c.time_base_id == time_base_id)))
+            rows.fetchone()
+
+    return split_id
+
+
+def run_case(name: str, db: DB, game_id: int, time_base_ids: List[int], split_count: int, commit: Callable[[int, int, List[Tuple[int, int]]], int]) -> float:
+    """Times split_count splits and returns the mean cost per split in seconds."""
+    run_id = db.create_run_id(game_id=game_id)
+    fuse_split_type_ids = [
+        db.ensure_fuse_split_type(game_id=game_id, type_key=f"bench:{name}:{i}")
+        for i in range(split_count)
+    ]
+
+    time_beg = time.perf_counter()
+    for i, fuse_split_type_id in enumerate(fuse_split_type_ids):
+        commit(run_id, fuse_split_type_id, [
+            (time_base_id, i*1000000)
+            for time_base_id in time_base_ids
+        ])
+    time_end = time.perf_counter()
+
+    return (time_end - time_beg) / split_count
+
+
+def run_benchmarks(*, split_count: int = 200, time_base_count: int = 2) -> List[BenchResult]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "bench.sqlite3"
+        db = DB(path)
+        legacy_engine = sqlalchemy.create_engine(
+            sqlalchemy.engine.url.URL(drivername="sqlite", database=str(path)),
+        )
+        game_id = db.ensure_game_id(game_key="bench", game_title="Benchmark")
+        time_base_ids = [
+            db.ensure_time_base_id(game_id=game_id, type_key=f"bench:{i}")
+            for i in range(time_base_count)
+        ]
+
+        before = run_case("before", db, game_id, time_base_ids, split_count,
+            (lambda r, f, t: legacy_commit_split(legacy_engine, r, f, t)))
+        after = run_case("after", db, game_id, time_base_ids, split_count,
+            db.commit_split)
+
+    return [
+        BenchResult(
+            name="split_commit",
+            params={"method": method, "time_bases": time_base_count},
+            metrics={"us_per_split": secs*1e6},
+        )
+        for method, secs in [("legacy", before), ("commit_split", after)]
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--splits", type=int, default=200, help="splits to write per case")
+    parser.add_argument("--time-bases", type=int, default=2, help="time bases per split")
+    args = parser.parse_args()
+
+    results = run_benchmarks(split_count=args.splits, time_base_count=args.time_bases)
+    before = results[0].metrics["us_per_split"]
+    after = results[1].metrics["us_per_split"]
+    print(f"splits={args.splits} time_bases={args.time_bases}")
+    print(f"before: {before/1000.0:9.3f} ms/split")
+    print(f"after:  {after/1000.0:9.3f} ms/split")
+    print(f"speedup: {before/after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
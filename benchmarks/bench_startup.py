@@ -0,0 +1,102 @@
+"""
+How long Goodsplit takes to start.
+
+Each case runs in a fresh interpreter (see startup_child), as that's
+the only way to see import costs. Times are taken inside the child from
+just before its first goodsplit import, and the whole process is also
+timed from the outside, which adds interpreter startup.
+
+Time-to-window builds the root window and waits until it's mapped. It
+needs an X server, and is skipped if there isn't one.
+
+Run with: python -m benchmarks.bench_startup
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+from typing import List
+
+from .common import BenchResult
+
+REPEATS = 5
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def run_child(case: str, *, home_dir: Path, db_path: Path) -> Dict[str, float]:
+    """Runs one case in a fresh interpreter, returning its times in milliseconds."""
+    env = dict(os.environ)
+    # Keep the font cache and anything else in ~ out of the real home directory
+    env["HOME"] = str(home_dir)
+    env["PYTHONPATH"] = os.pathsep.join([str(REPO_DIR)] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    time_beg = time.perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, "-m", "benchmarks.startup_child", case, str(db_path)],
+        env=env,
+        cwd=str(REPO_DIR),
+    )
+    wall_ms = (time.perf_counter() - time_beg)*1000.0
+    times: Dict[str, float] = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    times["process_ms"] = wall_ms
+    return times
+
+
+def run_case(name: str, case: str, *, repeats: int, home_dir: Path, db_path: Path, params: Dict[str, str]) -> BenchResult:
+    """Runs a case a few times, taking the median of each time."""
+    runs = [run_child(case, home_dir=home_dir, db_path=db_path) for i in range(repeats)]
+    return BenchResult(
+        name=name,
+        params=params,
+        metrics={
+            key: statistics.median(run[key] for run in runs)
+            for key in runs[0].keys()
+        },
+    )
+
+
+def run_benchmarks(*, repeats: int = REPEATS) -> List[BenchResult]:
+    results: List[BenchResult] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        home_dir = Path(tmp_dir)
+        db_path = home_dir / "goodsplit-times.sqlite3"
+
+        results.append(run_case("startup_import", "import_main",
+            repeats=repeats, home_dir=home_dir, db_path=db_path, params={"module": "goodsplit.__main__"}))
+        results.append(run_case("startup_import", "import_gui",
+            repeats=repeats, home_dir=home_dir, db_path=db_path, params={"module": "goodsplit.gui_tk.root"}))
+
+        # The first open makes the database, and every one after that only checks its version
+        results.append(run_case("startup_db_open", "db_open",
+            repeats=1, home_dir=home_dir, db_path=db_path, params={"db": "new"}))
+        results.append(run_case("startup_db_open", "db_open",
+            repeats=repeats, home_dir=home_dir, db_path=db_path, params={"db": "existing"}))
+
+        if os.environ.get("DISPLAY"):
+            # The first window has to look through the system fonts, and the rest use the cache
+            results.append(run_case("startup_window", "window",
+                repeats=1, home_dir=home_dir, db_path=db_path, params={"fonts": "uncached"}))
+            results.append(run_case("startup_window", "window",
+                repeats=repeats, home_dir=home_dir, db_path=db_path, params={"fonts": "cached"}))
+        else:
+            print("No X display, skipping time-to-window", file=sys.stderr)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="fresh processes to run for each case")
+    args = parser.parse_args()
+    for result in run_benchmarks(repeats=args.repeats):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Cost of tracing and logging on the thread doing the work.
+
+Times trace events and spans with tracing off, on, and sampled, both
+called as they are and behind a check of the channel's enabled flag,
+which should cost next to nothing when off. Also times a LOG.info()
+call writing straight to a file, through a plain QueueHandler, and
+through the queue handler which install_async_logging() puts in front
+of it.
+
+Run with: python -m benchmarks.bench_tracing
+"""
+import argparse
+import logging
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from pathlib import Path
+import queue
+import tempfile
+from typing import Any
+from typing import List
+
+from goodsplit.tracing import NULL_SPAN
+from goodsplit.tracing import Tracer
+from goodsplit.tracing import make_log_queue_handler
+
+from .common import BenchResult
+from .common import time_per_call
+
+CALLS_PER_CASE = 100
+SAMPLE_EVERY = 100
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    results: List[BenchResult] = []
+
+    # A tracer of our own, so the process-wide one isn't touched
+    tracer = Tracer()
+    channel = tracer.get_channel("bench")
+    for state in ["disabled", "enabled", "sampled"]:
+        if state == "disabled":
+            tracer.disable()
+        else:
+            tracer.enable()
+        tracer.set_sampling("bench", (SAMPLE_EVERY if state == "sampled" else 1))
+
+        def check() -> None:
+            for i in range(CALLS_PER_CASE):
+                if channel.enabled:
+                    channel.event("tick", i=i)
+
+        def event() -> None:
+            for i in range(CALLS_PER_CASE):
+                channel.event("tick", i=i)
+
+        def span() -> None:
+            for i in range(CALLS_PER_CASE):
+                with channel.span("tick", i=i):
+                    pass
+
+        def check_span() -> None:
+            for i in range(CALLS_PER_CASE):
+                with (channel.span("tick", i=i) if channel.enabled else NULL_SPAN):
+                    pass
+
+        for op, fn in [("check", check), ("event", event), ("span", span), ("check_span", check_span)]:
+            secs = time_per_call(fn, min_time=min_time)
+            tracer.clear()
+            results.append(BenchResult(
+                name="trace_call",
+                params={"tracing": state, "op": op},
+                metrics={"ns_per_call": secs*1e9/CALLS_PER_CASE},
+            ))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for sink in ["file", "queue", "goodsplit_queue"]:
+            logger = logging.getLogger(f"bench_tracing_{sink}")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            file_handler = logging.FileHandler(str(Path(tmp_dir) / f"{sink}.log"))
+            file_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+            listener = None
+            if sink != "file":
+                log_queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+                logger.addHandler(QueueHandler(log_queue) if sink == "queue" else make_log_queue_handler(log_queue))
+                listener = QueueListener(log_queue, file_handler)
+                listener.start()
+            else:
+                logger.addHandler(file_handler)
+
+            def log() -> None:
+                for i in range(CALLS_PER_CASE):
+                    logger.info(f"Fuse split [00:00:00.000000]: {i!r}")
+
+            secs = time_per_call(log, min_time=min_time)
+            if listener is not None:
+                listener.stop()
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            file_handler.close()
+            results.append(BenchResult(
+                name="log_call",
+                params={"sink": sink},
+                metrics={"us_per_call": secs*1e6/CALLS_PER_CASE},
+            ))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
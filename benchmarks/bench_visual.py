@@ -0,0 +1,68 @@
+"""
+Cost of matching 1080p frames with VisualEventSource.
+
+Builds a synthetic 1920x1080 RGB frame, then times matching it against a
+number of templates at a few scales. None of the templates match, which
+is what most frames look like. Needs NumPy.
+
+Run with: python -m benchmarks.bench_visual
+"""
+import argparse
+from typing import List
+
+from .common import BenchResult
+from .common import time_per_call
+
+TEMPLATE_COUNTS = [1, 8, 32]
+SCALES = [1, 2, 4]
+FRAME_WIDTH = 1920
+FRAME_HEIGHT = 1080
+REGION_WIDTH = 320
+REGION_HEIGHT = 120
+
+
+def run_benchmarks(*, min_time: float = 0.2) -> List[BenchResult]:
+    import numpy # type: ignore
+    from goodsplit.sources.visual import ImageSequenceFrameProvider
+    from goodsplit.sources.visual import VisualEventSource
+    from goodsplit.sources.visual import VisualTemplate
+
+    results: List[BenchResult] = []
+    rng = numpy.random.default_rng(0)
+    frame = rng.integers(0, 256, (FRAME_HEIGHT, FRAME_WIDTH, 3,), dtype=numpy.uint8)
+    reference = rng.integers(0, 256, (REGION_HEIGHT, REGION_WIDTH, 3,), dtype=numpy.uint8)
+    for scale in SCALES:
+        for template_count in TEMPLATE_COUNTS:
+            templates = [
+                VisualTemplate(f"t{i}",
+                    region=(
+                        (i*REGION_WIDTH) % (FRAME_WIDTH - REGION_WIDTH),
+                        ((i*REGION_WIDTH) // (FRAME_WIDTH - REGION_WIDTH) * REGION_HEIGHT) % (FRAME_HEIGHT - REGION_HEIGHT),
+                        REGION_WIDTH,
+                        REGION_HEIGHT,
+                    ),
+                    reference=reference,
+                    scale=scale,
+                )
+                for i in range(template_count)
+            ]
+            source = VisualEventSource(ImageSequenceFrameProvider([]), templates)
+            results.append(BenchResult(
+                name="visual_match",
+                params={"templates": template_count, "scale": scale},
+                metrics={"ms_per_frame": time_per_call(lambda: source.match_frame(frame, []), min_time=min_time)*1e3},
+            ))
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to run each timed case for")
+    args = parser.parse_args()
+    for result in run_benchmarks(min_time=args.min_time):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
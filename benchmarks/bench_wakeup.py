@@ -0,0 +1,145 @@
+"""
+Compares polling a reactor against waiting on its event source fds.
+
+"poll" is what the Tk frontend used to do: update the reactor, then
+sleep for 1 ms, forever. "wait" blocks in select() on the fds from
+Reactor.get_wait_fds() and only updates the reactor when one is readable.
+
+Reports CPU time spent by the consuming thread and the latency from a
+file being opened to the reactor seeing the event.
+
+Run with: python -m benchmarks.bench_wakeup
+"""
+import argparse
+from pathlib import Path
+from pathlib import PurePath
+import select
+import statistics
+import tempfile
+import threading
+import time
+from typing import Dict
+from typing import List
+
+from goodsplit.db import DB
+from goodsplit.interface import Event
+from goodsplit.reactor import Reactor
+from goodsplit.sources.inotify import INotifyEventSource
+from goodsplit.sources.inotify import OpenFileEvent
+from goodsplit.time_base import MonotonicFloatSeconds
+
+from .common import BenchResult
+
+
+class LatencyReactor(Reactor):
+    """A reactor which records how long each file open took to reach it."""
+    __slots__ = (
+        "latencies",
+        "sent_times",
+    )
+
+    def __init__(self, *, watch_dir: Path, db: DB, sent_times: Dict[str, float]) -> None:
+        self.sent_times = sent_times
+        self.latencies: List[float] = []
+        super().__init__(
+            time_bases=[MonotonicFloatSeconds()],
+            event_sources=[INotifyEventSource(fpaths=[watch_dir])],
+            db=db,
+        )
+
+    @classmethod
+    def get_game_title(cls) -> str:
+        return "Wakeup Benchmark"
+
+    @classmethod
+    def get_game_key(cls) -> str:
+        return "bench_wakeup"
+
+    def on_event(self, ts: List[float], ev: Event) -> None:
+        if isinstance(ev, OpenFileEvent):
+            sent_time = self.sent_times.pop(ev.fpath.name, None)
+            if sent_time is not None:
+                self.latencies.append(time.monotonic() - sent_time)
+
+
+def produce_events(watch_dir: Path, sent_times: Dict[str, float], count: int, interval: float) -> None:
+    """Opens a series of files in the watched directory."""
+    for i in range(count):
+        name = f"file{i:06d}.dat"
+        fpath = watch_dir / name
+        fpath.touch()
+        time.sleep(interval)
+        sent_times[name] = time.monotonic()
+        with open(fpath, "rb"):
+            pass
+
+
+def run_mode(mode: str, db: DB, count: int, interval: float) -> BenchResult:
+    """Runs one consumer mode and returns its results."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        watch_dir = Path(tmp_dir)
+        sent_times: Dict[str, float] = {}
+        reactor = LatencyReactor(watch_dir=watch_dir, db=db, sent_times=sent_times)
+        producer = threading.Thread(
+            target=produce_events,
+            args=(watch_dir, sent_times, count, interval),
+        )
+
+        cpu_beg = time.thread_time()
+        wall_beg = time.monotonic()
+        producer.start()
+        fds = reactor.get_wait_fds()
+        while producer.is_alive() or sent_times:
+            if mode == "poll":
+                reactor.update()
+                time.sleep(0.001)
+            else:
+                readable, _, _ = select.select(fds, [], [], 0.1)
+                if readable:
+                    reactor.update()
+            if (not producer.is_alive()) and time.monotonic() - wall_beg > count*interval + 5.0:
+                break
+        wall_end = time.monotonic()
+        cpu_end = time.thread_time()
+        producer.join()
+        reactor.close()
+
+    wall = wall_end - wall_beg
+    cpu = cpu_end - cpu_beg
+    latencies = sorted(reactor.latencies)
+    metrics = {
+        "events": float(len(latencies)),
+        "cpu_percent": 100.0*cpu/wall,
+    }
+    if latencies:
+        metrics["latency_p50_ms"] = statistics.median(latencies)*1000.0
+        metrics["latency_p99_ms"] = latencies[min(len(latencies)-1, int(len(latencies)*0.99))]*1000.0
+        metrics["latency_max_ms"] = latencies[-1]*1000.0
+    return BenchResult(
+        name="wakeup",
+        params={"mode": mode, "events": count},
+        metrics=metrics,
+    )
+
+
+def run_benchmarks(*, event_count: int = 200, interval: float = 0.01) -> List[BenchResult]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = DB(Path(tmp_dir) / "bench.sqlite3")
+        return [
+            run_mode(mode, db, event_count, interval)
+            for mode in ["poll", "wait"]
+        ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=200, help="file opens per mode")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between file opens")
+    args = parser.parse_args()
+
+    for result in run_benchmarks(event_count=args.events, interval=args.interval):
+        print(result.format_line())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Shared helpers for the benchmark suite."""
+from pathlib import Path
+from pathlib import PurePath
+import time
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from goodsplit.db import DB
+from goodsplit.games.system_shock_2 import SystemShock2Reactor
+from goodsplit.interface import Event
+from goodsplit.interface import EventSource
+from goodsplit.records import EventRing
+from goodsplit.records import KeyTable
+from goodsplit.records import get_record_kind
+from goodsplit.time_base import MonotonicFloatSeconds
+
+
+class BenchResult:
+    """The result of one benchmark case."""
+    __slots__ = (
+        "metrics",
+        "name",
+        "params",
+    )
+
+    def __init__(self, *, name: str, params: Dict[str, Any], metrics: Dict[str, float]) -> None:
+        self.name = name
+        self.params = params
+        self.metrics = metrics
+
+    def to_json(self) -> Dict[str, Any]:
+        """Gets this result as something json.dumps can take."""
+        return {
+            "name": self.name,
+            "params": dict(self.params),
+            "metrics": dict(self.metrics),
+        }
+
+    def format_line(self) -> str:
+        """Formats this result as a single human-readable line."""
+        params_str = " ".join(f"{k}={v}" for k, v in self.params.items())
+        metrics_str = "  ".join(f"{k}={v:.6g}" for k, v in self.metrics.items())
+        return f"{self.name:<24} {params_str:<32} {metrics_str}"
+
+
+def time_per_call(fn: Callable[[], Any], *, min_time: float = 0.2, min_calls: int = 3) -> float:
+    """Calls fn repeatedly for at least min_time seconds and returns the mean seconds per call."""
+    calls = 0
+    time_beg = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - time_beg
+        if calls >= min_calls and elapsed >= min_time:
+            return elapsed / calls
+
+
+class SyntheticEventSource(EventSource):
+    """An event source which produces the same batch of events on every pull."""
+    __slots__ = (
+        "_events",
+    )
+
+    def __init__(self, events: List[Event]) -> None:
+        self._events = list(events)
+
+    # Implementation
+    def pull_events(self) -> List[Event]:
+        return list(self._events)
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return None
+
+
+class SyntheticRecordSource(EventSource):
+    """An event source which writes the same batch of keyed records into the ring on every pull."""
+    __slots__ = (
+        "_events",
+        "_keyed_records",
+        "_keys",
+        "_keys_generation",
+        "_records",
+    )
+
+    def __init__(self, records: List[Tuple[int, Any]]) -> None:
+        # (kind code, key,) pairs, e.g. OPEN_FILE_KIND and a path
+        self._keyed_records = list(records)
+        self._events = [get_record_kind(kind).make_event(key) for kind, key in records]
+        # (kind code, key ID,) pairs, for the key table they were interned in
+        self._records: List[Tuple[int, int]] = []
+        self._keys: Optional[KeyTable] = None
+        self._keys_generation = 0
+
+    # Implementation
+    def pull_events(self) -> List[Event]:
+        return list(self._events)
+
+    # Implementation
+    def pull_records(self, ring: EventRing) -> int:
+        if ring.keys is not self._keys or ring.keys.generation != self._keys_generation:
+            self._keys = ring.keys
+            self._keys_generation = ring.keys.generation
+            self._records = [(kind, ring.keys.intern(key),) for kind, key in self._keyed_records]
+        capture_time = time.perf_counter()
+        for kind, key_id in self._records:
+            ring.push(kind, key_id, capture_time)
+        return len(self._records)
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return None
+
+
+def make_ss2_reactor(*, root_dir: Path, db: DB, event_sources: List[EventSource]) -> SystemShock2Reactor:
+    """Makes a System Shock 2 reactor which doesn't touch the real game or database."""
+    return SystemShock2Reactor(
+        root_dir=root_dir,
+        event_sources=event_sources,
+        time_bases=[MonotonicFloatSeconds()],
+        db=db,
+    )
@@ -0,0 +1,55 @@
+"""
+One case of the startup benchmark, run in a fresh interpreter by bench_startup.
+
+This doesn't import anything from goodsplit (or the rest of the
+benchmarks) until the clock is running.
+
+Run with: python -m benchmarks.startup_child CASE DB_PATH
+"""
+import json
+from pathlib import Path
+import sys
+import time
+from typing import Dict
+
+
+def child_main(case: str, db_path: Path) -> None:
+    """Runs one case, and prints its times in milliseconds as JSON."""
+    times: Dict[str, float] = {}
+    time_beg = time.perf_counter()
+
+    if case == "import_main":
+        import goodsplit.__main__
+        times["import_ms"] = (time.perf_counter() - time_beg)*1000.0
+
+    elif case == "import_gui":
+        import goodsplit.gui_tk.root
+        times["import_ms"] = (time.perf_counter() - time_beg)*1000.0
+
+    elif case == "db_open":
+        from goodsplit.db import DB
+        times["import_ms"] = (time.perf_counter() - time_beg)*1000.0
+        time_open = time.perf_counter()
+        DB(db_path)
+        times["open_ms"] = (time.perf_counter() - time_open)*1000.0
+
+    elif case == "window":
+        from goodsplit.gui_tk.root import TkGuiRoot
+        times["import_ms"] = (time.perf_counter() - time_beg)*1000.0
+        root = TkGuiRoot(args=[])
+        root.wait_visibility()
+        times["window_ms"] = (time.perf_counter() - time_beg)*1000.0
+        root.destroy()
+
+    else:
+        raise ValueError(f"unknown startup case {case!r}")
+
+    print(json.dumps(times))
+
+
+def main() -> None:
+    child_main(sys.argv[1], Path(sys.argv[2]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,248 @@
+import argparse
 import logging
 from pathlib import Path
-from pathlib import PurePath
 import sys
-import time
-from typing import Callable
-from typing import Dict
+from typing import List
+from typing import Optional
 
-from .reactor import Reactor
-from .games import REACTOR_CONSTRUCTORS
-from .games import REACTORS
-from .gui_tk.root import TkGuiRoot
+from .games import get_game
+from .games import get_supported_games
+from .metrics import METRICS
+from .tracing import TRACER
+from .tracing import install_async_logging
+from .tracing import stop_async_logging
 
 LOG = logging.getLogger("main")
 
 
-def print_usage() -> None:
-    print(f"usage:")
-    print(f"    {sys.argv[0]} game_name path/to/game/root")
-    print(f"")
-    print(f"supported game_name values:")
-    for game_key in sorted(list(REACTORS.keys())):
-        game_cls = REACTORS[game_key]
-        print(f"  - {game_key}: {game_cls.get_game_title()}")
+def make_arg_parser() -> argparse.ArgumentParser:
+    """Makes the command line argument parser."""
+    game_list_str = "\n".join(
+        f"  - {info.key}: {info.title}" + (f" ({', '.join(info.platforms)} only)" if info.platforms is not None else "")
+        for info in sorted(get_supported_games().values(), key=(lambda info: info.key))
+    )
+    parser = argparse.ArgumentParser(
+        prog="goodsplit",
+        description="An autosplitter-first split timer for speedrunning.",
+        epilog=f"supported game keys:\n{game_list_str}",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--headless", action="store_true",
+        help="run without a GUI, logging splits to stdout as JSON lines")
+    parser.add_argument("--stats", action="store_true",
+        help="print per-segment statistics for --game and exit (needs numpy)")
+    parser.add_argument("--export", metavar="PATH", type=Path,
+        help="export the history of --game to a .csv or .jsonl file and exit")
+    parser.add_argument("--import", metavar="PATH", type=Path, dest="import_path",
+        help="import history for --game from a .jsonl or LiveSplit .lss file and exit")
+    parser.add_argument("--asyncio", action="store_true",
+        help="run the GUI on an asyncio event loop")
+    parser.add_argument("--max-refresh-rate", metavar="HZ", type=float, default=60.0,
+        help="never repaint game windows more often than this (default: %(default)s)")
+    parser.add_argument("--game", metavar="KEY", choices=sorted(list(get_supported_games().keys())),
+        help="game to run in headless mode or show statistics for")
+    parser.add_argument("--root-dir", metavar="DIR", type=Path,
+        help="game root dir (defaults to the one last used for this game)")
+    parser.add_argument("--user-dir", metavar="DIR", type=Path,
+        help="game user dir (defaults to the one last used for this game)")
+    parser.add_argument("--db", metavar="PATH", type=Path,
+        help="database to use instead of ~/goodsplit-times.sqlite3")
+    parser.add_argument("--record", metavar="PATH", type=Path,
+        help="in headless mode, record every event to an event log")
+    parser.add_argument("--replay", metavar="PATH", type=Path,
+        help="in headless mode, replay an event log instead of watching the game, into a temporary database unless --db is given")
+    parser.add_argument("--replay-speed", metavar="X", type=float, default=0.0,
+        help="replay at this multiple of real time (default: as fast as possible)")
+    parser.add_argument("--metrics", metavar="PATH", type=Path,
+        help="record latency metrics, and write them here on exit (F8 in a game window or SIGUSR1 in headless mode writes them too)")
+    parser.add_argument("--trace", metavar="PATH", type=Path,
+        help="trace what the reactor, database, inotify and game window are doing, and write it here as JSON lines on exit (and with F8 or SIGUSR1, like --metrics)")
+    parser.add_argument("--trace-sample", metavar="NAME=N", action="append", default=[],
+        help="only trace one in every N spans and events of NAME (reactor, db, inotify or tk_game); can be given more than once")
+    parser.add_argument("--debug", action="store_true",
+        help="enable debug logging")
+    return parser
 
-def main() -> None:
-    if False and len(sys.argv[1:]) == 0:
-        print_usage()
-        sys.exit(1)
-        return
 
-    #logging.basicConfig(level=logging.DEBUG)
-    logging.basicConfig(level=logging.INFO)
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = make_arg_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=(logging.DEBUG if args.debug else logging.INFO))
+    # Keep writing log lines off the reactor's thread
+    install_async_logging()
+
+    if args.metrics is not None:
+        METRICS.report_path = args.metrics
+        METRICS.enable()
+
+    for sample_str in args.trace_sample:
+        name, _, every_str = sample_str.partition("=")
+        try:
+            TRACER.set_sampling(name, int(every_str))
+        except ValueError:
+            parser.error(f"--trace-sample expects NAME=N with N at least 1, not {sample_str!r}")
+    if args.trace is not None:
+        TRACER.dump_path = args.trace
+        TRACER.enable()
+
+    try:
+        if args.stats:
+            main_stats(parser, args)
+        elif args.export is not None or args.import_path is not None:
+            main_transfer(parser, args)
+        elif args.headless:
+            main_headless(parser, args)
+        else:
+            # Only pull Tk in if we actually want a GUI
+            from .gui_tk.root import TkGuiRoot
+            if args.max_refresh_rate <= 0.0:
+                parser.error(f"--max-refresh-rate must be above 0, not {args.max_refresh_rate!r}")
+            root = TkGuiRoot(args=sys.argv[1:], max_refresh_rate_hz=args.max_refresh_rate)
+            if args.asyncio:
+                import asyncio
+                asyncio.get_event_loop().run_until_complete(root.run_async())
+            else:
+                root.run()
+    finally:
+        if args.metrics is not None:
+            METRICS.write_report()
+        if args.trace is not None:
+            TRACER.write_dump()
+        stop_async_logging()
+
+
+def main_stats(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Prints statistics for every segment of a game."""
+    from .analysis import compute_segment_stats
+    from .analysis import format_segment_stats
+    from .analysis import load_history_matrix
+    from .db import DB
+
+    if args.game is None:
+        parser.error("--stats requires --game")
+
+    db = DB(args.db)
+    game_id = db.ensure_game_id(
+        game_key=args.game,
+        game_title=get_game(args.game).title,
+    )
+    matrix = load_history_matrix(db, game_id=game_id)
+    sys.stdout.write(format_segment_stats(compute_segment_stats(matrix)))
+
+
+def main_transfer(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Imports or exports the history of a game."""
+    from .db import DB
+    from .history_io import export_history_csv
+    from .history_io import export_history_jsonl
+    from .history_io import import_history_jsonl
+    from .history_io import import_lss
+
+    if args.game is None:
+        parser.error("--export and --import require --game")
+
+    db = DB(args.db)
+    game_id = db.ensure_game_id(
+        game_key=args.game,
+        game_title=get_game(args.game).title,
+    )
+
+    if args.import_path is not None:
+        suffix = args.import_path.suffix.lower()
+        if suffix == ".lss":
+            counts = import_lss(db, game_id=game_id, path=args.import_path)
+        elif suffix == ".jsonl":
+            with open(args.import_path, "r", encoding="utf-8") as f:
+                counts = import_history_jsonl(db, game_id=game_id, f=f)
+        else:
+            parser.error(f"don't know how to import {suffix!r} files, expected .lss or .jsonl")
+        run_count, skipped_run_count, split_count = counts
+        print(f"Imported {run_count} run(s) with {split_count} split(s), skipped {skipped_run_count} run(s) already in the database")
+
+    if args.export is not None:
+        suffix = args.export.suffix.lower()
+        if suffix not in [".csv", ".jsonl"]:
+            parser.error(f"don't know how to export {suffix!r} files, expected .csv or .jsonl")
+        with open(args.export, "w", encoding="utf-8", newline="") as f:
+            if suffix == ".csv":
+                row_count = export_history_csv(db, game_id=game_id, out=f)
+                print(f"Exported {row_count} time stamp(s)")
+            else:
+                run_count = export_history_jsonl(db, game_id=game_id, out=f)
+                print(f"Exported {run_count} run(s)")
+
+
+def main_headless(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Runs a single game without a GUI."""
+    import tempfile
+
+    from .db import DB
+    from .headless import replay_headless
+    from .headless import run_headless
+    from .sources.replay import EventLogWriter
+    from .sources.replay import RecordingEventSource
+    from .sources.replay import ReplayEventSource
+    from .time_base import LoadRemovedTimeBase
+    from .time_base import VirtualFloatSeconds
+
+    if args.game is None:
+        parser.error("--headless requires --game")
+
+    game_key: str = args.game
+    game_root_dir: Optional[Path] = args.root_dir
+    game_user_dir: Optional[Path] = args.user_dir
+
+    db = DB(args.db)
+
+    # Fall back to whatever the GUI last used
+    if game_root_dir is None or game_user_dir is None:
+        game_id = db.ensure_game_id(
+            game_key=game_key,
+            game_title=get_game(game_key).title,
+        )
+        if game_root_dir is None:
+            root_dir_str = db.get_game_root_dir(game_id=game_id)
+            if not root_dir_str:
+                parser.error(f"no root dir known for {game_key!r}, please pass --root-dir")
+            game_root_dir = Path(root_dir_str)
+        if game_user_dir is None:
+            game_user_dir = Path(db.get_game_user_dir(game_id=game_id))
+
+    game_root_dir = game_root_dir.expanduser().resolve()
+    game_user_dir = game_user_dir.expanduser()
+    LOG.info(f"Running {game_key!r} headless, root={str(game_root_dir)!r} user={str(game_user_dir)!r}")
+
+    if args.replay is not None:
+        # Replayed runs would count towards the personal bests of real ones
+        with tempfile.TemporaryDirectory(prefix="goodsplit-replay-") as tmp_dir:
+            if args.db is None:
+                db = DB(Path(tmp_dir) / "replay.sqlite3")
+                LOG.info("Replaying into a temporary database, pass --db to keep it")
+            clock = VirtualFloatSeconds()
+            source = ReplayEventSource(args.replay, clock=clock)
+            reactor = get_game(game_key).create_reactor(game_root_dir, game_user_dir,
+                event_sources=[source],
+                # Load removal runs off the same virtual clock
+                time_bases=[clock, LoadRemovedTimeBase(now=clock.fetch_time_unzeroed)],
+                db=db,
+            )
+            replay_headless(reactor, source, clock,
+                speed=(args.replay_speed if args.replay_speed > 0.0 else None),
+            )
+        return
 
-    if True:
-        TkGuiRoot(args=sys.argv[1:]).run()
+    reactor = get_game(game_key).create_reactor(game_root_dir, game_user_dir, db=db)
+    if args.record is None:
+        run_headless(reactor)
     else:
-        game_name = sys.argv[1]
-        game_root = Path(sys.argv[2]).expanduser().resolve()
-        reactor = REACTOR_CONSTRUCTORS[game_name](game_root)
+        event_log = EventLogWriter(args.record)
+        reactor.wrap_event_sources(lambda src: RecordingEventSource(src, event_log))
+        try:
+            run_headless(reactor)
+        finally:
+            event_log.close()
 
-        while True:
-            reactor.update()
-            time.sleep(0.001)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TYPE_CHECKING
+
+from .interface import AsyncEventSource
+from .interface import Event
+from .interface import EventSource
+
+if TYPE_CHECKING:
+    from .reactor import Reactor
+    from .records import EventRing
+
+LOG = logging.getLogger("aio")
+
+# How often to poll sources which can't be waited on
+DEFAULT_POLL_INTERVAL = 0.005
+# How long to back off when a source fails
+ERROR_RETRY_INTERVAL = 0.5
+
+
+class SyncEventSourceAdapter(AsyncEventSource):
+    """
+    Wraps a synchronous event source so it can be awaited.
+
+    If the source has a file descriptor, we wait for it to become readable
+    on the event loop. Otherwise we poll it.
+    """
+    __slots__ = (
+        "_poll_interval",
+        "_source",
+    )
+
+    def __init__(self, source: EventSource, *, poll_interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        self._source = source
+        self._poll_interval = poll_interval
+
+    def get_source(self) -> EventSource:
+        """Gets the wrapped event source."""
+        return self._source
+
+    # Implementation
+    async def pull_events_async(self) -> List[Event]:
+        while True:
+            events = self._source.pull_events()
+            if events:
+                return events
+            await self._wait()
+
+    # Implementation
+    async def pull_records_async(self, ring: "EventRing") -> int:
+        while True:
+            count = self._source.pull_records(ring)
+            if count:
+                return count
+            await self._wait()
+
+    async def _wait(self) -> None:
+        """Waits until the source might have events."""
+        fd = self._source.fileno()
+        if fd is None:
+            await asyncio.sleep(self._poll_interval)
+        else:
+            await self._wait_readable(fd)
+
+    async def _wait_readable(self, fd: int) -> None:
+        """Waits until a file descriptor becomes readable."""
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+
+        def on_readable() -> None:
+            if not fut.done():
+                fut.set_result(None)
+
+        loop.add_reader(fd, on_readable)
+        try:
+            await fut
+        finally:
+            loop.remove_reader(fd)
+
+
+def as_async_event_source(source: EventSource) -> AsyncEventSource:
+    """Gets an awaitable version of an event source, wrapping it if necessary."""
+    if isinstance(source, AsyncEventSource):
+        return source
+    else:
+        return SyncEventSourceAdapter(source)
+
+
+async def _pull_records_later(src: AsyncEventSource, ring: "EventRing", delay: float) -> int:
+    """Waits for a while, then waits for a source to pull records into an event ring."""
+    if delay > 0.0:
+        await asyncio.sleep(delay)
+    return await src.pull_records_async(ring)
+
+
+async def run_reactor(reactor: "Reactor", *, on_update: Optional[Callable[[], None]] = None) -> None:
+    """
+    Runs a reactor on the current asyncio event loop until cancelled.
+
+    Each source gets its own pending pull into the reactor's event ring.
+    Whenever any complete, the reactor processes everything in the ring,
+    as Reactor.update() does.
+    """
+    ring = reactor.get_event_ring()
+    sources = [as_async_event_source(src) for src in reactor.get_event_sources()]
+    pending: Dict["asyncio.Future[int]", AsyncEventSource] = {
+        asyncio.ensure_future(src.pull_records_async(ring)): src
+        for src in sources
+    }
+
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                list(pending.keys()),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            time_now = reactor.fetch_time_now()
+            for fut in done:
+                src = pending.pop(fut)
+                delay = 0.0
+                try:
+                    fut.result()
+                except Exception as e:
+                    LOG.exception(e)
+                    # Don't spin on a broken source, but don't hold up the others either
+                    delay = ERROR_RETRY_INTERVAL
+                pending[asyncio.ensure_future(_pull_records_later(src, ring, delay))] = src
+            try:
+                reactor.process_records(time_now, ring)
+            except Exception as e:
+                LOG.exception(e)
+
+            if on_update is not None:
+                on_update()
+
+    finally:
+        for fut in pending.keys():
+            fut.cancel()
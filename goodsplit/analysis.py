@@ -0,0 +1,290 @@
+"""
+Run history statistics, done with NumPy.
+
+A game's history on one time base is loaded in a single query into a
+matrix with one row per run and one column per fuse split type, holding
+split times in seconds and NaN wherever a run never reached a split.
+Everything else is array operations on that matrix.
+
+Needs NumPy, which you can get with: pip install goodsplit-iamgreaser[analysis]
+"""
+import concurrent.futures
+import logging
+import math
+import os
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy # type: ignore
+
+from .db import DB
+
+LOG = logging.getLogger("analysis")
+
+# Percentiles to report for each segment
+PERCENTILES = [10.0, 25.0, 75.0, 90.0]
+
+# Above this many cells, the per-segment statistics get spread across processes
+PARALLEL_MIN_CELLS = 4000000
+
+# Split keys the reactor uses for the start and end of a run
+START_SPLIT_KEY = "$system:start"
+FINISH_SPLIT_KEY = "$system:finish"
+CANCEL_SPLIT_KEY = "$system:cancel"
+
+
+class HistoryMatrix:
+    """A game's split times on one time base, with runs as rows and fuse split types as columns."""
+    __slots__ = (
+        "fuse_split_type_ids",
+        "run_ids",
+        "times",
+        "type_keys",
+    )
+
+    def __init__(self, *, run_ids: "numpy.ndarray", fuse_split_type_ids: "numpy.ndarray", type_keys: List[str], times: "numpy.ndarray") -> None:
+        self.run_ids = run_ids
+        self.fuse_split_type_ids = fuse_split_type_ids
+        self.type_keys = type_keys
+        # Seconds, shape (len(run_ids), len(fuse_split_type_ids)), NaN if never reached
+        self.times = times
+
+    def get_column(self, type_key: str) -> Optional[int]:
+        """Gets the column for a fuse split type key, if it has ever been reached."""
+        try:
+            return self.type_keys.index(type_key)
+        except ValueError:
+            return None
+
+    def get_segments(self) -> "numpy.ndarray":
+        """
+        Gets the segment times, with the same shape as the split times.
+
+        A segment is the time from the previous split the same run reached.
+        Each row is sorted by time, differenced, and scattered back.
+        """
+        times = self.times
+        if times.size == 0:
+            return times.copy()
+        # NaN sorts last, and ties keep column order so a cancel comes after the split it shares a time with
+        order = numpy.argsort(times, axis=1, kind="stable")
+        sorted_times = numpy.take_along_axis(times, order, axis=1)
+        sorted_segments = numpy.diff(sorted_times, axis=1, prepend=0.0)
+        segments = numpy.empty_like(times)
+        numpy.put_along_axis(segments, order, sorted_segments, axis=1)
+        return segments
+
+
+class SegmentStats:
+    """Per fuse split type statistics for the segments ending at each split, in seconds."""
+    __slots__ = (
+        "bests",
+        "consistency",
+        "medians",
+        "percentiles",
+        "reached_counts",
+        "reset_rates",
+        "stds",
+        "type_keys",
+    )
+
+    def __init__(self, *, type_keys: List[str], reached_counts: "numpy.ndarray", bests: "numpy.ndarray", medians: "numpy.ndarray", percentiles: Dict[float, "numpy.ndarray"], stds: "numpy.ndarray", consistency: "numpy.ndarray", reset_rates: "numpy.ndarray") -> None:
+        self.type_keys = type_keys
+        self.reached_counts = reached_counts
+        self.bests = bests
+        self.medians = medians
+        self.percentiles = percentiles
+        self.stds = stds
+        # 1 / (1 + IQR/median): 1.0 is perfectly consistent, heading to 0.0 as it gets erratic
+        self.consistency = consistency
+        # Fraction of the runs reaching a split which were reset before the next one
+        self.reset_rates = reset_rates
+
+
+def load_history_matrix(db: DB, *, game_id: int, time_base_id: Optional[int] = None) -> HistoryMatrix:
+    """
+    Loads a game's history into a matrix.
+
+    If time_base_id isn't given, the game's oldest time base is used.
+    """
+    if time_base_id is None:
+        time_base_ids = sorted(db.get_time_base_keys(game_id=game_id).keys())
+        if not time_base_ids:
+            raise ValueError(f"Game {game_id!r} has no time bases")
+        time_base_id = time_base_ids[0]
+
+    rows = db.get_split_time_rows(game_id=game_id, time_base_id=time_base_id)
+    all_type_keys = db.get_fuse_split_type_keys(game_id=game_id)
+    if not rows:
+        return HistoryMatrix(
+            run_ids=numpy.zeros((0,), dtype=numpy.int64),
+            fuse_split_type_ids=numpy.zeros((0,), dtype=numpy.int64),
+            type_keys=[],
+            times=numpy.zeros((0, 0), dtype=numpy.float64),
+        )
+
+    data = numpy.array(rows, dtype=numpy.int64)
+    run_ids, run_rows = numpy.unique(data[:, 0], return_inverse=True)
+    fuse_split_type_ids, type_columns = numpy.unique(data[:, 1], return_inverse=True)
+    times = numpy.full((len(run_ids), len(fuse_split_type_ids)), numpy.nan, dtype=numpy.float64)
+    times[run_rows, type_columns] = data[:, 2] / 1000000.0
+
+    # Put the columns in the order the splits usually happen, with the system splits at either end
+    type_keys = [all_type_keys[int(type_id)] for type_id in fuse_split_type_ids]
+    column_ranks = numpy.array([
+        {START_SPLIT_KEY: 0, FINISH_SPLIT_KEY: 2, CANCEL_SPLIT_KEY: 3}.get(type_key, 1)
+        for type_key in type_keys
+    ])
+    column_order = numpy.lexsort((_nanmedian_or_inf(times), column_ranks))
+    fuse_split_type_ids = fuse_split_type_ids[column_order]
+    times = times[:, column_order]
+
+    LOG.info(f"Loaded {len(run_ids)} run(s) and {len(fuse_split_type_ids)} split type(s) for game {game_id!r}")
+    return HistoryMatrix(
+        run_ids=run_ids,
+        fuse_split_type_ids=fuse_split_type_ids,
+        type_keys=[type_keys[int(col)] for col in column_order],
+        times=times,
+    )
+
+
+def compute_segment_stats(matrix: HistoryMatrix, *, max_workers: Optional[int] = None) -> SegmentStats:
+    """
+    Computes statistics for each segment.
+
+    For matrices of at least PARALLEL_MIN_CELLS cells, the columns are
+    split into chunks and worked on in a process pool.
+    """
+    segments = matrix.get_segments()
+    reached = ~numpy.isnan(matrix.times)
+
+    # The start split has no segment, and a cancel isn't a segment anyone ran
+    excluded = [
+        col
+        for col in [matrix.get_column(START_SPLIT_KEY), matrix.get_column(CANCEL_SPLIT_KEY)]
+        if col is not None
+    ]
+    segments[:, excluded] = numpy.nan
+
+    # Resets happen after the last real split of every run which didn't finish
+    reset_rates = _compute_reset_rates(matrix, reached, excluded)
+
+    if segments.size >= PARALLEL_MIN_CELLS and segments.shape[1] > 1:
+        column_stats = _compute_column_stats_parallel(segments, max_workers=max_workers)
+    else:
+        column_stats = _compute_column_stats(segments)
+    bests, medians, percentiles, stds = column_stats
+
+    iqrs = percentiles[1] - percentiles[0]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        consistency = 1.0 / (1.0 + iqrs/medians)
+
+    return SegmentStats(
+        type_keys=list(matrix.type_keys),
+        reached_counts=reached.sum(axis=0),
+        bests=bests,
+        medians=medians,
+        percentiles={
+            pct: percentiles[i+2]
+            for i, pct in enumerate(PERCENTILES)
+        },
+        stds=stds,
+        consistency=consistency,
+        reset_rates=reset_rates,
+    )
+
+
+def _nanmedian_or_inf(times: "numpy.ndarray") -> "numpy.ndarray":
+    """Gets the median of each column, or infinity for columns which are all NaN."""
+    counts = (~numpy.isnan(times)).sum(axis=0)
+    medians = numpy.full((times.shape[1],), numpy.inf, dtype=numpy.float64)
+    if times.shape[0] != 0:
+        nonempty = (counts != 0)
+        medians[nonempty] = numpy.nanmedian(times[:, nonempty], axis=0)
+    return medians
+
+
+def _compute_reset_rates(matrix: HistoryMatrix, reached: "numpy.ndarray", excluded: List[int]) -> "numpy.ndarray":
+    """Works out how often runs get reset after each split."""
+    run_count, column_count = matrix.times.shape
+    reset_counts = numpy.zeros((column_count,), dtype=numpy.int64)
+    finish_col = matrix.get_column(FINISH_SPLIT_KEY)
+    if run_count != 0 and column_count != 0:
+        real_times = matrix.times.copy()
+        real_times[:, excluded] = numpy.nan
+        has_real = ~numpy.isnan(real_times).all(axis=1)
+        is_reset = has_real
+        if finish_col is not None:
+            is_reset = is_reset & ~reached[:, finish_col]
+        # The last split reached is the latest one, treating unreached as never
+        last_cols = numpy.argmax(numpy.where(numpy.isnan(real_times), -numpy.inf, real_times)[is_reset], axis=1)
+        reset_counts = numpy.bincount(last_cols, minlength=column_count)
+
+    reached_counts = reached.sum(axis=0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(reached_counts != 0, reset_counts / reached_counts, numpy.nan)
+
+
+ColumnStats = Tuple["numpy.ndarray", "numpy.ndarray", "numpy.ndarray", "numpy.ndarray"]
+
+
+def _compute_column_stats(segments: "numpy.ndarray") -> ColumnStats:
+    """
+    Computes (bests, medians, percentiles, stds,) for every column.
+
+    percentiles has a row each for the 25th and 75th, then one for each of PERCENTILES.
+    """
+    column_count = segments.shape[1]
+    pcts = [25.0, 75.0] + PERCENTILES
+    bests = numpy.full((column_count,), numpy.nan)
+    medians = numpy.full((column_count,), numpy.nan)
+    percentiles = numpy.full((len(pcts), column_count), numpy.nan)
+    stds = numpy.full((column_count,), numpy.nan)
+
+    nonempty = ~numpy.isnan(segments).all(axis=0)
+    if segments.shape[0] != 0 and nonempty.any():
+        values = segments[:, nonempty]
+        bests[nonempty] = numpy.nanmin(values, axis=0)
+        medians[nonempty] = numpy.nanmedian(values, axis=0)
+        percentiles[:, nonempty] = numpy.nanpercentile(values, pcts, axis=0)
+        stds[nonempty] = numpy.nanstd(values, axis=0)
+
+    return (bests, medians, percentiles, stds,)
+
+
+def _compute_column_stats_parallel(segments: "numpy.ndarray", *, max_workers: Optional[int]) -> ColumnStats:
+    """Computes the column statistics in chunks of columns across a process pool."""
+    worker_count = (max_workers if max_workers is not None else (os.cpu_count() or 1))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count) as pool:
+        chunk_size = int(math.ceil(segments.shape[1] / worker_count))
+        chunks = [
+            numpy.ascontiguousarray(segments[:, beg:beg+chunk_size])
+            for beg in range(0, segments.shape[1], chunk_size)
+        ]
+        LOG.info(f"Computing statistics in {len(chunks)} chunk(s)")
+        results = list(pool.map(_compute_column_stats, chunks))
+
+    return (
+        numpy.concatenate([r[0] for r in results]),
+        numpy.concatenate([r[1] for r in results]),
+        numpy.concatenate([r[2] for r in results], axis=1),
+        numpy.concatenate([r[3] for r in results]),
+    )
+
+
+def format_segment_stats(stats: SegmentStats) -> str:
+    """Formats segment statistics as a text table, in seconds."""
+    pct_headers = "".join(f" {f'p{pct:g}':>9}" for pct in PERCENTILES)
+    lines = [
+        f"{'split':<32} {'runs':>6} {'best':>9} {'median':>9}{pct_headers} {'std':>9} {'consist':>7} {'resets':>6}",
+    ]
+    for i, type_key in enumerate(stats.type_keys):
+        pct_values = "".join(f" {stats.percentiles[pct][i]:>9.2f}" for pct in PERCENTILES)
+        lines.append(
+            f"{type_key:<32} {int(stats.reached_counts[i]):>6d}"
+            f" {stats.bests[i]:>9.2f} {stats.medians[i]:>9.2f}{pct_values}"
+            f" {stats.stds[i]:>9.2f} {stats.consistency[i]:>7.3f} {stats.reset_rates[i]*100.0:>5.1f}%"
+        )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,258 @@
+"""
+Comparisons against past runs.
+
+The history for a game is read once, and from it we build per time base:
+
+- the split times of the personal best (PB), i.e. the finished run with
+  the lowest finish time,
+- the best segment for each fuse split type, where a segment is the time
+  from the previous split in the same run,
+- the sum of best segments over the PB's route.
+
+Looking up the deltas for a split is then a couple of dict lookups, and
+when a run ends the tables are updated from that run alone.
+
+All times in here are in integer microseconds, same as the database.
+"""
+import logging
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+LOG = logging.getLogger("comparison")
+
+# A run as a list of (fuse_split_type_id, {time_base_index: value_microseconds},)
+RunSplits = List[Tuple[int, Dict[int, int]]]
+
+
+class SplitComparison:
+    """How a split compares to history, per time base. Entries are None when there is nothing to compare against."""
+    __slots__ = (
+        "best_segment_deltas",
+        "pb_deltas",
+        "segment_times",
+    )
+
+    def __init__(self, *, pb_deltas: List[Optional[int]], best_segment_deltas: List[Optional[int]], segment_times: List[Optional[int]]) -> None:
+        self.pb_deltas = pb_deltas
+        self.best_segment_deltas = best_segment_deltas
+        self.segment_times = segment_times
+
+    def __repr__(self) -> str:
+        arg_strings = [
+            f"{sn}={getattr(self,sn)!r}"
+            for sn in self.__slots__
+        ]
+        arg_list_str = ", ".join(arg_strings)
+        return f"{self.__class__.__name__}({arg_list_str})"
+
+
+class ComparisonEngine:
+    """Personal best and best segment tables for one game."""
+    __slots__ = (
+        "_best_segments",
+        "_cancel_type_id",
+        "_finish_type_id",
+        "_pb_finish_times",
+        "_pb_routes",
+        "_pb_times",
+        "_run_prev_times",
+        "_run_splits",
+        "_start_type_id",
+        "_sum_of_best",
+        "_time_base_indices",
+    )
+
+    def __init__(self, *, time_base_ids: List[int], start_type_id: int, finish_type_id: int, cancel_type_id: int) -> None:
+        self._time_base_indices: Dict[int, int] = {
+            time_base_id: i
+            for i, time_base_id in enumerate(time_base_ids)
+        }
+        self._start_type_id = start_type_id
+        self._finish_type_id = finish_type_id
+        self._cancel_type_id = cancel_type_id
+
+        count = len(time_base_ids)
+        self._pb_times: List[Dict[int, int]] = [{} for i in range(count)]
+        self._pb_finish_times: List[Optional[int]] = [None]*count
+        self._pb_routes: List[List[int]] = [[] for i in range(count)]
+        self._best_segments: List[Dict[int, int]] = [{} for i in range(count)]
+        self._sum_of_best: List[Optional[int]] = [None]*count
+
+        self._run_splits: RunSplits = []
+        self._run_prev_times: List[Optional[int]] = [None]*count
+
+    def load_history(self, rows: Iterable[Tuple[int, int, int, int]]) -> None:
+        """
+        Builds the tables from a game's history.
+
+        rows is (run_id, fuse_split_type_id, time_base_id, value_microseconds,)
+        ordered by run and then by split.
+        """
+        run_count = 0
+        last_run_id: Optional[int] = None
+        last_type_id: Optional[int] = None
+        run_splits: RunSplits = []
+        for run_id, fuse_split_type_id, time_base_id, value_microseconds in rows:
+            if run_id != last_run_id:
+                if run_splits:
+                    self._apply_run(run_splits, update_sum_of_best=False)
+                    run_count += 1
+                run_splits = []
+                last_run_id = run_id
+                last_type_id = None
+
+            if fuse_split_type_id != last_type_id:
+                run_splits.append((fuse_split_type_id, {},))
+                last_type_id = fuse_split_type_id
+
+            idx = self._time_base_indices.get(time_base_id)
+            if idx is not None:
+                run_splits[-1][1][idx] = value_microseconds
+
+        if run_splits:
+            self._apply_run(run_splits, update_sum_of_best=False)
+            run_count += 1
+
+        for idx in range(len(self._sum_of_best)):
+            self._update_sum_of_best(idx)
+
+        LOG.info(f"Loaded comparisons from {run_count} run(s)")
+
+    def start_run(self) -> None:
+        """Starts tracking a new run."""
+        self._run_splits = []
+        self._run_prev_times = [None]*len(self._run_prev_times)
+
+    def add_split(self, fuse_split_type_id: int, time_stamps: List[int]) -> SplitComparison:
+        """Adds a split to the current run, and compares it against history."""
+        pb_deltas: List[Optional[int]] = []
+        best_segment_deltas: List[Optional[int]] = []
+        segment_times: List[Optional[int]] = []
+        values: Dict[int, int] = {}
+        for idx, value in enumerate(time_stamps):
+            values[idx] = value
+
+            pb_value = self._pb_times[idx].get(fuse_split_type_id)
+            pb_deltas.append(None if pb_value is None else value - pb_value)
+
+            prev_value = self._run_prev_times[idx]
+            if prev_value is None or not self._is_segment(fuse_split_type_id):
+                segment_times.append(None)
+                best_segment_deltas.append(None)
+            else:
+                segment = value - prev_value
+                segment_times.append(segment)
+                best_segment = self._best_segments[idx].get(fuse_split_type_id)
+                best_segment_deltas.append(None if best_segment is None else segment - best_segment)
+            self._run_prev_times[idx] = value
+
+        self._run_splits.append((fuse_split_type_id, values,))
+        return SplitComparison(
+            pb_deltas=pb_deltas,
+            best_segment_deltas=best_segment_deltas,
+            segment_times=segment_times,
+        )
+
+    def end_run(self) -> RunSplits:
+        """
+        Folds the current run into the tables, and returns it.
+
+        Cancelled runs still count towards best segments. Only runs which
+        have a finish split can become the PB.
+        """
+        run_splits = self._run_splits
+        self.add_run(run_splits)
+        self.start_run()
+        return run_splits
+
+    def add_run(self, run_splits: RunSplits) -> None:
+        """Folds a run which has ended into the tables. Folding the same run in again changes nothing."""
+        if run_splits:
+            self._apply_run(run_splits, update_sum_of_best=True)
+
+    def carry_on_run(self, other: "ComparisonEngine") -> None:
+        """Carries on with the run in progress on another engine for the same game."""
+        self._run_splits = list(other._run_splits)
+        self._run_prev_times = list(other._run_prev_times)
+
+    def get_pb_time(self, time_base_index: int, fuse_split_type_id: int) -> Optional[int]:
+        """Gets the PB's time for a split."""
+        return self._pb_times[time_base_index].get(fuse_split_type_id)
+
+    def get_pb_finish_time(self, time_base_index: int) -> Optional[int]:
+        """Gets the PB's finish time."""
+        return self._pb_finish_times[time_base_index]
+
+    def get_best_segment(self, time_base_index: int, fuse_split_type_id: int) -> Optional[int]:
+        """Gets the best segment ending in a split."""
+        return self._best_segments[time_base_index].get(fuse_split_type_id)
+
+    def get_sum_of_best(self, time_base_index: int) -> Optional[int]:
+        """Gets the sum of best segments along the PB's route."""
+        return self._sum_of_best[time_base_index]
+
+    def _is_segment(self, fuse_split_type_id: int) -> bool:
+        """Does a split of this type end a segment?"""
+        return fuse_split_type_id != self._start_type_id and fuse_split_type_id != self._cancel_type_id
+
+    def _apply_run(self, run_splits: RunSplits, *, update_sum_of_best: bool) -> None:
+        """Folds one run into the tables."""
+        for idx in range(len(self._pb_times)):
+            # Best segments
+            best_segments = self._best_segments[idx]
+            is_best_changed = False
+            prev_value: Optional[int] = None
+            finish_value: Optional[int] = None
+            for fuse_split_type_id, values in run_splits:
+                value = values.get(idx)
+                if value is None:
+                    continue
+                if prev_value is not None and self._is_segment(fuse_split_type_id):
+                    segment = value - prev_value
+                    best_segment = best_segments.get(fuse_split_type_id)
+                    if best_segment is None or segment < best_segment:
+                        best_segments[fuse_split_type_id] = segment
+                        is_best_changed = True
+                if fuse_split_type_id == self._finish_type_id:
+                    finish_value = value
+                prev_value = value
+
+            # Personal best
+            pb_finish_value = self._pb_finish_times[idx]
+            is_pb_changed = False
+            if finish_value is not None and (pb_finish_value is None or finish_value < pb_finish_value):
+                self._pb_finish_times[idx] = finish_value
+                self._pb_times[idx] = {
+                    fuse_split_type_id: values[idx]
+                    for fuse_split_type_id, values in run_splits
+                    if idx in values
+                }
+                self._pb_routes[idx] = [
+                    fuse_split_type_id
+                    for fuse_split_type_id, values in run_splits
+                    if idx in values and self._is_segment(fuse_split_type_id)
+                ]
+                is_pb_changed = True
+
+            if update_sum_of_best and (is_best_changed or is_pb_changed):
+                self._update_sum_of_best(idx)
+
+    def _update_sum_of_best(self, idx: int) -> None:
+        """Works out the sum of best segments along the PB's route for a time base."""
+        route = self._pb_routes[idx]
+        if not route:
+            self._sum_of_best[idx] = None
+            return
+        best_segments = self._best_segments[idx]
+        total = 0
+        for fuse_split_type_id in route:
+            best_segment = best_segments.get(fuse_split_type_id)
+            if best_segment is None:
+                # The route starts somewhere we have no segment for
+                self._sum_of_best[idx] = None
+                return
+            total += best_segment
+        self._sum_of_best[idx] = total
@@ -1,3 +1,11 @@
 from .core import DB as _DB
+from .core import RunRecord as _RunRecord
+from .core import RunSummaryRecord as _RunSummaryRecord
+from .core import SplitRecord as _SplitRecord
+from .writer import DBWriter as _DBWriter
 
 DB = _DB
+DBWriter = _DBWriter
+RunRecord = _RunRecord
+RunSummaryRecord = _RunSummaryRecord
+SplitRecord = _SplitRecord
@@ -1,36 +1,316 @@
+import contextlib
 import datetime
+import itertools
 import logging
 from pathlib import Path
+import struct
+import threading
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
 
 import sqlalchemy
 import sqlalchemy as SQL
 import sqlalchemy.engine.url
+import sqlalchemy.event
+import sqlalchemy.pool
+import sqlalchemy.util
 
 LOG = logging.getLogger("db")
 
 from . import schema
 from . import schema as S
 
+DEFAULT_DB_PATH = Path("~/goodsplit-times.sqlite3")
+
+# Connection profile
+BUSY_TIMEOUT_SECONDS = 5.0
+PAGE_CACHE_KIBIBYTES = 8192
+STATEMENT_CACHE_SIZE = 256
+SYNCHRONOUS_IDLE = "FULL"
+SYNCHRONOUS_IN_RUN = "NORMAL"
+
+# One engine per database file, shared by every handle in the process
+_ENGINES: Dict[Path, SQL.engine.Engine] = {}
+_ENGINES_LOCK = threading.Lock()
+
+# How many history rows to pull from SQLite at a time
+HISTORY_FETCH_SIZE = 4096
+
+# Statements used on the split path, built once so their compiled forms get cached
+_INSERT_RUN = S.runs.insert()
+_INSERT_SPLIT = S.splits.insert()
+_INSERT_TIME_STAMP = S.time_stamps.insert()
+_UPSERT_RUN_SUMMARY = S.run_summaries.insert().prefix_with("OR REPLACE")
+_DELETE_RUN_SUMMARY_TIMES = S.run_summary_times.delete().where(
+    S.run_summary_times.c.run_id == SQL.bindparam("summary_run_id"))
+_INSERT_RUN_SUMMARY_TIME = S.run_summary_times.insert()
+_UPSERT_RUN_LOADS = S.run_loads.insert().prefix_with("OR REPLACE")
+
+# The split type key which marks a run as finished
+FINISH_SPLIT_KEY = "$system:finish"
+
+
+def _on_sqlite_connect(dbapi_connection: Any, connection_record: Any) -> None:
+    """Applies our connection profile to a freshly opened SQLite connection."""
+    # pysqlite would begin transactions by itself, always deferred, so
+    # leave that to _on_sqlite_begin() which can take the write lock
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    try:
+        # WAL lets other processes read while we're writing, and vice versa
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT_SECONDS*1000)}")
+        cursor.execute(f"PRAGMA cache_size={-PAGE_CACHE_KIBIBYTES}")
+        cursor.execute(f"PRAGMA synchronous={SYNCHRONOUS_IDLE}")
+    finally:
+        cursor.close()
+    connection_record.info["synchronous"] = SYNCHRONOUS_IDLE
+
+
+def _on_sqlite_begin(C: SQL.engine.Connection) -> None:
+    """Begins a transaction, taking the write lock up front if the connection asked with S.BEGIN_IMMEDIATE."""
+    if C.get_execution_options().get(S.BEGIN_IMMEDIATE):
+        C.execute("BEGIN IMMEDIATE")
+    else:
+        C.execute("BEGIN")
+
+
+def _get_shared_engine(path: Path) -> SQL.engine.Engine:
+    """Gets the shared engine for a database file, creating and preparing it if necessary."""
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(path)
+        if engine is None:
+            LOG.info(f"Opening {path}")
+            engine = sqlalchemy.create_engine(
+                sqlalchemy.engine.url.URL(
+                    drivername="sqlite",
+                    database=str(path),
+                ),
+                # One long-lived connection per thread
+                poolclass=sqlalchemy.pool.SingletonThreadPool,
+                pool_size=8,
+                connect_args={
+                    "timeout": BUSY_TIMEOUT_SECONDS,
+                    "cached_statements": STATEMENT_CACHE_SIZE,
+                },
+                execution_options={
+                    "compiled_cache": sqlalchemy.util.LRUCache(STATEMENT_CACHE_SIZE),
+                },
+            )
+            sqlalchemy.event.listen(engine, "connect", _on_sqlite_connect)
+            sqlalchemy.event.listen(engine, "begin", _on_sqlite_begin)
+            schema.ensure_schema(engine)
+            with engine.connect() as C:
+                with C.begin():
+                    _backfill_run_summaries(C)
+            _ENGINES[path] = engine
+        return engine
+
+
+def _backfill_run_summaries(C: SQL.engine.Connection) -> int:
+    """
+    Adds summaries for any runs which don't have one yet.
+
+    This covers databases from before run summaries existed, and runs
+    which never got to finish or cancel. A run counts as finished if it
+    has a finish split, and its final times are those of its last split.
+
+    Returns the number of runs summarised.
+    """
+    missing_runs = (SQL.select([
+            S.runs.c.id.label("run_id"),
+            S.runs.c.game_id,
+        ])
+        .select_from(S.runs
+            .outerjoin(S.run_summaries, S.run_summaries.c.run_id == S.runs.c.id))
+        .where(S.run_summaries.c.run_id.is_(None))
+        .alias("missing_runs"))
+    missing_count = int(C.execute(SQL.select([SQL.func.count()])
+        .select_from(missing_runs)).scalar())
+    if missing_count == 0:
+        return 0
+
+    LOG.info(f"Summarising {missing_count} run(s)")
+
+    # Final times come from the last split of each run
+    last_splits = (SQL.select([
+            S.splits.c.run_id,
+            SQL.func.max(S.splits.c.id).label("split_id"),
+        ])
+        .select_from(missing_runs
+            .join(S.splits, S.splits.c.run_id == missing_runs.c.run_id))
+        .group_by(S.splits.c.run_id)
+        .alias("last_splits"))
+    C.execute(S.run_summary_times.insert().from_select(
+        ["run_id", "time_base_id", "value_microseconds"],
+        SQL.select([
+            last_splits.c.run_id,
+            S.time_stamps.c.time_base_id,
+            S.time_stamps.c.value_microseconds,
+        ])
+        .select_from(last_splits
+            .join(S.time_stamps, S.time_stamps.c.split_id == last_splits.c.split_id)),
+    ))
+
+    is_finished = (SQL.exists()
+        .where(S.splits.c.run_id == missing_runs.c.run_id)
+        .where(S.splits.c.fuse_split_type_id == S.fuse_split_types.c.id)
+        .where(S.fuse_split_types.c.type_key == FINISH_SPLIT_KEY))
+    split_count = (SQL.select([SQL.func.count()])
+        .where(S.splits.c.run_id == missing_runs.c.run_id)
+        .as_scalar())
+    C.execute(S.run_summaries.insert().from_select(
+        ["run_id", "game_id", "is_finished", "split_count"],
+        SQL.select([
+            missing_runs.c.run_id,
+            missing_runs.c.game_id,
+            is_finished,
+            split_count,
+        ]),
+    ))
+
+    return missing_count
+
+
+class SplitRecord:
+    """A split which is waiting to be written to the database."""
+    __slots__ = (
+        "fuse_split_type_id",
+        "origin_time",
+        "run_id",
+        "time_stamps",
+    )
+
+    def __init__(self, *, run_id: int, fuse_split_type_id: int, time_stamps: List[Tuple[int, int]], origin_time: Optional[float] = None) -> None:
+        self.run_id = run_id
+        self.fuse_split_type_id = fuse_split_type_id
+        # List of (time_base_id, value_microseconds,)
+        self.time_stamps = time_stamps
+        # time.perf_counter() when the event behind this split was read, for latency metrics
+        self.origin_time = origin_time
+
+
+class RunRecord:
+    """A run which has been started and is waiting to be written to the database."""
+    __slots__ = (
+        "game_id",
+        "run_id",
+        "run_start_datetime",
+    )
+
+    def __init__(self, *, run_id: int, game_id: int, run_start_datetime: str) -> None:
+        # A local ID from DB.new_local_run_id(), which splits and summaries use until it's written
+        self.run_id = run_id
+        self.game_id = game_id
+        self.run_start_datetime = run_start_datetime
+
+
+class RunSummaryRecord:
+    """A summary of a finished or cancelled run which is waiting to be written to the database."""
+    __slots__ = (
+        "final_times",
+        "game_id",
+        "is_finished",
+        "load_intervals",
+        "load_time_base_id",
+        "run_id",
+        "split_count",
+    )
+
+    def __init__(self, *, run_id: int, game_id: int, is_finished: bool, split_count: int, final_times: List[Tuple[int, int]], load_time_base_id: Optional[int] = None, load_intervals: Sequence[Tuple[int, int]] = ()) -> None:
+        self.run_id = run_id
+        self.game_id = game_id
+        self.is_finished = is_finished
+        self.split_count = split_count
+        # List of (time_base_id, value_microseconds,)
+        self.final_times = final_times
+        # List of (begin_microseconds, end_microseconds,) on load_time_base_id
+        self.load_time_base_id = load_time_base_id
+        self.load_intervals = load_intervals
+
+
+def pack_load_intervals(intervals: Sequence[Tuple[int, int]]) -> bytes:
+    """Packs load intervals into the form stored in run_loads.intervals."""
+    return struct.pack(f"<{len(intervals)*2}q", *(value for interval in intervals for value in interval))
+
+
+def unpack_load_intervals(data: bytes) -> List[Tuple[int, int]]:
+    """Unpacks load intervals from the form stored in run_loads.intervals."""
+    return [(int(beg), int(end),) for beg, end in struct.iter_unpack("<qq", data)]
+
+
 class DB:
     """A Goodsplit SQLite 3 database handle."""
     __slots__ = (
+        "_fuse_split_type_ids",
+        "_fuse_split_type_keys",
+        "_game_ids",
+        "_local_fuse_split_type_ids",
+        "_local_fuse_split_types",
+        "_local_ids",
+        "_real_ids_by_local_id",
         "_sql_engine",
+        "_synchronous",
+        "_time_base_ids",
+        "path",
     )
 
-    def __init__(self) -> None:
-        path = Path("~/goodsplit-times.sqlite3").expanduser().resolve()
-        LOG.info(f"Opening {path}")
-        self._sql_engine = sqlalchemy.create_engine(
-            sqlalchemy.engine.url.URL(
-                drivername="sqlite",
-                database=str(path),
-            )
-        )
-        self._prepare_sql_schema()
+    def __init__(self, path: Optional[Path] = None) -> None:
+        if path is None:
+            path = DEFAULT_DB_PATH
+        path = path.expanduser().resolve()
+        self.path = path
+        self._sql_engine = _get_shared_engine(path)
+        self._synchronous = SYNCHRONOUS_IDLE
+
+        # Identity cache
+        self._game_ids: Dict[str, int] = {}
+        self._time_base_ids: Dict[Tuple[int, str], int] = {}
+        self._fuse_split_type_ids: Dict[Tuple[int, str], int] = {}
+        self._fuse_split_type_keys: Dict[int, str] = {}
+
+        # Local IDs are negative, handed out without touching SQLite, and
+        # swapped for real ones by create_splits() when it writes them
+        self._local_ids = itertools.count(-1, -1)
+        self._real_ids_by_local_id: Dict[int, int] = {}
+        self._local_fuse_split_type_ids: Dict[Tuple[int, str], int] = {}
+        self._local_fuse_split_types: Dict[int, Tuple[int, str]] = {}
+
+    def _connect(self) -> SQL.engine.Connection:
+        """Gets this thread's connection, with our sync mode applied."""
+        C = self._sql_engine.connect()
+        if C.info.get("synchronous") != self._synchronous:
+            C.execute(f"PRAGMA synchronous={self._synchronous}")
+            C.info["synchronous"] = self._synchronous
+        return C
+
+    @contextlib.contextmanager
+    def _begin(self, *, immediate: bool = False) -> Iterator[SQL.engine.Connection]:
+        """
+        Gets this thread's connection inside a transaction.
+
+        With immediate=True the write lock is taken straight away, so
+        nothing else can write between what we read and what we write.
+        """
+        with self._connect() as C:
+            if immediate:
+                C = C.execution_options(**{S.BEGIN_IMMEDIATE: True})
+            with C.begin():
+                yield C
 
-    def _prepare_sql_schema(self) -> None:
-        """Creates all of the tables in our database if they don't exist already."""
-        schema.metadata.create_all(self._sql_engine)
+    def set_run_in_progress(self, in_progress: bool) -> None:
+        """
+        Switches the sync mode depending on whether a run is in progress.
+
+        During a run we only sync the WAL at checkpoints, so commits don't
+        wait on the disk. Outside of a run every commit is synced.
+        """
+        self._synchronous = (SYNCHRONOUS_IN_RUN if in_progress else SYNCHRONOUS_IDLE)
 
     def fetch_timestamp_now(self) -> str:
         """Fetches a timestamp of now in ISO format with microseconds."""
@@ -40,8 +320,16 @@ class DB:
 
     def ensure_game_id(self, *, game_key: str, game_title: str) -> int:
         """Gets the database ID for the game, creating it if necessary."""
+        result = self._game_ids.get(game_key)
+        if result is None:
+            result = self._fetch_or_create_game_id(game_key=game_key, game_title=game_title)
+            self._game_ids[game_key] = result
+        return result
+
+    def _fetch_or_create_game_id(self, *, game_key: str, game_title: str) -> int:
+        """Gets the database ID for the game from the database, creating it if necessary."""
         # Get, and if empty then dump
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             rows = (C.execute(SQL.select([S.games.c.id]).limit(1)
                 .where(S.games.c.type_key == game_key)))
 
@@ -53,49 +341,84 @@ class DB:
 
             # Otherwise... no - add it
             LOG.info(f"Adding game ID {game_key!r} -> {game_title!r}")
-            C.execute(S.games.insert()
+            result = C.execute(S.games.insert()
                 .values(type_key=game_key, title=game_title))
-
-            # Did we get an ID?
-            # Well, we got an ID, or something went horribly wrong
-            rows = (C.execute(SQL.select([S.games.c.id]).limit(1)
-                .where(S.games.c.type_key == game_key)))
-            row = rows.fetchone()
-            result = int(row[0])
-            return result
+            return int(result.inserted_primary_key[0])
 
     def ensure_fuse_split_type(self, *, game_id: int, type_key: str) -> int:
         """Gets the database ID for the fuse split type, creating it if necessary."""
+        result = self._fuse_split_type_ids.get((game_id, type_key,))
+        if result is None:
+            result = self._fetch_or_create_fuse_split_type(game_id=game_id, type_key=type_key)
+            self._remember_fuse_split_type(game_id=game_id, type_key=type_key, fuse_split_type_id=result)
+        return result
+
+    def reserve_fuse_split_type(self, *, game_id: int, type_key: str) -> int:
+        """
+        Gets an ID for the fuse split type without touching SQLite.
+
+        Types which are already known get their database ID. New ones get a
+        local ID, and are created along with the first split which uses them.
+        """
+        result = self._fuse_split_type_ids.get((game_id, type_key,))
+        if result is None:
+            result = self._local_fuse_split_type_ids.get((game_id, type_key,))
+            if result is None:
+                # setdefault, so two threads reserving the same type agree
+                result = self._local_fuse_split_type_ids.setdefault((game_id, type_key,), next(self._local_ids))
+                self._local_fuse_split_types[result] = (game_id, type_key,)
+                self._fuse_split_type_keys[result] = type_key
+        return result
+
+    def new_local_run_id(self) -> int:
+        """Hands out a local ID for a run which will be written by create_splits() as a RunRecord."""
+        return next(self._local_ids)
+
+    def _fetch_or_create_fuse_split_type(self, *, game_id: int, type_key: str) -> int:
+        """Gets the database ID for the fuse split type from the database, creating it if necessary."""
+        with self._connect() as C:
+            return self._fetch_or_create_fuse_split_type_on(C, game_id=game_id, type_key=type_key)
+
+    def _fetch_or_create_fuse_split_type_on(self, C: SQL.engine.Connection, *, game_id: int, type_key: str) -> int:
+        """Gets the database ID for the fuse split type on a connection, creating it if necessary."""
         # Get, and if empty then dump
-        with self._sql_engine.connect() as C:
-            rows = (C.execute(SQL.select([S.fuse_split_types.c.id]).limit(1)
-                .where(S.fuse_split_types.c.game_id == game_id)
-                .where(S.fuse_split_types.c.type_key == type_key)))
+        rows = (C.execute(SQL.select([S.fuse_split_types.c.id]).limit(1)
+            .where(S.fuse_split_types.c.game_id == game_id)
+            .where(S.fuse_split_types.c.type_key == type_key)))
 
-            # Did we get an ID?
-            row = rows.fetchone()
-            if row:
-                # Yes - return it
-                return int(row[0])
+        # Did we get an ID?
+        row = rows.fetchone()
+        if row:
+            # Yes - return it
+            return int(row[0])
 
-            # Otherwise... no - add it
-            LOG.info(f"Adding fuse split type ID {game_id!r} {type_key!r}")
-            C.execute(S.fuse_split_types.insert()
-                .values(game_id=game_id, type_key=type_key))
+        # Otherwise... no - add it
+        LOG.info(f"Adding fuse split type ID {game_id!r} {type_key!r}")
+        result = C.execute(S.fuse_split_types.insert()
+            .values(game_id=game_id, type_key=type_key))
+        return int(result.inserted_primary_key[0])
 
-            # Did we get an ID?
-            # Well, we got an ID, or something went horribly wrong
-            rows = (C.execute(SQL.select([S.fuse_split_types.c.id]).limit(1)
-                .where(S.fuse_split_types.c.game_id == game_id)
-                .where(S.fuse_split_types.c.type_key == type_key)))
-            row = rows.fetchone()
-            result = int(row[0])
-            return result
+    def _remember_fuse_split_type(self, *, game_id: int, type_key: str, fuse_split_type_id: int) -> None:
+        """Adds a fuse split type to the identity cache."""
+        self._fuse_split_type_ids[(game_id, type_key,)] = fuse_split_type_id
+        self._fuse_split_type_keys[fuse_split_type_id] = type_key
+
+    def get_fuse_split_type_key(self, *, fuse_split_type_id: int) -> str:
+        """Gets the type key for a fuse split type ID which has already been seen."""
+        return self._fuse_split_type_keys[fuse_split_type_id]
 
     def ensure_time_base_id(self, *, game_id: int, type_key: str) -> int:
         """Gets the database ID for the time base type, creating it if necessary."""
+        result = self._time_base_ids.get((game_id, type_key,))
+        if result is None:
+            result = self._fetch_or_create_time_base_id(game_id=game_id, type_key=type_key)
+            self._time_base_ids[(game_id, type_key,)] = result
+        return result
+
+    def _fetch_or_create_time_base_id(self, *, game_id: int, type_key: str) -> int:
+        """Gets the database ID for the time base type from the database, creating it if necessary."""
         # Get, and if empty then dump
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             rows = (C.execute(SQL.select([S.time_bases.c.id]).limit(1)
                 .where(S.time_bases.c.game_id == game_id)
                 .where(S.time_bases.c.type_key == type_key)))
@@ -108,81 +431,461 @@ class DB:
 
             # Otherwise... no - add it
             LOG.info(f"Adding time base ID {game_id!r} {type_key!r}")
-            C.execute(S.time_bases.insert()
+            result = C.execute(S.time_bases.insert()
                 .values(game_id=game_id, type_key=type_key))
+            return int(result.inserted_primary_key[0])
 
-            # Did we get an ID?
-            # Well, we got an ID, or something went horribly wrong
-            rows = (C.execute(SQL.select([S.time_bases.c.id]).limit(1)
-                .where(S.time_bases.c.game_id == game_id)
-                .where(S.time_bases.c.type_key == type_key)))
-            row = rows.fetchone()
-            result = int(row[0])
-            return result
+    def preload_game(self, *, game_id: int) -> None:
+        """Loads all of the time bases and fuse split types for a game into the identity cache in one query."""
+        query = SQL.union_all(
+            SQL.select([
+                SQL.literal_column("0").label("kind"),
+                S.time_bases.c.id,
+                S.time_bases.c.type_key,
+            ]).where(S.time_bases.c.game_id == game_id),
+            SQL.select([
+                SQL.literal_column("1").label("kind"),
+                S.fuse_split_types.c.id,
+                S.fuse_split_types.c.type_key,
+            ]).where(S.fuse_split_types.c.game_id == game_id),
+        )
+        with self._connect() as C:
+            rows = C.execute(query).fetchall()
+
+        for kind, row_id, type_key in rows:
+            if kind == 0:
+                self._time_base_ids[(game_id, type_key,)] = int(row_id)
+            else:
+                self._remember_fuse_split_type(game_id=game_id, type_key=type_key, fuse_split_type_id=int(row_id))
+
+        LOG.info(f"Preloaded {len(rows)} time base(s) and fuse split type(s) for game {game_id!r}")
 
     def create_run_id(self, *, game_id: int) -> int:
         """Creates a run for now and returns its ID."""
 
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             run_start_datetime = self.fetch_timestamp_now()
-            LOG.info(f"Adding run game={game_id!r} start={run_start_datetime!r}")
-            C.execute(S.runs.insert()
-                .values(game_id=game_id, run_start_datetime=run_start_datetime))
-
-            # Did we get an ID?
-            # Well, we got an ID, or something went horribly wrong
-            rows = (C.execute(SQL.select([S.runs.c.id]).limit(1)
-                .where(S.runs.c.game_id == game_id)
-                .where(S.runs.c.run_start_datetime == run_start_datetime)))
-            row = rows.fetchone()
-            result = int(row[0])
-            return result
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug(f"Adding run game={game_id!r} start={run_start_datetime!r}")
+            result = C.execute(_INSERT_RUN,
+                game_id=game_id,
+                run_start_datetime=run_start_datetime,
+            )
+            return int(result.inserted_primary_key[0])
 
     def create_split_id(self, *, run_id: int, fuse_split_type_id: int) -> int:
         """Creates a split and returns its ID."""
 
-        with self._sql_engine.connect() as C:
-            LOG.info(f"Adding split run={run_id!r} fuse_split_type={fuse_split_type_id!r}")
-            C.execute(S.splits.insert()
-                .values(run_id=run_id, fuse_split_type_id=fuse_split_type_id))
-
-            # Did we get an ID?
-            # Well, we got an ID, or something went horribly wrong
-            rows = (C.execute(SQL.select([S.splits.c.id]).limit(1)
-                .where(S.splits.c.run_id == run_id)
-                .where(S.splits.c.fuse_split_type_id == fuse_split_type_id)))
-            row = rows.fetchone()
-            result = int(row[0])
-            return result
+        with self._connect() as C:
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug(f"Adding split run={run_id!r} fuse_split_type={fuse_split_type_id!r}")
+            result = C.execute(_INSERT_SPLIT,
+                run_id=run_id,
+                fuse_split_type_id=fuse_split_type_id,
+            )
+            return int(result.inserted_primary_key[0])
 
     def create_time_stamp_id(self, *, split_id: int, time_base_id: int, value_microseconds: int) -> int:
         """Creates a time stamp and returns its ID."""
 
-        with self._sql_engine.connect() as C:
-            LOG.info(f"Adding time stamp split={split_id!r} time_base={time_base_id!r} value={value_microseconds!r}")
-            C.execute(S.time_stamps.insert().values(
+        with self._connect() as C:
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug(f"Adding time stamp split={split_id!r} time_base={time_base_id!r} value={value_microseconds!r}")
+            result = C.execute(_INSERT_TIME_STAMP,
                 split_id=split_id,
                 time_base_id=time_base_id,
                 value_microseconds=value_microseconds,
-            ))
-            # Did we get an ID?
-            # Well, we got an ID, or something went horribly wrong
-            rows = C.execute(SQL.select([S.time_stamps.c.id]).limit(1),
-                split_id=split_id,
-                time_base_id=time_base_id,
             )
-            row = rows.fetchone()
-            result = int(row[0])
-            return result
+            return int(result.inserted_primary_key[0])
+
+    def commit_split(self, run_id: int, fuse_split_type_id: int, time_stamps: Sequence[Tuple[int, int]]) -> int:
+        """
+        Creates a split and all of its time stamps in a single transaction.
+
+        time_stamps is a sequence of (time_base_id, value_microseconds,).
+
+        Returns the ID of the new split.
+        """
+        with self._begin() as C:
+            return self._insert_split(C,
+                run_id=run_id,
+                fuse_split_type_id=fuse_split_type_id,
+                time_stamps=time_stamps,
+            )
+
+    def create_splits(self, *, splits: Sequence["SplitRecord"], run_summaries: Sequence["RunSummaryRecord"] = (), runs: Sequence["RunRecord"] = ()) -> None:
+        """
+        Creates a batch of splits and all of their time stamps in a single transaction.
+
+        Any runs are created first, and any run summaries are written after
+        the splits, all in the same transaction. Local run and fuse split
+        type IDs are swapped for real ones, creating the fuse split types
+        which haven't been written yet.
+        """
+        # Only kept once the transaction has gone through
+        real_ids: Dict[int, int] = {}
+        with self._begin() as C:
+            for run in runs:
+                result = C.execute(_INSERT_RUN,
+                    game_id=run.game_id,
+                    run_start_datetime=run.run_start_datetime,
+                )
+                real_ids[run.run_id] = int(result.inserted_primary_key[0])
+            for split in splits:
+                self._insert_split(C,
+                    run_id=self._resolve_local_id(C, split.run_id, real_ids),
+                    fuse_split_type_id=self._resolve_local_id(C, split.fuse_split_type_id, real_ids),
+                    time_stamps=split.time_stamps,
+                )
+            for run_summary in run_summaries:
+                self._upsert_run_summary(C, run_summary, run_id=self._resolve_local_id(C, run_summary.run_id, real_ids))
+
+        self._real_ids_by_local_id.update(real_ids)
+        for local_id, real_id in real_ids.items():
+            fuse_split_type = self._local_fuse_split_types.get(local_id)
+            if fuse_split_type is not None:
+                game_id, type_key = fuse_split_type
+                self._remember_fuse_split_type(game_id=game_id, type_key=type_key, fuse_split_type_id=real_id)
+
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f"Wrote {len(runs)} run(s), {len(splits)} split(s) and {len(run_summaries)} run summary(s)")
+
+    def _resolve_local_id(self, C: SQL.engine.Connection, row_id: int, real_ids: Dict[int, int]) -> int:
+        """Swaps a local ID for a real one, creating its fuse split type if that's what it is."""
+        if row_id >= 0:
+            return row_id
+        real_id = self._real_ids_by_local_id.get(row_id)
+        if real_id is None:
+            real_id = real_ids.get(row_id)
+        if real_id is None:
+            fuse_split_type = self._local_fuse_split_types.get(row_id)
+            if fuse_split_type is None:
+                raise KeyError(f"Local ID {row_id!r} has no run written for it")
+            game_id, type_key = fuse_split_type
+            real_id = real_ids[row_id] = self._fetch_or_create_fuse_split_type_on(C, game_id=game_id, type_key=type_key)
+        return real_id
+
+    def _upsert_run_summary(self, C: SQL.engine.Connection, run_summary: "RunSummaryRecord", *, run_id: int) -> None:
+        """Writes or replaces a run summary, for the given real run ID, on a connection which is already in a transaction."""
+        C.execute(_UPSERT_RUN_SUMMARY,
+            run_id=run_id,
+            game_id=run_summary.game_id,
+            is_finished=run_summary.is_finished,
+            split_count=run_summary.split_count,
+        )
+        C.execute(_DELETE_RUN_SUMMARY_TIMES, summary_run_id=run_id)
+        if run_summary.final_times:
+            C.execute(_INSERT_RUN_SUMMARY_TIME, [
+                {
+                    "run_id": run_id,
+                    "time_base_id": time_base_id,
+                    "value_microseconds": value_microseconds,
+                }
+                for time_base_id, value_microseconds in run_summary.final_times
+            ])
+        if run_summary.load_time_base_id is not None and run_summary.load_intervals:
+            # One row for the whole run, however many loads it had
+            C.execute(_UPSERT_RUN_LOADS,
+                run_id=run_id,
+                time_base_id=run_summary.load_time_base_id,
+                load_count=len(run_summary.load_intervals),
+                total_microseconds=sum(end - beg for beg, end in run_summary.load_intervals),
+                intervals=pack_load_intervals(run_summary.load_intervals),
+            )
+
+    def backfill_run_summaries(self) -> int:
+        """
+        Adds summaries for any runs which don't have one yet.
+
+        This already happens when a database is first opened, so it's only
+        needed after runs have been added behind our back.
+
+        Returns the number of runs summarised.
+        """
+        with self._begin() as C:
+            return _backfill_run_summaries(C)
+
+    def get_best_runs(self, *, game_id: int, time_base_id: int, limit: int) -> List[Tuple[int, int]]:
+        """
+        Gets the fastest finished runs for a game on a time base.
+
+        Returns a list of (run_id, final_value_microseconds,), fastest first.
+        """
+        query = (SQL.select([
+                S.run_summary_times.c.run_id,
+                S.run_summary_times.c.value_microseconds,
+            ])
+            .select_from(S.run_summary_times
+                .join(S.run_summaries, S.run_summaries.c.run_id == S.run_summary_times.c.run_id))
+            .where(S.run_summary_times.c.time_base_id == time_base_id)
+            .where(S.run_summaries.c.game_id == game_id)
+            .where(S.run_summaries.c.is_finished == True)
+            .order_by(S.run_summary_times.c.value_microseconds, S.run_summary_times.c.run_id)
+            .limit(limit))
+        with self._connect() as C:
+            return [(int(row[0]), int(row[1]),) for row in C.execute(query)]
+
+    def get_recent_runs(self, *, game_id: int, limit: int, finished_only: bool = False) -> List[Tuple[int, bool, int]]:
+        """
+        Gets the most recent finished or cancelled runs for a game.
+
+        Returns a list of (run_id, is_finished, split_count,), newest first.
+        """
+        query = (SQL.select([
+                S.run_summaries.c.run_id,
+                S.run_summaries.c.is_finished,
+                S.run_summaries.c.split_count,
+            ])
+            .where(S.run_summaries.c.game_id == game_id)
+            .order_by(S.run_summaries.c.run_id.desc())
+            .limit(limit))
+        if finished_only:
+            query = query.where(S.run_summaries.c.is_finished == True)
+        with self._connect() as C:
+            return [(int(row[0]), bool(row[1]), int(row[2]),) for row in C.execute(query)]
+
+    def get_run_final_times(self, *, run_id: int) -> List[Tuple[int, int]]:
+        """Gets the final times of a run as a list of (time_base_id, value_microseconds,)."""
+        query = (SQL.select([
+                S.run_summary_times.c.time_base_id,
+                S.run_summary_times.c.value_microseconds,
+            ])
+            .where(S.run_summary_times.c.run_id == run_id))
+        with self._connect() as C:
+            return [(int(row[0]), int(row[1]),) for row in C.execute(query)]
+
+    def get_run_load_intervals(self, *, run_id: int) -> Tuple[Optional[int], List[Tuple[int, int]]]:
+        """
+        Gets the loads removed from a run.
+
+        Returns (time_base_id, [(begin_microseconds, end_microseconds,), ...],),
+        or (None, [],) if the run had no loads.
+        """
+        query = (SQL.select([
+                S.run_loads.c.time_base_id,
+                S.run_loads.c.intervals,
+            ])
+            .where(S.run_loads.c.run_id == run_id))
+        with self._connect() as C:
+            row = C.execute(query).first()
+        if row is None:
+            return (None, [],)
+        return (int(row[0]), unpack_load_intervals(bytes(row[1])),)
+
+    def get_split_times(self, *, fuse_split_type_id: int, time_base_id: int) -> List[Tuple[int, int]]:
+        """
+        Gets the time of a split type in every run which reached it.
+
+        Returns a list of (run_id, value_microseconds,), oldest run first.
+        """
+        query = (SQL.select([
+                S.splits.c.run_id,
+                S.time_stamps.c.value_microseconds,
+            ])
+            .select_from(S.splits
+                .join(S.time_stamps, S.time_stamps.c.split_id == S.splits.c.id))
+            .where(S.splits.c.fuse_split_type_id == fuse_split_type_id)
+            .where(S.time_stamps.c.time_base_id == time_base_id)
+            .order_by(S.splits.c.run_id))
+        with self._connect() as C:
+            return [(int(row[0]), int(row[1]),) for row in C.execute(query)]
+
+    def _insert_split(self, C: SQL.engine.Connection, *, run_id: int, fuse_split_type_id: int, time_stamps: Sequence[Tuple[int, int]]) -> int:
+        """Inserts a split and its time stamps on a connection which is already in a transaction."""
+        result = C.execute(_INSERT_SPLIT,
+            run_id=run_id,
+            fuse_split_type_id=fuse_split_type_id,
+        )
+        split_id = int(result.inserted_primary_key[0])
+
+        # One prepared statement for every time base
+        if time_stamps:
+            C.execute(_INSERT_TIME_STAMP, [
+                {
+                    "split_id": split_id,
+                    "time_base_id": time_base_id,
+                    "value_microseconds": value_microseconds,
+                }
+                for time_base_id, value_microseconds in time_stamps
+            ])
+
+        return split_id
+
+    def iter_split_history(self, *, game_id: int) -> Iterator[Tuple[int, int, int, int]]:
+        """
+        Streams every time stamp ever recorded for a game.
+
+        Yields (run_id, fuse_split_type_id, time_base_id, value_microseconds,)
+        ordered by run and then by split.
+        """
+        query = (SQL.select([
+                S.splits.c.run_id,
+                S.splits.c.fuse_split_type_id,
+                S.time_stamps.c.time_base_id,
+                S.time_stamps.c.value_microseconds,
+            ])
+            .select_from(S.runs
+                .join(S.splits, S.splits.c.run_id == S.runs.c.id)
+                .join(S.time_stamps, S.time_stamps.c.split_id == S.splits.c.id))
+            .where(S.runs.c.game_id == game_id)
+            .order_by(S.splits.c.run_id, S.splits.c.id))
+
+        with self._connect() as C:
+            rows = C.execution_options(stream_results=True).execute(query)
+            while True:
+                chunk = rows.fetchmany(HISTORY_FETCH_SIZE)
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield (int(row[0]), int(row[1]), int(row[2]), int(row[3]),)
+
+    def get_split_time_rows(self, *, game_id: int, time_base_id: int) -> List[Tuple[int, int, int]]:
+        """
+        Gets every time stamp for a game on one time base in one query.
+
+        Returns a list of (run_id, fuse_split_type_id, value_microseconds,).
+        """
+        query = (SQL.select([
+                S.splits.c.run_id,
+                S.splits.c.fuse_split_type_id,
+                S.time_stamps.c.value_microseconds,
+            ])
+            .select_from(S.runs
+                .join(S.splits, S.splits.c.run_id == S.runs.c.id)
+                .join(S.time_stamps, S.time_stamps.c.split_id == S.splits.c.id))
+            .where(S.runs.c.game_id == game_id)
+            .where(S.time_stamps.c.time_base_id == time_base_id))
+        with self._connect() as C:
+            # Skip the row wrappers, the caller wants plain tuples in bulk
+            compiled = query.compile(dialect=self._sql_engine.dialect)
+            cursor = C.connection.cursor()
+            try:
+                cursor.execute(str(compiled), [compiled.params[name] for name in compiled.positiontup])
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    def get_time_base_keys(self, *, game_id: int) -> Dict[int, str]:
+        """Gets every time base for a game, as a dict of time_base_id -> type_key."""
+        with self._connect() as C:
+            rows = C.execute(SQL.select([S.time_bases.c.id, S.time_bases.c.type_key])
+                .where(S.time_bases.c.game_id == game_id))
+            return {int(row[0]): str(row[1]) for row in rows}
+
+    def get_fuse_split_type_keys(self, *, game_id: int) -> Dict[int, str]:
+        """Gets every fuse split type for a game, as a dict of fuse_split_type_id -> type_key."""
+        with self._connect() as C:
+            rows = C.execute(SQL.select([S.fuse_split_types.c.id, S.fuse_split_types.c.type_key])
+                .where(S.fuse_split_types.c.game_id == game_id))
+            return {int(row[0]): str(row[1]) for row in rows}
+
+    def iter_history_export(self, *, game_id: int) -> Iterator[Tuple[int, str, Optional[bool], str, str, int]]:
+        """
+        Streams a game's whole history for exporting.
+
+        Yields (run_id, run_start_datetime, is_finished, split_key, time_base_key, value_microseconds,)
+        ordered by run, then split, then time base. is_finished is None for runs which are still going.
+        """
+        query = (SQL.select([
+                S.runs.c.id,
+                S.runs.c.run_start_datetime,
+                S.run_summaries.c.is_finished,
+                S.fuse_split_types.c.type_key,
+                S.time_bases.c.type_key,
+                S.time_stamps.c.value_microseconds,
+            ])
+            .select_from(S.runs
+                .outerjoin(S.run_summaries, S.run_summaries.c.run_id == S.runs.c.id)
+                .join(S.splits, S.splits.c.run_id == S.runs.c.id)
+                .join(S.fuse_split_types, S.fuse_split_types.c.id == S.splits.c.fuse_split_type_id)
+                .join(S.time_stamps, S.time_stamps.c.split_id == S.splits.c.id)
+                .join(S.time_bases, S.time_bases.c.id == S.time_stamps.c.time_base_id))
+            .where(S.runs.c.game_id == game_id)
+            .order_by(S.runs.c.id, S.splits.c.id, S.time_stamps.c.time_base_id))
+
+        with self._connect() as C:
+            rows = C.execution_options(stream_results=True).execute(query)
+            while True:
+                chunk = rows.fetchmany(HISTORY_FETCH_SIZE)
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield (
+                        int(row[0]),
+                        str(row[1]),
+                        (None if row[2] is None else bool(row[2])),
+                        str(row[3]),
+                        str(row[4]),
+                        int(row[5]),
+                    )
+
+    def create_runs_bulk(self, *, game_id: int, runs: Sequence[Tuple[str, Sequence[Tuple[int, Sequence[Tuple[int, int]]]]]]) -> List[Optional[int]]:
+        """
+        Creates a batch of runs and their splits in one transaction.
+
+        runs is a sequence of (run_start_datetime, [(fuse_split_type_id, [(time_base_id, value_microseconds,), ...],), ...],).
+        Runs which already exist for this game are skipped along with their
+        splits, so importing the same thing twice doesn't duplicate anything,
+        and importing it again after a batch failed picks up where it left off.
+        IDs are handed out up front, so everything goes in with three executemany() calls.
+
+        Returns the new run IDs in the same order, with None for skipped runs.
+        """
+        # IDs are handed out from max(id), which nothing else may change meanwhile
+        with self._begin(immediate=True) as C:
+            run_start_datetimes = [run_start_datetime for run_start_datetime, _ in runs]
+            existing = set(row[0] for row in C.execute(SQL.select([S.runs.c.run_start_datetime])
+                .where(S.runs.c.game_id == game_id)
+                .where(S.runs.c.run_start_datetime.in_(list(set(run_start_datetimes))))))
+            next_run_id = int(C.execute(SQL.select([SQL.func.coalesce(SQL.func.max(S.runs.c.id), 0)])).scalar()) + 1
+            next_split_id = int(C.execute(SQL.select([SQL.func.coalesce(SQL.func.max(S.splits.c.id), 0)])).scalar()) + 1
+
+            result: List[Optional[int]] = []
+            run_rows: List[Dict[str, Any]] = []
+            split_rows: List[Dict[str, Any]] = []
+            time_stamp_rows: List[Dict[str, Any]] = []
+            for run_start_datetime, splits in runs:
+                if run_start_datetime in existing:
+                    result.append(None)
+                    continue
+                existing.add(run_start_datetime)
+                result.append(next_run_id)
+                run_rows.append({
+                    "id": next_run_id,
+                    "game_id": game_id,
+                    "run_start_datetime": run_start_datetime,
+                })
+                for fuse_split_type_id, time_stamps in splits:
+                    split_rows.append({
+                        "id": next_split_id,
+                        "run_id": next_run_id,
+                        "fuse_split_type_id": fuse_split_type_id,
+                    })
+                    for time_base_id, value_microseconds in time_stamps:
+                        time_stamp_rows.append({
+                            "split_id": next_split_id,
+                            "time_base_id": time_base_id,
+                            "value_microseconds": value_microseconds,
+                        })
+                    next_split_id += 1
+                next_run_id += 1
+
+            if run_rows:
+                C.execute(_INSERT_RUN, run_rows)
+            if split_rows:
+                C.execute(_INSERT_SPLIT, split_rows)
+            if time_stamp_rows:
+                C.execute(_INSERT_TIME_STAMP, time_stamp_rows)
+
+        return result
 
     def get_game_root_dir(self, *, game_id: int) -> str:
         """Gets the root dir for the game."""
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             # Did we get a row?
             # Well, we got a row, or something went horribly wrong
-            rows = C.execute(SQL.select([S.games.c.game_root_dir]).limit(1),
-                id=game_id,
-            )
+            rows = C.execute(SQL.select([S.games.c.game_root_dir]).limit(1)
+                .where(S.games.c.id == game_id))
             row = rows.fetchone()
             result = row[0]
             assert isinstance(result, str)
@@ -190,12 +893,11 @@ class DB:
 
     def get_game_user_dir(self, *, game_id: int) -> str:
         """Gets the user dir for the game."""
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             # Did we get a row?
             # Well, we got a row, or something went horribly wrong
-            rows = C.execute(SQL.select([S.games.c.game_user_dir]).limit(1),
-                id=game_id,
-            )
+            rows = C.execute(SQL.select([S.games.c.game_user_dir]).limit(1)
+                .where(S.games.c.id == game_id))
             row = rows.fetchone()
             result = row[0]
             assert isinstance(result, str)
@@ -203,14 +905,14 @@ class DB:
 
     def set_game_root_dir(self, *, game_id: int, game_root_dir: str) -> None:
         """Sets the root dir for the game."""
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             C.execute(S.games.update()
                 .where(S.games.c.id == game_id)
                 .values(game_root_dir=game_root_dir))
 
     def set_game_user_dir(self, *, game_id: int, game_user_dir: str) -> None:
         """Sets the user dir for the game."""
-        with self._sql_engine.connect() as C:
+        with self._connect() as C:
             C.execute(S.games.update()
                 .where(S.games.c.id == game_id)
                 .values(game_user_dir=game_user_dir))
@@ -1,6 +1,8 @@
 import datetime
 import logging
 from pathlib import Path
+from typing import Callable
+from typing import List
 
 import sqlalchemy
 import sqlalchemy as SQL
@@ -68,6 +70,8 @@ splits = SQL.Table("splits", metadata,
     SQL.Column("run_id", SQL.ForeignKey("runs.id"), nullable=False),
     SQL.Column("fuse_split_type_id", SQL.ForeignKey("fuse_split_types.id"), nullable=False),
     SQL.Index("splits_unique_run_id_fuse_spit_type_id", "run_id", "fuse_split_type_id", unique=True),
+    # For looking up one split type across every run
+    SQL.Index("splits_fuse_split_type_id_run_id", "fuse_split_type_id", "run_id"),
 )
 
 # Time stamps (ref: Split) (ref: Time base)
@@ -79,3 +83,188 @@ time_stamps = SQL.Table("time_stamps", metadata,
     SQL.Column("value_microseconds", SQL.BigInteger, nullable=False),
     SQL.Index("time_stamps_unique_split_id_time_base_id", "split_id", "time_base_id", unique=True),
 )
+
+
+#
+# Summaries of finished and cancelled runs, so history doesn't need to
+# walk every split. These are maintained by the database writer.
+#
+
+# Run summaries (ref: Run) (ref: Game)
+run_summaries = SQL.Table("run_summaries", metadata,
+    SQL.Column("run_id", SQL.ForeignKey("runs.id"), nullable=False, primary_key=True, autoincrement=False),
+    SQL.Column("game_id", SQL.ForeignKey("games.id"), nullable=False),
+    SQL.Column("is_finished", SQL.Boolean, nullable=False),
+    SQL.Column("split_count", SQL.Integer, nullable=False),
+    SQL.Index("run_summaries_game_id_is_finished_run_id", "game_id", "is_finished", "run_id"),
+    # For listing recent runs regardless of how they ended
+    SQL.Index("run_summaries_game_id_run_id", "game_id", "run_id"),
+)
+
+# Final times of a run (ref: Run summary) (ref: Time base)
+run_summary_times = SQL.Table("run_summary_times", metadata,
+    SQL.Column("run_id", SQL.ForeignKey("run_summaries.run_id"), nullable=False, primary_key=True, autoincrement=False),
+    SQL.Column("time_base_id", SQL.ForeignKey("time_bases.id"), nullable=False, primary_key=True, autoincrement=False),
+    SQL.Column("value_microseconds", SQL.BigInteger, nullable=False),
+    # For ranking runs by final time
+    SQL.Index("run_summary_times_time_base_id_value_run_id", "time_base_id", "value_microseconds", "run_id"),
+)
+
+# Loads removed from a run (ref: Run summary) (ref: Time base)
+# intervals is every (begin, end,) pair in microseconds on time_base_id, packed as little-endian int64s
+run_loads = SQL.Table("run_loads", metadata,
+    SQL.Column("run_id", SQL.ForeignKey("run_summaries.run_id"), nullable=False, primary_key=True, autoincrement=False),
+    SQL.Column("time_base_id", SQL.ForeignKey("time_bases.id"), nullable=False),
+    SQL.Column("load_count", SQL.Integer, nullable=False),
+    SQL.Column("total_microseconds", SQL.BigInteger, nullable=False),
+    SQL.Column("intervals", SQL.LargeBinary, nullable=False),
+)
+
+
+#
+# Migrations.
+#
+# The schema version lives in SQLite's user_version, so checking it is one
+# pragma rather than reflecting every table. MIGRATIONS[n] takes a database
+# from version n to version n+1; add new ones to the end and never change
+# old ones. Each runs in the one transaction ensure_schema() begins.
+#
+
+# Version 1, as it was when it shipped. Migrations spell out their DDL
+# rather than using the tables above, as those only describe the latest
+# version. IF NOT EXISTS lets this finish off databases from before
+# versioning, which have some of these already.
+_V1_DDL = [
+    """CREATE TABLE IF NOT EXISTS games (
+        id INTEGER NOT NULL,
+        type_key VARCHAR NOT NULL,
+        title VARCHAR NOT NULL,
+        game_root_dir VARCHAR DEFAULT '' NOT NULL,
+        game_user_dir VARCHAR DEFAULT '' NOT NULL,
+        PRIMARY KEY (id),
+        UNIQUE (type_key),
+        UNIQUE (title)
+    )""",
+    """CREATE TABLE IF NOT EXISTS fuse_split_types (
+        id INTEGER NOT NULL,
+        game_id INTEGER NOT NULL,
+        type_key VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(game_id) REFERENCES games (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS fuse_split_types_unique_game_id_type_key ON fuse_split_types (game_id, type_key)",
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER NOT NULL,
+        game_id INTEGER NOT NULL,
+        run_start_datetime VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(game_id) REFERENCES games (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS runs_unique_game_id_run_start_datetime ON runs (game_id, run_start_datetime)",
+    """CREATE TABLE IF NOT EXISTS time_bases (
+        id INTEGER NOT NULL,
+        game_id INTEGER NOT NULL,
+        type_key VARCHAR NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(game_id) REFERENCES games (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS time_bases_unique_game_id_type_key ON time_bases (game_id, type_key)",
+    """CREATE TABLE IF NOT EXISTS run_summaries (
+        run_id INTEGER NOT NULL,
+        game_id INTEGER NOT NULL,
+        is_finished BOOLEAN NOT NULL,
+        split_count INTEGER NOT NULL,
+        PRIMARY KEY (run_id),
+        FOREIGN KEY(run_id) REFERENCES runs (id),
+        FOREIGN KEY(game_id) REFERENCES games (id),
+        CHECK (is_finished IN (0, 1))
+    )""",
+    "CREATE INDEX IF NOT EXISTS run_summaries_game_id_is_finished_run_id ON run_summaries (game_id, is_finished, run_id)",
+    "CREATE INDEX IF NOT EXISTS run_summaries_game_id_run_id ON run_summaries (game_id, run_id)",
+    """CREATE TABLE IF NOT EXISTS splits (
+        id INTEGER NOT NULL,
+        run_id INTEGER NOT NULL,
+        fuse_split_type_id INTEGER NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(run_id) REFERENCES runs (id),
+        FOREIGN KEY(fuse_split_type_id) REFERENCES fuse_split_types (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS splits_fuse_split_type_id_run_id ON splits (fuse_split_type_id, run_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS splits_unique_run_id_fuse_spit_type_id ON splits (run_id, fuse_split_type_id)",
+    """CREATE TABLE IF NOT EXISTS run_loads (
+        run_id INTEGER NOT NULL,
+        time_base_id INTEGER NOT NULL,
+        load_count INTEGER NOT NULL,
+        total_microseconds BIGINT NOT NULL,
+        intervals BLOB NOT NULL,
+        PRIMARY KEY (run_id),
+        FOREIGN KEY(run_id) REFERENCES run_summaries (run_id),
+        FOREIGN KEY(time_base_id) REFERENCES time_bases (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS run_summary_times (
+        run_id INTEGER NOT NULL,
+        time_base_id INTEGER NOT NULL,
+        value_microseconds BIGINT NOT NULL,
+        PRIMARY KEY (run_id, time_base_id),
+        FOREIGN KEY(run_id) REFERENCES run_summaries (run_id),
+        FOREIGN KEY(time_base_id) REFERENCES time_bases (id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS run_summary_times_time_base_id_value_run_id ON run_summary_times (time_base_id, value_microseconds, run_id)",
+    """CREATE TABLE IF NOT EXISTS time_stamps (
+        id INTEGER NOT NULL,
+        split_id INTEGER NOT NULL,
+        time_base_id INTEGER NOT NULL,
+        value_microseconds BIGINT NOT NULL,
+        PRIMARY KEY (id),
+        FOREIGN KEY(split_id) REFERENCES splits (id),
+        FOREIGN KEY(time_base_id) REFERENCES time_bases (id)
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS time_stamps_unique_split_id_time_base_id ON time_stamps (split_id, time_base_id)",
+]
+
+
+def _migrate_unversioned(C: SQL.engine.Connection) -> None:
+    """Brings a new database, or one from before versioning, up to version 1."""
+    for statement in _V1_DDL:
+        C.execute(statement)
+
+
+MIGRATIONS: List[Callable[[SQL.engine.Connection], None]] = [
+    _migrate_unversioned,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(C: SQL.engine.Connection) -> int:
+    """Gets the schema version of a database, 0 if it has never been versioned."""
+    return int(C.execute("PRAGMA user_version").scalar())
+
+
+# Execution option which makes a connection's transactions take the write
+# lock as they begin, given an engine with DB's "begin" event listener
+BEGIN_IMMEDIATE = "goodsplit_begin_immediate"
+
+
+def ensure_schema(engine: SQL.engine.Engine) -> bool:
+    """
+    Brings the database up to SCHEMA_VERSION.
+
+    Returns True if anything had to be migrated.
+    """
+    with engine.connect() as C:
+        if get_schema_version(C) == SCHEMA_VERSION:
+            return False
+
+        # Take the write lock before looking again, so only one process migrates
+        with C.execution_options(**{BEGIN_IMMEDIATE: True}).begin():
+            version = get_schema_version(C)
+            if version > SCHEMA_VERSION:
+                LOG.warning(f"Database is at schema version {version}, but we only know up to {SCHEMA_VERSION}")
+                return False
+            for from_version in range(version, SCHEMA_VERSION):
+                LOG.info(f"Migrating database from schema version {from_version} to {from_version+1}")
+                MIGRATIONS[from_version](C)
+            C.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    return True
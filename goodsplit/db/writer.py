@@ -0,0 +1,374 @@
+import atexit
+import json
+import logging
+from pathlib import Path
+import queue
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import sqlalchemy.exc
+
+from ..metrics import METRICS
+from ..metrics import STAGE_DB_COMMIT
+from ..tracing import NULL_SPAN
+from ..tracing import TRACER
+from .core import DB
+from .core import RunRecord
+from .core import RunSummaryRecord
+from .core import SplitRecord
+
+LOG = logging.getLogger("db_writer")
+TRACE = TRACER.get_channel("db")
+
+# Sentinel which tells the writer thread to stop.
+_STOP = object()
+
+# Delays between attempts at writing a batch, the last one repeating
+RETRY_DELAYS = [0.05, 0.2, 1.0, 5.0]
+# How long a batch which fails with the database being busy or unavailable keeps being retried
+MAX_RETRY_SECS_ON_BUSY = 30.0
+# Attempts at a batch which fails with something other than the database being busy or unavailable
+MAX_ATTEMPTS_ON_ERROR = 4
+# How long close() waits for a batch which is still being written, once it has given up on it
+CLOSE_GIVE_UP_WAIT_SECS = 1.0
+
+
+class DBWriterStats:
+    """A snapshot of the counters for a DB writer."""
+    __slots__ = (
+        "batches_written",
+        "flush_latency_last",
+        "flush_latency_max",
+        "flush_latency_total",
+        "queue_depth",
+        "queue_depth_max",
+        "splits_dropped",
+        "splits_pending",
+        "splits_written",
+    )
+
+    def __init__(self) -> None:
+        self.queue_depth = 0
+        self.queue_depth_max = 0
+        self.splits_pending = 0
+        self.splits_written = 0
+        self.splits_dropped = 0
+        self.batches_written = 0
+        self.flush_latency_last = 0.0
+        self.flush_latency_max = 0.0
+        self.flush_latency_total = 0.0
+
+    def __repr__(self) -> str:
+        arg_strings = [
+            f"{sn}={getattr(self,sn)!r}"
+            for sn in self.__slots__
+        ]
+        arg_list_str = ", ".join(arg_strings)
+        return f"{self.__class__.__name__}({arg_list_str})"
+
+
+class DBWriter:
+    """
+    A write-behind queue which persists splits on a background thread.
+
+    Splits are put on a bounded queue. The writer thread takes everything
+    that is pending and writes it in one transaction as soon as the queue
+    goes idle.
+
+    Submitting never blocks. Anything which can't be written goes to a
+    spool file next to the database (see get_spool_path()) so it isn't
+    lost, and flush() returns False from then on. That happens to
+    anything submitted while the queue is full, to a batch which is
+    still failing with the database busy or unavailable after
+    MAX_RETRY_SECS_ON_BUSY, to a batch which fails for any other reason
+    a few times, and to anything still queued if close() times out.
+
+    Use flush() to wait until everything submitted so far has been committed.
+    """
+    __slots__ = (
+        "_cond",
+        "_db",
+        "_dropped_count",
+        "_is_closed",
+        "_is_dead",
+        "_is_giving_up",
+        "_max_batch_size",
+        "_processed_count",
+        "_queue",
+        "_spool_lock",
+        "_stats",
+        "_submitted_count",
+        "_thread",
+    )
+
+    def __init__(self, *, db: DB, max_queue_size: int = 1024, max_batch_size: int = 256) -> None:
+        self._db = db
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=max_queue_size)
+        self._max_batch_size = max_batch_size
+        self._cond = threading.Condition()
+        self._submitted_count = 0
+        self._processed_count = 0
+        # Items which never made it into the database
+        self._dropped_count = 0
+        self._is_closed = False
+        # Set if the writer thread has stopped for any reason
+        self._is_dead = False
+        # Set by close() to stop retrying, and spool instead
+        self._is_giving_up = False
+        self._spool_lock = threading.Lock()
+        self._stats = DBWriterStats()
+        self._thread = threading.Thread(
+            target=self._run,
+            name="goodsplit-db-writer",
+            daemon=True,
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def get_spool_path(self) -> Path:
+        """Gets where batches which couldn't be written get saved, as JSON lines."""
+        return self._db.path.with_name(self._db.path.name + ".unwritten.jsonl")
+
+    def submit_run(self, run: RunRecord) -> None:
+        """Queues a run to be created before every split submitted after it."""
+        self._submit(run)
+
+    def submit_split(self, split: SplitRecord) -> None:
+        """Queues a split to be written."""
+        self._submit(split)
+
+    def submit_run_summary(self, run_summary: RunSummaryRecord) -> None:
+        """Queues a run summary to be written after every split submitted before it."""
+        self._submit(run_summary)
+
+    def _submit(self, item: Any) -> None:
+        """Queues something to be written."""
+        self._put(item)
+        depth = self._queue.qsize()
+        if depth > self._stats.queue_depth_max:
+            self._stats.queue_depth_max = depth
+
+    def _put(self, item: Any) -> None:
+        """Puts something on the queue, or in the spool file if it's full, unless we've been closed or the thread has died."""
+        with self._cond:
+            if self._is_closed:
+                raise RuntimeError("DB writer has been closed")
+            if self._is_dead:
+                raise RuntimeError("DB writer thread has stopped")
+            try:
+                self._queue.put_nowait(item)
+                self._submitted_count += 1
+                return
+            except queue.Full:
+                pass
+        LOG.warning(f"DB writer queue is full with {self._queue.qsize()} item(s), not waiting for it")
+        self._spool_items([item])
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until everything submitted so far has been processed.
+
+        Returns False if it timed out, the writer thread has stopped, or
+        anything has ever failed to be written (in which case it's in the
+        spool file).
+        """
+        with self._cond:
+            target = self._submitted_count
+            is_done = self._cond.wait_for(
+                (lambda: self._processed_count >= target or self._is_dead),
+                timeout,
+            )
+            return is_done and self._processed_count >= target and self._dropped_count == 0
+
+    def close(self, timeout: Optional[float] = 10.0) -> None:
+        """
+        Flushes everything and stops the writer thread.
+
+        If that takes longer than timeout, anything still queued is
+        spooled, and so is the batch being written once it next fails.
+        """
+        with self._cond:
+            if self._is_closed:
+                return
+            self._is_closed = True
+        atexit.unregister(self.close)
+        if not self._is_dead:
+            time_end = (None if timeout is None else time.monotonic() + timeout)
+            try:
+                # Nothing else can be submitted now, so the thread will make room
+                self._queue.put(_STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            else:
+                self._thread.join(None if time_end is None else max(0.0, time_end - time.monotonic()))
+                if not self._thread.is_alive() and self._queue.empty():
+                    return
+            LOG.error(f"DB writer did not stop within {timeout!r} seconds")
+        # It's a daemon thread, so anything it still has is lost at exit
+        with self._cond:
+            self._is_giving_up = True
+            self._cond.notify_all()
+        items: List[Any] = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                items.append(item)
+        if items:
+            self._spool_items(items)
+            with self._cond:
+                self._processed_count += len(items)
+                self._cond.notify_all()
+        self._thread.join(CLOSE_GIVE_UP_WAIT_SECS)
+
+    def get_stats(self) -> DBWriterStats:
+        """Gets a snapshot of the counters for this writer."""
+        stats = DBWriterStats()
+        for sn in DBWriterStats.__slots__:
+            setattr(stats, sn, getattr(self._stats, sn))
+        stats.queue_depth = self._queue.qsize()
+        with self._cond:
+            stats.splits_pending = self._submitted_count - self._processed_count
+        return stats
+
+    def _run(self) -> None:
+        """Main loop for the writer thread."""
+        try:
+            is_stopping = False
+            while not is_stopping:
+                # Wait for something to do
+                batch: List[Any] = []
+                item = self._queue.get()
+
+                # Grab everything else that's pending
+                while True:
+                    if item is _STOP:
+                        is_stopping = True
+                    else:
+                        batch.append(item)
+                    if len(batch) >= self._max_batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+
+                # There's room on the queue again
+                with self._cond:
+                    self._cond.notify_all()
+
+                if batch:
+                    try:
+                        self._write_batch(batch)
+                    except Exception as e:
+                        # Keep going, whatever happened
+                        LOG.exception(e)
+                    with self._cond:
+                        self._processed_count += len(batch)
+                        self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._is_dead = True
+                self._cond.notify_all()
+
+    def _write_batch(self, batch: List[Any]) -> None:
+        """Writes a batch of splits and run summaries, retrying until it goes in or is spooled."""
+        runs = [item for item in batch if isinstance(item, RunRecord)]
+        splits = [item for item in batch if isinstance(item, SplitRecord)]
+        run_summaries = [item for item in batch if isinstance(item, RunSummaryRecord)]
+        attempt = 0
+        time_first = time.monotonic()
+        while True:
+            time_beg = time.monotonic()
+            try:
+                with (TRACE.span("write_batch", runs=len(runs), splits=len(splits), run_summaries=len(run_summaries), attempt=attempt) if TRACE.enabled else NULL_SPAN):
+                    self._db.create_splits(splits=splits, run_summaries=run_summaries, runs=runs)
+            except Exception as e:
+                # Busy, locked, or can't get at the disk: this may clear up, so keep trying for a while
+                is_transient = isinstance(e, sqlalchemy.exc.OperationalError)
+                if is_transient:
+                    is_retrying = (time.monotonic() - time_first < MAX_RETRY_SECS_ON_BUSY)
+                    LOG.warning(f"Could not write {len(splits)} split(s){', will retry' if is_retrying else ''}: {e}")
+                else:
+                    LOG.exception(e)
+                    is_retrying = (attempt + 1 < MAX_ATTEMPTS_ON_ERROR)
+                if is_retrying:
+                    # close() wakes us if it gives up on us
+                    with self._cond:
+                        self._cond.wait_for((lambda: self._is_giving_up), RETRY_DELAYS[min(attempt, len(RETRY_DELAYS)-1)])
+                    is_retrying = not self._is_giving_up
+                if not is_retrying:
+                    self._spool_batch(runs, splits, run_summaries)
+                    return
+                attempt += 1
+            else:
+                time_end = time.monotonic()
+                latency = time_end - time_beg
+                self._stats.batches_written += 1
+                self._stats.splits_written += len(splits)
+                self._stats.flush_latency_last = latency
+                self._stats.flush_latency_total += latency
+                if latency > self._stats.flush_latency_max:
+                    self._stats.flush_latency_max = latency
+                if METRICS.enabled:
+                    for split in splits:
+                        if split.origin_time is not None:
+                            METRICS.record_since(STAGE_DB_COMMIT, split.origin_time)
+                return
+
+    def _spool_items(self, items: List[Any]) -> None:
+        """Saves things which were submitted but can't be written to the spool file."""
+        self._spool_batch(
+            [item for item in items if isinstance(item, RunRecord)],
+            [item for item in items if isinstance(item, SplitRecord)],
+            [item for item in items if isinstance(item, RunSummaryRecord)],
+        )
+
+    def _spool_batch(self, runs: List[RunRecord], splits: List[SplitRecord], run_summaries: List[RunSummaryRecord]) -> None:
+        """Saves a batch which can't be written to the spool file, and counts it as dropped."""
+        spool_path = self.get_spool_path()
+        LOG.error(f"Giving up on writing {len(runs)} run(s), {len(splits)} split(s) and {len(run_summaries)} run summary(s), saving them to {str(spool_path)!r}")
+        with self._cond:
+            self._dropped_count += len(runs) + len(splits) + len(run_summaries)
+        self._stats.splits_dropped += len(splits)
+        # Run and fuse split type IDs below zero are local ones, which were never written
+        records: List[Dict[str, Any]] = []
+        for run in runs:
+            records.append({
+                "type": "run",
+                "run_id": run.run_id,
+                "game_id": run.game_id,
+                "run_start_datetime": run.run_start_datetime,
+            })
+        for split in splits:
+            records.append({
+                "type": "split",
+                "run_id": split.run_id,
+                "fuse_split_type_id": split.fuse_split_type_id,
+                "fuse_split_type_key": self._db.get_fuse_split_type_key(fuse_split_type_id=split.fuse_split_type_id),
+                "time_stamps": split.time_stamps,
+            })
+        for run_summary in run_summaries:
+            records.append({
+                "type": "run_summary",
+                "run_id": run_summary.run_id,
+                "game_id": run_summary.game_id,
+                "is_finished": run_summary.is_finished,
+                "split_count": run_summary.split_count,
+                "final_times": run_summary.final_times,
+                "load_time_base_id": run_summary.load_time_base_id,
+                "load_intervals": list(run_summary.load_intervals),
+            })
+        try:
+            # Batches can be spooled by the writer thread and by whatever submits
+            with self._spool_lock, open(spool_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except OSError as e:
+            LOG.exception(e)
@@ -1,15 +1,157 @@
+"""
+The game registry.
+
+Games are described by GameInfo records, which say everything needed to
+list a game without importing it. The reactor module for a game only
+gets imported when that game is actually opened.
+
+Games come from the built-in list below, and from the "goodsplit.games"
+entry point group. Each entry point should load a GameInfo (or a list of
+them), ideally from a small module which doesn't import the reactor:
+
+    entry_points={
+        "goodsplit.games": [
+            "my_game = my_package.manifest:GAME_INFO",
+        ],
+    }
+"""
+import importlib
+import logging
 from pathlib import Path
-from typing import Callable
+import sys
+from typing import Any
 from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
 from typing import Type
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from ..reactor import Reactor
+
+LOG = logging.getLogger("games")
+
+ENTRY_POINT_GROUP = "goodsplit.games"
+
+
+class GameInfo:
+    """What we know about a game without importing its reactor."""
+    __slots__ = (
+        "_reactor_class",
+        "key",
+        "platforms",
+        "reactor_path",
+        "title",
+    )
+
+    def __init__(self, *, key: str, title: str, reactor_path: str, platforms: Optional[Sequence[str]] = None) -> None:
+        self.key = key
+        self.title = title
+        # "module:ClassName" of the reactor
+        self.reactor_path = reactor_path
+        # sys.platform prefixes this game can be autosplit on, or None for all of them
+        self.platforms = (list(platforms) if platforms is not None else None)
+        self._reactor_class: Optional[Type["Reactor"]] = None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(key={self.key!r}, title={self.title!r}, reactor_path={self.reactor_path!r}, platforms={self.platforms!r})"
+
+    def is_supported(self) -> bool:
+        """Can this game be autosplit on the platform we're running on?"""
+        if self.platforms is None:
+            return True
+        return any(sys.platform.startswith(platform) for platform in self.platforms)
+
+    def get_reactor_class(self) -> Type["Reactor"]:
+        """Gets the reactor class, importing it the first time."""
+        if self._reactor_class is None:
+            module_name, _, class_name = self.reactor_path.partition(":")
+            LOG.info(f"Loading {self.key!r} from {module_name!r}")
+            self._reactor_class = getattr(importlib.import_module(module_name), class_name)
+        return self._reactor_class
+
+    def create_reactor(self, game_root_dir: Path, game_user_dir: Path, **kwargs: Any) -> "Reactor":
+        """
+        Creates a reactor for this game.
+
+        kwargs are optional overrides for the reactor (event_sources, time_bases, db).
+        """
+        return self.get_reactor_class().create_for_game(
+            game_root_dir=game_root_dir,
+            game_user_dir=game_user_dir,
+            **kwargs,
+        )
+
+
+# Games which ship with Goodsplit
+BUILTIN_GAMES: List[GameInfo] = [
+    GameInfo(
+        key="system_shock_2",
+        title="System Shock 2",
+        reactor_path="goodsplit.games.system_shock_2:SystemShock2Reactor",
+        platforms=["linux"],
+    ),
+]
+
+_games: Optional[Dict[str, GameInfo]] = None
+
+
+def get_games() -> Dict[str, GameInfo]:
+    """Gets every known game, keyed by game key. Plugins are looked up the first time."""
+    global _games
+    if _games is None:
+        games = {
+            info.key: info
+            for info in BUILTIN_GAMES
+        }
+        for info in _load_plugin_games():
+            if info.key in games:
+                LOG.warning(f"Ignoring plugin game {info.key!r}, as that key is already taken")
+                continue
+            games[info.key] = info
+        _games = games
+    return _games
+
+
+def get_supported_games() -> Dict[str, GameInfo]:
+    """Gets every game which can be autosplit on the platform we're running on, keyed by game key."""
+    return {
+        game_key: info
+        for game_key, info in get_games().items()
+        if info.is_supported()
+    }
+
+
+def get_game(game_key: str) -> GameInfo:
+    """Gets a game by its key. Raises KeyError if there is no such game."""
+    return get_games()[game_key]
+
 
-from ..reactor import Reactor
-from .system_shock_2 import SystemShock2Reactor as _SystemShock2Reactor
+def _load_plugin_games() -> List[GameInfo]:
+    """Loads the game manifests from the entry points."""
+    try:
+        import importlib.metadata as importlib_metadata
+    except ImportError:
+        # Python 3.7 and older
+        return []
 
+    all_entry_points: Any = importlib_metadata.entry_points()
+    if hasattr(all_entry_points, "select"):
+        entry_points = all_entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        entry_points = all_entry_points.get(ENTRY_POINT_GROUP, [])
 
-REACTOR_CONSTRUCTORS: Dict[str, Callable[[Path, Path], Reactor]] = {
-    "system_shock_2": (lambda game_root_dir, game_user_dir: _SystemShock2Reactor(root_dir=game_root_dir)),
-}
-REACTORS: Dict[str, Type[Reactor]] = {
-    "system_shock_2": _SystemShock2Reactor,
-}
+    infos: List[GameInfo] = []
+    for entry_point in entry_points:
+        try:
+            loaded = entry_point.load()
+        except Exception:
+            LOG.exception(f"Could not load game plugin {entry_point.name!r}")
+            continue
+        for info in (loaded if isinstance(loaded, (list, tuple)) else [loaded]):
+            if isinstance(info, GameInfo):
+                infos.append(info)
+            else:
+                LOG.warning(f"Game plugin {entry_point.name!r} gave us {info!r}, which isn't a GameInfo")
+    return infos
@@ -2,17 +2,33 @@ import enum
 import logging
 from pathlib import Path
 from pathlib import PurePath
+from typing import Any
 from typing import List
+from typing import Optional
 
+from goodsplit.db import DB
 from goodsplit.interface import Event
+from goodsplit.interface import EventSource
+from goodsplit.interface import TimeBase
 from goodsplit.reactor import Reactor
+from goodsplit.records import EventRing
+from goodsplit.rules import RuleAction
+from goodsplit.rules import SplitRule
 from goodsplit.sources.inotify import INotifyEventSource
 from goodsplit.sources.inotify import OpenFileEvent
 from goodsplit.sources.inotify import CloseFileEvent
+from goodsplit.time_base import LoadRemovedTimeBase
 from goodsplit.time_base import MonotonicFloatSeconds
 
 LOG = logging.getLogger("system_shock_2")
 
+# Files the game keeps opening which we don't care about
+IGNORED_FILE_NAMES = [
+    "shock2.gam",
+    "allobjs.osm",
+    "motiondb.bin",
+]
+
 
 class RunState(enum.Enum):
     """
@@ -37,11 +53,9 @@ class SystemShock2Reactor(Reactor):
         "_path_earth_mis",
         "_path_ss2_exe",
         "_root_dir",
-        "_run_state",
-        "_missions_entered",
     )
 
-    def __init__(self, *, root_dir: Path) -> None:
+    def __init__(self, *, root_dir: Path, event_sources: Optional[List[EventSource]] = None, time_bases: Optional[List[TimeBase]] = None, db: Optional[DB] = None) -> None:
         # Set up paths
         self._root_dir = root_dir.resolve()
         self._path_cs1_avi = self._root_dir / "Data" / "cutscenes" / "cs1.avi"
@@ -49,10 +63,8 @@ class SystemShock2Reactor(Reactor):
         self._path_earth_mis = self._root_dir / "Data" / "earth.mis"
         self._path_ss2_exe = self._root_dir / "ss2.exe"
 
-        self._run_state = RunState.STOPPED
-
-        super().__init__(
-            event_sources=[
+        if event_sources is None:
+            event_sources = [
                 INotifyEventSource(fpaths=[
                     # Start, stop, split
                     self._root_dir / "Data",
@@ -60,12 +72,24 @@ class SystemShock2Reactor(Reactor):
 
                     # Crash monitoring
                     self._root_dir / "ss2.exe",
-                ]),
-            ],
+                ], ignore_names=IGNORED_FILE_NAMES),
+            ]
+        if time_bases is None:
             time_bases = [
                 MonotonicFloatSeconds(),
-            ],
+                LoadRemovedTimeBase(),
+            ]
+
+        super().__init__(
+            event_sources=event_sources,
+            time_bases=time_bases,
+            db=db,
         )
+        self.set_rules(self._make_rules(), initial_state=RunState.STOPPED)
+
+    @classmethod
+    def create_for_game(cls, *, game_root_dir: Path, game_user_dir: Path, **kwargs: Any) -> "SystemShock2Reactor":
+        return cls(root_dir=game_root_dir, **kwargs)
 
     @classmethod
     def get_game_title(cls) -> str:
@@ -76,63 +100,59 @@ class SystemShock2Reactor(Reactor):
         return "system_shock_2"
 
     def on_event(self, ts: List[float], ev: Event) -> None:
-        time_str = self.convert_times_to_str(ts)
-
-        if isinstance(ev, OpenFileEvent):
-            if ev.fpath == self._path_cs1_avi:
-                # Open cs1.avi: Opening cutscene. We're about to start a run.
-                self.cancel_run()
-                self._run_state = RunState.STOPPED_AWAITING_EARTH_MIS
-                LOG.info(f"{time_str} Watching cs1.avi, previous run has been cancelled")
-
-            elif ev.fpath == self._path_cs3_avi:
-                # Open cs3.avi: Ending cutscene. Run is (probably) finished.
-                self.finish_run()
-                self._run_state = RunState.FINISHED
-                LOG.info(f"{time_str} Watching cs3.avi, run is over!")
-
-            elif ev.fpath.name.lower().endswith(".avi"):
-                # Some cutscene.
-                #LOG.info(f"{time_str} TODO: Cutscene open {ev}")
-                self.do_fuse_split(ts, f"cutscene:{ev.fpath.name.lower()}")
-
-            elif ev.fpath == self._path_earth_mis:
-                # earth.mis is special.
-                LOG.info(f"{time_str} Loading earth.mis... run starts when it gets closed")
-
-            elif ev.fpath.name.lower().endswith(".mis"):
-                # Some mission.
-                #LOG.info(f"{time_str} Splitting on {ev.fpath.name.lower()}")
-                self.do_fuse_split(ts, f"mission:{ev.fpath.name.lower()}")
-                self.start_loading(ts)
-
-            elif ev.fpath.name.lower() in ["shock2.gam", "allobjs.osm", "motiondb.bin"]:
-                # Some files we don't care about.
-                pass
-
-            else:
-                LOG.info(f"{time_str} TODO: {ev}")
-
-        elif isinstance(ev, CloseFileEvent):
-            if ev.fpath == self._path_earth_mis:
-                # Close earth.mis: If we're waiting for this, then start the run!
-                if self._run_state == RunState.STOPPED_AWAITING_EARTH_MIS:
-                    self._run_state = RunState.RUNNING
-                    self.start_run()
-
-            elif ev.fpath.name.lower().endswith(".mis"):
-                # Some mission.
-                #LOG.info(f"{time_str} TODO: Mission close {ev} (for load removal)")
-                self.stop_loading(ts)
-
-            elif ev.fpath.name.lower().endswith(".avi"):
-                # Some cutscene.
-                # We really don't care when these close.
-                pass
-
-            elif ev.fpath.name.lower() in ["shock2.gam", "allobjs.osm", "motiondb.bin"]:
-                # Some files we don't care about.
-                pass
-
-            else:
-                LOG.info(f"{time_str} TODO: {ev}")
+        if not self.apply_rules(ts, ev):
+            if LOG.isEnabledFor(logging.INFO):
+                LOG.info(f"{self.convert_times_to_str(ts)} TODO: {ev}")
+
+    def on_record(self, ts: List[float], ring: EventRing, idx: int) -> None:
+        if not self.apply_record_rules(ts, ring, idx):
+            if LOG.isEnabledFor(logging.INFO):
+                LOG.info(f"{self.convert_times_to_str(ts)} TODO: {ring.get_event(idx)}")
+
+    def _make_rules(self) -> List[SplitRule]:
+        """Makes the split rules for this game."""
+        rules = [
+            # Open cs1.avi: Opening cutscene. We're about to start a run.
+            SplitRule(OpenFileEvent, path=self._path_cs1_avi,
+                actions=[RuleAction.CANCEL],
+                next_state=RunState.STOPPED_AWAITING_EARTH_MIS,
+                message="Watching cs1.avi, previous run has been cancelled"),
+            # Open cs3.avi: Ending cutscene. Run is (probably) finished.
+            SplitRule(OpenFileEvent, path=self._path_cs3_avi,
+                actions=[RuleAction.FINISH],
+                next_state=RunState.FINISHED,
+                message="Watching cs3.avi, run is over!"),
+            # earth.mis is special.
+            SplitRule(OpenFileEvent, path=self._path_earth_mis,
+                message="Loading earth.mis... run starts when it gets closed"),
+            # Some cutscene.
+            SplitRule(OpenFileEvent, suffix=".avi",
+                actions=[RuleAction.SPLIT],
+                split_prefix="cutscene"),
+            # Some mission.
+            SplitRule(OpenFileEvent, suffix=".mis",
+                actions=[RuleAction.SPLIT, RuleAction.START_LOADING],
+                split_prefix="mission"),
+
+            # Close earth.mis: If we're waiting for this, then start the run!
+            SplitRule(CloseFileEvent, path=self._path_earth_mis,
+                states=[RunState.STOPPED_AWAITING_EARTH_MIS],
+                actions=[RuleAction.START],
+                next_state=RunState.RUNNING),
+            # Otherwise it's not the end of a load, so don't fall through to the .mis rule
+            SplitRule(CloseFileEvent, path=self._path_earth_mis),
+            # Some mission.
+            SplitRule(CloseFileEvent, suffix=".mis",
+                actions=[RuleAction.STOP_LOADING]),
+            # Some cutscene.
+            # We really don't care when these close.
+            SplitRule(CloseFileEvent, suffix=".avi"),
+        ]
+
+        # Some files we don't care about.
+        # The inotify source drops these already, but a replay might still have them.
+        for name in IGNORED_FILE_NAMES:
+            rules.append(SplitRule(OpenFileEvent, name=name))
+            rules.append(SplitRule(CloseFileEvent, name=name))
+
+        return rules
@@ -2,38 +2,65 @@ import logging
 import math
 from pathlib import Path
 import sys
+import time
+from typing import Callable
 from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
 
 import tkinter
 import tkinter.font # type: ignore
 import tkinter.ttk
 
-from goodsplit.db import DB
-from goodsplit.games import REACTOR_CONSTRUCTORS
-from goodsplit.reactor import Reactor
+from goodsplit.games import get_game
+from goodsplit.metrics import METRICS
+from goodsplit.metrics import STAGE_DISPLAY
+from goodsplit.tracing import NULL_SPAN
+from goodsplit.tracing import TRACER
+
+if TYPE_CHECKING:
+    import asyncio
+    from goodsplit.db import DB
+    from goodsplit.reactor import Reactor
 
 LOG = logging.getLogger("tk_game")
+TRACE = TRACER.get_channel("tk_game")
+
+# How often to refresh the display when the timer isn't running
+REFRESH_INTERVAL_IDLE_MS = 250
+# Never repaint faster than a typical monitor can show it, unless told otherwise
+DEFAULT_MAX_REFRESH_RATE_HZ = 60.0
+# How often to poll reactors which have sources we can't wait on
+POLL_INTERVAL_MS = 5
 
 
 class TkGameWindow(tkinter.Toplevel):
     """A game window."""
-    def __init__(self, *, game_key: str, game_root_dir: str, game_user_dir: str) -> None:
+    def __init__(self, *, game_key: str, game_root_dir: str, game_user_dir: str, db: "Optional[DB]" = None, loop: "Optional[asyncio.AbstractEventLoop]" = None, request_pump: Optional[Callable[[], None]] = None, max_refresh_rate_hz: float = DEFAULT_MAX_REFRESH_RATE_HZ) -> None:
         super().__init__()
+        self._loop = loop
+        # Called after refreshing from the loop, so Tk gets to redraw
+        self._request_pump = request_pump
+        self._min_refresh_interval = 1.0/max_refresh_rate_hz
         self.configure(background="#000000")
         self._is_dead = False
         self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.bind("<Key-F8>", self.on_dump_metrics)
         self._game_key = game_key
         self._game_root_dir = Path(game_root_dir)
         self._game_user_dir = Path(game_user_dir)
         LOG.info(f"Creating game reactor")
-        self._reactor: Reactor = REACTOR_CONSTRUCTORS[game_key](
+        self._reactor: "Reactor" = get_game(game_key).create_reactor(
             self._game_root_dir,
             self._game_user_dir,
+            db=db,
         )
         self.title(f"GS: {self._reactor.get_game_title()}")
         self._init_fonts()
         self._init_widgets()
-        self.after_idle(self.on_tick) # type: ignore
+        self._init_wakeups(loop=loop)
+        self.after_idle(self.on_refresh_tick) # type: ignore
 
     def is_dead(self) -> bool:
         """Is this window dead?"""
@@ -43,6 +70,36 @@ class TkGameWindow(tkinter.Toplevel):
         """Initialises all the fonts used."""
         pass
 
+    def _init_wakeups(self, *, loop: "Optional[asyncio.AbstractEventLoop]") -> None:
+        """Arranges for the reactor to be woken up by its event sources."""
+        self._wait_fds: List[int] = []
+        self._reactor_task: "Optional[asyncio.Future[None]]" = None
+        self._is_polling = False
+
+        if loop is not None:
+            # The asyncio loop wakes the reactor up for us
+            import asyncio
+            self._reactor_task = asyncio.ensure_future(
+                self._reactor.run_async(on_update=self.request_refresh),
+                loop=loop,
+            )
+            return
+
+        self._is_polling = self._reactor.needs_polling()
+        for fd in self._reactor.get_wait_fds():
+            try:
+                self.tk.createfilehandler(fd, tkinter.READABLE, self.on_source_readable) # type: ignore
+            except AttributeError:
+                # This Tk doesn't do file handlers, so fall back to polling
+                LOG.warning(f"Cannot wait on event sources, polling instead")
+                self._is_polling = True
+                break
+            else:
+                self._wait_fds.append(fd)
+
+        if self._is_polling:
+            self.after_idle(self.on_poll_tick) # type: ignore
+
     def _init_widgets(self) -> None:
         """Initialises all the widgets in this window."""
         self.grid()
@@ -72,6 +129,7 @@ class TkGameWindow(tkinter.Toplevel):
         row += 1
         self._split_labels_name: List[tkinter.ttk.Label] = []
         self._split_labels_time: List[tkinter.ttk.Label] = []
+        self._split_labels_delta: List[tkinter.ttk.Label] = []
         self._splits_frame.columnconfigure(index=0, weight=1)
         for i in range(self._split_row_count):
             self._split_labels_name.append(
@@ -88,9 +146,19 @@ class TkGameWindow(tkinter.Toplevel):
                     text=f"--:--.-",
                 )
             )
+            self._split_labels_delta.append(
+                tkinter.ttk.Label(
+                    self._splits_frame,
+                    font="TkFixedFont",
+                    text=f"",
+                    width=9,
+                    anchor=tkinter.E,
+                )
+            )
             self._splits_frame.rowconfigure(index=i, weight=1)
             self._split_labels_name[-1].grid(row=i, column=0, sticky=tkinter.W)
-            self._split_labels_time[-1].grid(row=i, column=1, sticky=tkinter.E)
+            self._split_labels_delta[-1].grid(row=i, column=1, sticky=tkinter.E)
+            self._split_labels_time[-1].grid(row=i, column=2, sticky=tkinter.E)
 
         # Stats
         self._stats_frame = tkinter.ttk.Frame(
@@ -117,61 +185,195 @@ class TkGameWindow(tkinter.Toplevel):
         self._stats_frame.rowconfigure(index=statrow, weight=1)
         statrow += 1
 
+        # What's currently on screen, so we only touch labels which change
+        self._split_row_texts: List[Tuple[str, str, str]] = [
+            ("-", "--:--.-", "",)
+            for i in range(self._split_row_count)
+        ]
+        self._rendered_split_version = -1
+        self._rendered_clock_tenths: Optional[int] = None
+        self._rendered_split_origin_time: Optional[float] = None
+        self._last_refresh_time = 0.0
+        self._is_refresh_pending = False
+
     def on_close(self) -> None:
         LOG.info(f"Closing window for {self._game_key}")
         self._is_dead = True
+        for fd in self._wait_fds:
+            self.tk.deletefilehandler(fd) # type: ignore
+        self._wait_fds = []
+        if self._reactor_task is not None:
+            self._reactor_task.cancel()
+            self._reactor_task = None
         try:
             self._reactor.cancel_run()
         except Exception as e:
             LOG.exception(e)
             # Otherwise let it through
+        try:
+            self._reactor.close()
+        except Exception as e:
+            LOG.exception(e)
         self.destroy() # type: ignore
 
-    def on_tick(self) -> None:
-        """Main update."""
+    def on_dump_metrics(self, ev: tkinter.Event) -> None:
+        """Dumps the latency metrics to the log and the metrics file if we're recording them, and the trace if we're tracing."""
+        if METRICS.enabled:
+            LOG.info(f"Latency metrics:\n{METRICS.format_report()}")
+        else:
+            LOG.info("Latency metrics are off, pass --metrics to record them")
+        try:
+            if METRICS.enabled:
+                METRICS.write_report()
+            if TRACER.is_enabled():
+                TRACER.write_dump()
+        except OSError as e:
+            LOG.exception(e)
+
+    def on_source_readable(self, fd: int, mask: int) -> None:
+        """Called by Tk when one of the reactor's event sources has something for us."""
+        if not self._is_dead:
+            self.update_reactor()
+
+    def on_poll_tick(self) -> None:
+        """Polls the reactor for sources which can't be waited on."""
+        if self._is_dead:
+            return
+        self.update_reactor()
+        self.after(POLL_INTERVAL_MS, self.on_poll_tick)
 
-        # Run update
+    def on_refresh_tick(self) -> None:
+        """Display refresh timer."""
+        if self._is_dead:
+            return
+
+        self.refresh_display()
+
+        # Work out when the displayed time will next change
+        if self._reactor.is_time_invalid():
+            delay_ms = REFRESH_INTERVAL_IDLE_MS
+        else:
+            time_secs = self._reactor.fetch_time_now()[0]
+            next_change_secs = (math.floor(time_secs*10)+1)/10
+            delay_ms = max(1, int(math.ceil((next_change_secs - time_secs)*1000)))
+        self._call_later(delay_ms, self.on_refresh_tick)
+
+    def update_reactor(self) -> None:
+        """Lets the reactor process whatever events are waiting."""
         try:
-            # Update reactor
-            self._reactor.update()
-
-            ordered_fuses = self._reactor.get_ordered_fuse_splits()
-            for i, (ts, split_id,) in enumerate(ordered_fuses[-10:]):
-                self._split_labels_name[i].configure(text=split_id.split(":")[-1])
-                time_secs = ts[0]
-                subsecs = int(math.floor(time_secs*10))
-                subs = subsecs % 10
-                secs = (subsecs // 10) % 60
-                mins = ((subsecs // 10) // 60) % 60
-                hours = ((subsecs // 10) // 60) // 60
-                if hours != 0:
-                    time_str = f"{hours:d}:{mins:02d}:{secs:02d}.{subs:01d}"
-                else:
-                    time_str = f"{mins:02d}:{secs:02d}.{subs:01d}"
-                self._split_labels_time[i].configure(text=time_str)
+            with (TRACE.span("update_reactor") if TRACE.enabled else NULL_SPAN):
+                self._reactor.update()
+        except Exception as e:
+            LOG.exception(e)
+        self.request_refresh()
+
+    def request_refresh(self) -> None:
+        """Asks for the display to be refreshed, but no more often than it can be shown."""
+        if self._is_dead or self._is_refresh_pending:
+            return
+
+        wait_secs = (self._last_refresh_time + self._min_refresh_interval) - time.monotonic()
+        if wait_secs <= 0.0:
+            self.refresh_display()
+        else:
+            self._is_refresh_pending = True
+            self._call_later(max(1, int(math.ceil(wait_secs*1000))), self.on_deferred_refresh)
+
+    def _call_later(self, delay_ms: int, callback: Callable[[], None]) -> None:
+        """
+        Calls something after a delay, on the asyncio loop if we're on one.
+
+        Tk's own timers only get run when Tk is pumped, which on a loop
+        isn't often enough for the clock.
+        """
+        if self._loop is not None:
+            self._loop.call_later(delay_ms/1000, callback)
+        else:
+            self.after(delay_ms, callback)
+
+    def on_deferred_refresh(self) -> None:
+        """Handles a refresh which was held back by the rate cap."""
+        self._is_refresh_pending = False
+        if not self._is_dead:
+            self.refresh_display()
 
-            for i in range(len(ordered_fuses)+1, self._split_row_count, 1):
-                self._split_labels_time[i].configure(text="--:--.-")
+    def refresh_display(self) -> None:
+        """Updates whichever labels have changed since the last refresh."""
+        try:
+            self._last_refresh_time = time.monotonic()
+
+            # Split rows only change when the reactor says they have
+            split_version = self._reactor.get_fuse_split_version()
+            if split_version != self._rendered_split_version:
+                self._rendered_split_version = split_version
+                self._refresh_split_rows()
+
+                # Measure each split once, from its event to it being on screen
+                origin_time = self._reactor.get_last_split_origin_time()
+                if origin_time is not None and origin_time != self._rendered_split_origin_time and METRICS.enabled:
+                    self._rendered_split_origin_time = origin_time
+                    METRICS.record_since(STAGE_DISPLAY, origin_time)
 
-            ts = self._reactor.fetch_time_now()
+            # Only reformat the clock when the tenths digit changes
+            clock_tenths: Optional[int]
             if self._reactor.is_time_invalid():
-                self._stat_time_value_label.configure(text="--:--:--.-")
+                clock_tenths = None
             else:
-                time_secs = ts[0]
-                subsecs = int(math.floor(time_secs*10))
-                subs = subsecs % 10
-                secs = (subsecs // 10) % 60
-                mins = ((subsecs // 10) // 60) % 60
-                hours = ((subsecs // 10) // 60) // 60
-                time_str = f"{hours:02d}:{mins:02d}:{secs:02d}.{subs:01d}"
-                self._stat_time_value_label.configure(text=time_str)
+                clock_tenths = int(math.floor(self._reactor.fetch_time_now()[0]*10))
+            if clock_tenths != self._rendered_clock_tenths:
+                self._rendered_clock_tenths = clock_tenths
+                if clock_tenths is None:
+                    self._stat_time_value_label.configure(text="--:--:--.-")
+                else:
+                    self._stat_time_value_label.configure(text=self.format_tenths(clock_tenths, pad_hours=True))
 
         except Exception as e:
             LOG.exception(e)
-            if not self._is_dead:
-                # Call us after 500 msec because we screwed up
-                self.after(500, self.on_tick)
+
+        if self._request_pump is not None:
+            self._request_pump()
+
+    def _refresh_split_rows(self) -> None:
+        """Updates the split rows whose text has changed."""
+        last_fuses = self._reactor.get_last_fuse_splits(self._split_row_count)
+        last_comparisons = self._reactor.get_last_split_comparisons(self._split_row_count)
+        for i in range(self._split_row_count):
+            if i < len(last_fuses):
+                ts, split_id = last_fuses[i]
+                name_str = split_id.split(":")[-1]
+                time_str = self.format_tenths(int(math.floor(ts[0]*10)), pad_hours=False)
+                delta_str = self.format_delta(last_comparisons[i].pb_deltas[0])
+            else:
+                name_str = "-"
+                time_str = "--:--.-"
+                delta_str = ""
+
+            old_name_str, old_time_str, old_delta_str = self._split_row_texts[i]
+            if name_str != old_name_str:
+                self._split_labels_name[i].configure(text=name_str)
+            if time_str != old_time_str:
+                self._split_labels_time[i].configure(text=time_str)
+            if delta_str != old_delta_str:
+                self._split_labels_delta[i].configure(text=delta_str)
+            self._split_row_texts[i] = (name_str, time_str, delta_str,)
+
+    def format_delta(self, delta_microseconds: Optional[int]) -> str:
+        """Formats a delta against the personal best, or nothing if there isn't one."""
+        if delta_microseconds is None:
+            return ""
+        sign = ("-" if delta_microseconds < 0 else "+")
+        subsecs = abs(delta_microseconds) // 100000
+        return sign + self.format_tenths(subsecs, pad_hours=False)
+
+    def format_tenths(self, subsecs: int, *, pad_hours: bool) -> str:
+        """Formats a time given in tenths of a second."""
+        subs = subsecs % 10
+        secs = (subsecs // 10) % 60
+        mins = ((subsecs // 10) // 60) % 60
+        hours = ((subsecs // 10) // 60) // 60
+        if pad_hours:
+            return f"{hours:02d}:{mins:02d}:{secs:02d}.{subs:01d}"
+        elif hours != 0:
+            return f"{hours:d}:{mins:02d}:{secs:02d}.{subs:01d}"
         else:
-            if not self._is_dead:
-                # Call us after 1 msec
-                self.after(1, self.on_tick)
+            return f"{mins:02d}:{secs:02d}.{subs:01d}"
@@ -1,10 +1,14 @@
+import json
 import logging
 from pathlib import Path
 import sys
 from typing import Any
 from typing import List
+from typing import Optional
 from typing import Sequence
 from typing import Set
+from typing import Tuple
+from typing import TYPE_CHECKING
 
 import tkinter
 import tkinter.filedialog
@@ -12,32 +16,140 @@ import tkinter.font # type: ignore
 import tkinter.messagebox
 import tkinter.ttk
 
-from goodsplit.db import DB
-from goodsplit.games import REACTOR_CONSTRUCTORS
-from goodsplit.games import REACTORS
-from goodsplit.reactor import Reactor
+from goodsplit.games import get_games
+from goodsplit.games import get_supported_games
 
+from .game import DEFAULT_MAX_REFRESH_RATE_HZ
 from .game import TkGameWindow
 
+if TYPE_CHECKING:
+    import asyncio
+    from goodsplit.db import DB
+
 LOG = logging.getLogger("tk_root")
 
+# Where the font families we picked are remembered between runs
+FONT_CACHE_PATH = Path("~/goodsplit-fonts.json")
+
+# How often to pump Tk on an asyncio event loop when we can't wait on its display
+ASYNC_PUMP_INTERVAL = 1.0/60.0
+# How often to run Tk's own timers, such as the cursor blinking, when we can
+ASYNC_TIMER_PUMP_INTERVAL = 0.1
+
 
 class TkGuiRoot(tkinter.Tk):
     """The Tk application root."""
-    def __init__(self, *, args: Sequence[str]) -> None:
+    def __init__(self, *, args: Sequence[str], max_refresh_rate_hz: float = DEFAULT_MAX_REFRESH_RATE_HZ) -> None:
         super().__init__()
+        self._max_refresh_rate_hz = max_refresh_rate_hz
         self.title("Game Setup - Goodsplit")
         self.configure(background="#000000")
-        self._db = DB()
+        # Opened when it's first needed, so the window comes up without waiting on it
+        self._db: "Optional[DB]" = None
         self._init_styles()
         self._init_fonts()
         self._init_widgets()
         self._active_windows: List[tkinter.Toplevel] = []
+        self._loop: "Optional[asyncio.AbstractEventLoop]" = None
+        self._is_gone: "Optional[asyncio.Future[None]]" = None
+        self._is_pump_pending = False
 
     def run(self) -> None:
         """Runs the main loop."""
         self.mainloop()
 
+    async def run_async(self) -> None:
+        """
+        Runs the GUI as a task on the current asyncio event loop.
+
+        Reactors run as their own tasks on the same loop. On X11, Tk gets
+        pumped when its display connection has something to read, or when
+        a window asks for it with request_pump(), and otherwise only often
+        enough for Tk's own timers. Anywhere else it gets pumped at the
+        display rate.
+        """
+        import asyncio
+        self._loop = loop = asyncio.get_event_loop()
+        self._is_gone = loop.create_future()
+
+        display_fd = self._find_display_fd()
+        if display_fd is not None:
+            LOG.debug(f"Waiting on the Tk display connection, fd {display_fd}")
+            loop.add_reader(display_fd, self._pump)
+            interval = ASYNC_TIMER_PUMP_INTERVAL
+        else:
+            interval = ASYNC_PUMP_INTERVAL
+        try:
+            self._pump()
+            while not self._is_gone.done():
+                await asyncio.wait([self._is_gone], timeout=interval)
+                self._pump()
+        finally:
+            if display_fd is not None:
+                loop.remove_reader(display_fd)
+        LOG.info("Tk root has gone away")
+
+    def request_pump(self) -> None:
+        """
+        Has Tk pumped soon, after something changed a widget from the loop.
+
+        Redraws are Tk idle tasks, and Xlib may have read events into its
+        own queue meanwhile, which the display fd won't tell us about.
+        """
+        if self._loop is not None and not self._is_pump_pending:
+            self._is_pump_pending = True
+            self._loop.call_soon(self._pump)
+
+    def _pump(self) -> None:
+        """Handles every Tk event, timer and idle task waiting, without blocking."""
+        self._is_pump_pending = False
+        if self._is_gone is None or self._is_gone.done():
+            return
+        try:
+            while self.tk.dooneevent(tkinter._tkinter.DONT_WAIT): # type: ignore
+                pass
+            # dooneevent() doesn't say when the root has been destroyed
+            is_gone = not self.winfo_exists()
+        except tkinter.TclError:
+            is_gone = True
+        if is_gone:
+            self._is_gone.set_result(None)
+
+    def _find_display_fd(self) -> Optional[int]:
+        """
+        Finds the fd of the X server connection Tk reads events from.
+
+        Tk doesn't give this to Python, so it's dug out with ctypes: a
+        Tk_Window starts with its Display, as in Tk_FakeWin. Returns None
+        if Tk isn't on X11, or any of that fails.
+        """
+        if str(self.tk.call("tk", "windowingsystem")) != "x11":
+            return None
+        try:
+            import ctypes
+            import ctypes.util
+            # Symbols from libtk can be found through _tkinter, which links it
+            libtk = ctypes.CDLL(tkinter._tkinter.__file__) # type: ignore
+            libtk.Tk_MainWindow.argtypes = [ctypes.c_void_p]
+            libtk.Tk_MainWindow.restype = ctypes.c_void_p
+            libx11_name = ctypes.util.find_library("X11")
+            if libx11_name is None:
+                return None
+            libx11 = ctypes.CDLL(libx11_name)
+            libx11.XConnectionNumber.argtypes = [ctypes.c_void_p]
+            libx11.XConnectionNumber.restype = ctypes.c_int
+            tk_window = libtk.Tk_MainWindow(self.tk.interpaddr())
+            if not tk_window:
+                return None
+            display = ctypes.c_void_p.from_address(tk_window).value
+            if not display:
+                return None
+            fd: int = libx11.XConnectionNumber(display)
+        except (OSError, AttributeError) as e:
+            LOG.warning(f"Cannot find the Tk display connection, pumping Tk instead: {e}")
+            return None
+        return (fd if fd >= 0 else None)
+
     def _init_styles(self) -> None:
         """Initialises all the styles used."""
         # TODO: Toplevel, and button mouseover colours
@@ -77,24 +189,7 @@ class TkGuiRoot(tkinter.Tk):
 
     def _init_fonts(self) -> None:
         """Initialises all the fonts used."""
-        families_set: Set[str]
-        families_set = set(tkinter.font.families())
-        families_set_lower = set(f.lower() for f in families_set)
-        sans_family=(list(filter(lambda f: f in families_set, [
-            "DejaVu Sans",
-            "Bitstream Vera Sans",
-            "Verdana", # Gee, guess where they got the name of that font from
-            "Helvetica",
-            "",
-        ])))[0]
-        mono_family=(list(filter(lambda f: f.lower() in families_set_lower, [
-            "DejaVu Sans Mono",
-            "Bitstream Vera Sans Mono",
-            "Lucida Console",
-            "Courier New",
-            "Courier",
-            "",
-        ])))[0]
+        sans_family, mono_family = self._resolve_font_families()
 
         self.font_size = 12
 
@@ -119,6 +214,60 @@ class TkGuiRoot(tkinter.Tk):
             #weight=tkinter.font.BOLD,
         )
 
+    def _resolve_font_families(self) -> Tuple[str, str]:
+        """
+        Picks the (sans, mono,) font families to use.
+
+        Listing every font on the system is slow, so what we picked last
+        time is remembered, and only gets picked again if it has gone away.
+        """
+        try:
+            with open(FONT_CACHE_PATH.expanduser(), "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            sans_family = str(cached["sans"])
+            mono_family = str(cached["mono"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        else:
+            if self._has_font_family(sans_family) and self._has_font_family(mono_family):
+                return (sans_family, mono_family,)
+
+        families_set: Set[str]
+        families_set = set(tkinter.font.families())
+        families_set_lower = set(f.lower() for f in families_set)
+        sans_family=(list(filter(lambda f: f in families_set, [
+            "DejaVu Sans",
+            "Bitstream Vera Sans",
+            "Verdana", # Gee, guess where they got the name of that font from
+            "Helvetica",
+            "",
+        ])))[0]
+        mono_family=(list(filter(lambda f: f.lower() in families_set_lower, [
+            "DejaVu Sans Mono",
+            "Bitstream Vera Sans Mono",
+            "Lucida Console",
+            "Courier New",
+            "Courier",
+            "",
+        ])))[0]
+
+        try:
+            with open(FONT_CACHE_PATH.expanduser(), "w", encoding="utf-8") as f:
+                json.dump({"sans": sans_family, "mono": mono_family}, f)
+        except OSError as e:
+            LOG.warning(f"Could not write font cache {FONT_CACHE_PATH}: {e}")
+
+        return (sans_family, mono_family,)
+
+    def _has_font_family(self, family: str) -> bool:
+        """Does Tk give us this font family when we ask for it, rather than a stand-in?"""
+        if not family:
+            # The fallback, which might not be needed any more
+            return False
+        actual_family: str
+        actual_family = tkinter.font.Font(root=self, family=family).actual("family") # type: ignore
+        return actual_family.lower() == family.lower()
+
     def _init_widgets(self) -> None:
         """Initialises all the widgets in the root window."""
         self.grid()
@@ -130,11 +279,12 @@ class TkGuiRoot(tkinter.Tk):
 
         # Game Select
         self._game_sel_var = tkinter.StringVar()
+        # Only the manifests get read here, no game gets imported until it's opened
         self._game_sel_options = [
-            g.get_game_key()
-            for g in sorted(
-                list(REACTORS.values()),
-                key=(lambda g: g.get_game_title().lower()),
+            info.key
+            for info in sorted(
+                list(get_supported_games().values()),
+                key=(lambda info: info.title.lower()),
             )
         ]
         self._game_sel_label = tkinter.ttk.Label(
@@ -209,8 +359,16 @@ class TkGuiRoot(tkinter.Tk):
 
     def init_db(self) -> None:
         """Initialises the database handle."""
+        from goodsplit.db import DB
         self._db = DB()
 
+    def get_db(self) -> "DB":
+        """Gets the database handle shared by every window, opening it if necessary."""
+        if self._db is None:
+            self.init_db()
+            assert self._db is not None
+        return self._db
+
     def on_go_button(self) -> None:
         """Handler for the go button."""
         game_key: str
@@ -220,7 +378,7 @@ class TkGuiRoot(tkinter.Tk):
         game_user_dir: str
         game_user_dir = self._game_user_dir_var.get() # type: ignore
 
-        if game_key not in REACTOR_CONSTRUCTORS:
+        if game_key not in get_supported_games():
             tkinter.messagebox.showerror(
                 title="Error - Goodsplit",
                 message=f"Please select a valid game.\nThe game key {game_key!r} is not valid or not supported.",
@@ -230,6 +388,10 @@ class TkGuiRoot(tkinter.Tk):
                 game_key=game_key,
                 game_root_dir=game_root_dir,
                 game_user_dir=game_user_dir,
+                db=self.get_db(),
+                loop=self._loop,
+                request_pump=(self.request_pump if self._loop is not None else None),
+                max_refresh_rate_hz=self._max_refresh_rate_hz,
             )
             self._active_windows.append(window)
 
@@ -237,18 +399,13 @@ class TkGuiRoot(tkinter.Tk):
         """Handler for selecting the game."""
         game_key: str
         game_key = self._game_sel_var.get() # type: ignore
-        game_root_dir = self._db.get_game_root_dir(
-            game_id=self._db.ensure_game_id(
-                game_key=game_key,
-                game_title=REACTORS[game_key].get_game_title(),
-            ),
-        )
-        game_user_dir = self._db.get_game_user_dir(
-            game_id=self._db.ensure_game_id(
-                game_key=game_key,
-                game_title=REACTORS[game_key].get_game_title(),
-            ),
+        db = self.get_db()
+        game_id = db.ensure_game_id(
+            game_key=game_key,
+            game_title=get_games()[game_key].title,
         )
+        game_root_dir = db.get_game_root_dir(game_id=game_id)
+        game_user_dir = db.get_game_user_dir(game_id=game_id)
         self._game_root_dir_var.set(game_root_dir) # type: ignore
         self._game_user_dir_var.set(game_user_dir) # type: ignore
         self._game_root_dir_entry.icursor(tkinter.END) # type: ignore
@@ -293,11 +450,12 @@ class TkGuiRoot(tkinter.Tk):
         result = self._game_root_dir_var.get() # type: ignore
         game_key: str
         game_key = self._game_sel_var.get() # type: ignore
-        if game_key in REACTORS:
-            self._db.set_game_root_dir(
-                game_id=self._db.ensure_game_id(
+        if game_key in get_games():
+            db = self.get_db()
+            db.set_game_root_dir(
+                game_id=db.ensure_game_id(
                     game_key=game_key,
-                    game_title=REACTORS[game_key].get_game_title(),
+                    game_title=get_games()[game_key].title,
                 ),
                 game_root_dir=result,
             )
@@ -316,11 +474,12 @@ class TkGuiRoot(tkinter.Tk):
         result = self._game_user_dir_var.get() # type: ignore
         game_key: str
         game_key = self._game_sel_var.get() # type: ignore
-        if game_key in REACTORS:
-            self._db.set_game_user_dir(
-                game_id=self._db.ensure_game_id(
+        if game_key in get_games():
+            db = self.get_db()
+            db.set_game_user_dir(
+                game_id=db.ensure_game_id(
                     game_key=game_key,
-                    game_title=REACTORS[game_key].get_game_title(),
+                    game_title=get_games()[game_key].title,
                 ),
                 game_user_dir=result,
             )
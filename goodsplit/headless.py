@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import signal
+import sys
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import TextIO
+
+from .metrics import METRICS
+from .reactor import Reactor
+from .sources.replay import ReplayEventSource
+from .sources.replay import run_replay
+from .time_base import VirtualFloatSeconds
+from .tracing import TRACER
+
+LOG = logging.getLogger("headless")
+
+
+class SplitLogger:
+    """Writes a reactor's splits out as JSON lines as they happen."""
+    __slots__ = (
+        "_out",
+    )
+
+    def __init__(self, *, out: TextIO) -> None:
+        self._out = out
+
+    def on_split(self, ts: List[float], split_id: str) -> None:
+        """Logs a split."""
+        self.write_record({
+            "event": "split",
+            "split": split_id,
+            "times": ts,
+        })
+
+    def write_record(self, record: Dict[str, Any]) -> None:
+        """Writes a single record as one line."""
+        self._out.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._out.flush()
+
+
+def on_dump_metrics() -> None:
+    """Dumps the latency metrics to the metrics file if we're recording them, and the trace if we're tracing."""
+    try:
+        if METRICS.enabled:
+            METRICS.write_report()
+        if TRACER.is_enabled():
+            TRACER.write_dump()
+    except OSError as e:
+        LOG.exception(e)
+
+
+async def run_headless_async(reactor: Reactor, *, out: TextIO) -> None:
+    """Runs a reactor until we get SIGTERM or SIGINT."""
+    loop = asyncio.get_event_loop()
+    stop_event = asyncio.Event()
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        loop.add_signal_handler(signum, stop_event.set)
+    loop.add_signal_handler(signal.SIGUSR1, on_dump_metrics)
+
+    split_logger = SplitLogger(out=out)
+    reactor.add_split_listener(split_logger.on_split)
+    reactor_task = asyncio.ensure_future(reactor.run_async())
+    try:
+        # Either we get told to stop, or the reactor dies on us
+        stop_task = asyncio.ensure_future(stop_event.wait())
+        await asyncio.wait(
+            [stop_task, reactor_task],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        stop_task.cancel()
+    finally:
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGUSR1]:
+            loop.remove_signal_handler(signum)
+        reactor_task.cancel()
+        try:
+            await reactor_task
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            LOG.exception(e)
+
+        LOG.info("Stopping")
+        reactor.cancel_run()
+
+
+def run_headless(reactor: Reactor, *, out: TextIO = sys.stdout) -> None:
+    """Runs a reactor without a GUI, then flushes everything to the database."""
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(run_headless_async(reactor, out=out))
+    finally:
+        reactor.close()
+
+
+def replay_headless(reactor: Reactor, source: ReplayEventSource, clock: VirtualFloatSeconds, *, speed: Optional[float], out: TextIO = sys.stdout) -> None:
+    """Replays a recorded session through a reactor, then flushes everything to the database."""
+    split_logger = SplitLogger(out=out)
+    reactor.add_split_listener(split_logger.on_split)
+    try:
+        # So a replay compares against the same history every time
+        reactor.wait_for_history()
+        time_beg = time.perf_counter()
+        batch_count = run_replay(reactor, source, clock, speed=speed)
+        time_end = time.perf_counter()
+        LOG.info(f"Replayed {batch_count} batch(es) covering {clock.fetch_time_unzeroed():.3f} s in {time_end-time_beg:.3f} s")
+        reactor.cancel_run()
+    finally:
+        reactor.close()
@@ -0,0 +1,332 @@
+"""
+Importing and exporting run history.
+
+Exports stream straight from the database to the file, so memory use
+doesn't grow with the size of the history:
+
+- CSV: one row per time stamp.
+- JSON Lines: one object per run.
+
+Imports parse incrementally and go into the database in batches, each
+run in the same transaction as its splits:
+
+- JSON Lines, as written by the exporter.
+- LiveSplit .lss splits files. Every attempt becomes a run, and every
+  segment becomes a fuse split type keyed on its position and name.
+"""
+import csv
+import datetime
+import json
+import logging
+from pathlib import Path
+import re
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
+import xml.etree.ElementTree as ET
+
+from .db import DB
+from .time_base import MonotonicFloatSeconds
+
+LOG = logging.getLogger("history_io")
+
+CSV_HEADER = [
+    "run_id",
+    "run_start_datetime",
+    "is_finished",
+    "split_key",
+    "time_base_key",
+    "value_microseconds",
+]
+
+# How many runs to create per transaction
+RUN_BATCH_SIZE = 500
+# How many splits to write per transaction, unless a single run has more
+SPLIT_BATCH_SIZE = 20000
+
+# Split keys the reactor uses for the start and end of a run
+START_SPLIT_KEY = "$system:start"
+FINISH_SPLIT_KEY = "$system:finish"
+CANCEL_SPLIT_KEY = "$system:cancel"
+
+# Prefix for the split keys of imported LiveSplit segments, which go on with "{index}:{name}"
+LSS_SPLIT_KEY_PREFIX = "livesplit:"
+# Which LiveSplit timing methods go into which time bases by default
+LSS_TIME_BASE_KEYS = {
+    "RealTime": MonotonicFloatSeconds.get_time_base_key(),
+}
+
+# [d.]hh:mm:ss[.fffffff]
+_LSS_TIME_RE = re.compile(r"^(-)?(?:(\d+)\.)?(\d+):(\d+):(\d+)(?:\.(\d+))?$")
+
+
+def export_history_csv(db: DB, *, game_id: int, out: TextIO) -> int:
+    """Writes a game's history as CSV, one row per time stamp. Returns the number of rows written."""
+    writer = csv.writer(out)
+    writer.writerow(CSV_HEADER)
+    row_count = 0
+    for run_id, run_start_datetime, is_finished, split_key, time_base_key, value_microseconds in db.iter_history_export(game_id=game_id):
+        writer.writerow([
+            run_id,
+            run_start_datetime,
+            ("" if is_finished is None else int(is_finished)),
+            split_key,
+            time_base_key,
+            value_microseconds,
+        ])
+        row_count += 1
+    return row_count
+
+
+def export_history_jsonl(db: DB, *, game_id: int, out: TextIO) -> int:
+    """Writes a game's history as JSON Lines, one run per line. Returns the number of runs written."""
+    run_count = 0
+    record: Optional[Dict[str, Any]] = None
+    last_split_key: Optional[str] = None
+    for run_id, run_start_datetime, is_finished, split_key, time_base_key, value_microseconds in db.iter_history_export(game_id=game_id):
+        if record is None or record["run_id"] != run_id:
+            if record is not None:
+                out.write(json.dumps(record, separators=(",", ":")) + "\n")
+                run_count += 1
+            record = {
+                "run_id": run_id,
+                "run_start_datetime": run_start_datetime,
+                "is_finished": is_finished,
+                "splits": [],
+            }
+            last_split_key = None
+
+        if split_key != last_split_key:
+            record["splits"].append({"key": split_key, "times": {}})
+            last_split_key = split_key
+        record["splits"][-1]["times"][time_base_key] = value_microseconds
+
+    if record is not None:
+        out.write(json.dumps(record, separators=(",", ":")) + "\n")
+        run_count += 1
+    return run_count
+
+
+class HistoryImporter:
+    """
+    Buffers imported runs and writes them in batches.
+
+    Each run goes in the same transaction as its splits, so if a batch
+    fails, none of its runs look like they were already imported.
+    Split keys and time base keys are turned into IDs as they turn up,
+    creating them if necessary.
+    """
+    __slots__ = (
+        "_db",
+        "_game_id",
+        "_pending_runs",
+        "_pending_split_count",
+        "_run_count",
+        "_skipped_run_count",
+        "_split_count",
+    )
+
+    def __init__(self, db: DB, *, game_id: int) -> None:
+        self._db = db
+        self._game_id = game_id
+        self._pending_runs: List[Tuple[str, List[Tuple[int, List[Tuple[int, int]]]]]] = []
+        self._pending_split_count = 0
+        self._run_count = 0
+        self._skipped_run_count = 0
+        self._split_count = 0
+
+        # Same trade-off as during a run: batches don't wait on the disk, and the final commit syncs
+        self._db.set_run_in_progress(True)
+
+    def get_counts(self) -> Tuple[int, int, int]:
+        """Gets (runs imported, runs skipped as already present, splits imported,)."""
+        return (self._run_count, self._skipped_run_count, self._split_count,)
+
+    def add_run(self, *, run_start_datetime: str, splits: List[Tuple[str, Dict[str, int]]]) -> None:
+        """Queues a whole run, as a list of (split_key, {time_base_key: value_microseconds},)."""
+        self._pending_runs.append((
+            run_start_datetime,
+            [
+                (
+                    self._db.ensure_fuse_split_type(game_id=self._game_id, type_key=split_key),
+                    [
+                        (self._db.ensure_time_base_id(game_id=self._game_id, type_key=time_base_key), value_microseconds)
+                        for time_base_key, value_microseconds in times.items()
+                    ],
+                )
+                for split_key, times in splits
+            ],
+        ))
+        self._pending_split_count += len(splits)
+        if len(self._pending_runs) >= RUN_BATCH_SIZE or self._pending_split_count >= SPLIT_BATCH_SIZE:
+            self._flush_runs()
+
+    def close(self) -> None:
+        """Writes everything still pending, and summarises the new runs."""
+        self._flush_runs()
+        self._db.set_run_in_progress(False)
+        self._db.backfill_run_summaries()
+        LOG.info(f"Imported {self._run_count} run(s) with {self._split_count} split(s), skipped {self._skipped_run_count} run(s) we already had")
+
+    def _flush_runs(self) -> None:
+        """Writes the pending runs along with their splits."""
+        if not self._pending_runs:
+            return
+        pending_runs = self._pending_runs
+        self._pending_runs = []
+        self._pending_split_count = 0
+        run_ids = self._db.create_runs_bulk(game_id=self._game_id, runs=pending_runs)
+        for run_id, (_, splits) in zip(run_ids, pending_runs):
+            if run_id is None:
+                self._skipped_run_count += 1
+            else:
+                self._run_count += 1
+                self._split_count += len(splits)
+
+
+def import_history_jsonl(db: DB, *, game_id: int, f: TextIO) -> Tuple[int, int, int]:
+    """
+    Imports runs written by export_history_jsonl().
+
+    Returns (runs imported, runs skipped, splits imported,).
+    """
+    importer = HistoryImporter(db, game_id=game_id)
+    for line in f:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        importer.add_run(
+            run_start_datetime=record["run_start_datetime"],
+            splits=[
+                (split["key"], {k: int(v) for k, v in split["times"].items()},)
+                for split in record["splits"]
+            ],
+        )
+    importer.close()
+    return importer.get_counts()
+
+
+def parse_lss_time(s: Optional[str]) -> Optional[int]:
+    """Parses a LiveSplit time span into microseconds."""
+    if not s:
+        return None
+    m = _LSS_TIME_RE.match(s.strip())
+    if m is None:
+        raise ValueError(f"Bad LiveSplit time {s!r}")
+    sign, days, hours, mins, secs, frac = m.groups()
+    result = ((int(days or "0")*24 + int(hours))*60 + int(mins))*60 + int(secs)
+    result_us = result*1000000 + int(((frac or "") + "000000")[:6])
+    return (-result_us if sign else result_us)
+
+
+def parse_lss_datetime(s: Optional[str]) -> Optional[datetime.datetime]:
+    """Parses a LiveSplit attempt date, which is in UTC."""
+    if not s:
+        return None
+    return datetime.datetime.strptime(s.strip(), "%m/%d/%Y %H:%M:%S")
+
+
+def import_lss(db: DB, *, game_id: int, path: Path, time_base_keys: Dict[str, str] = LSS_TIME_BASE_KEYS) -> Tuple[int, int, int]:
+    """
+    Imports every attempt in a LiveSplit splits file.
+
+    The file is parsed incrementally, but it lists times by segment
+    rather than by attempt, so each attempt's splits are kept until the
+    end of the file. Then the attempts are written in batches.
+
+    time_base_keys maps LiveSplit timing methods (RealTime, GameTime) to
+    the time bases to import them into.
+
+    Returns (runs imported, runs skipped, splits imported,).
+    """
+    importer = HistoryImporter(db, game_id=game_id)
+
+    # attempt ID -> run start
+    run_start_datetimes: Dict[int, str] = {}
+    # attempt ID -> the final time of a finished attempt
+    final_times: Dict[int, Dict[str, int]] = {}
+    # attempt ID -> time so far, and time of the last split reached
+    totals: Dict[int, Dict[str, int]] = {}
+    last_split_times: Dict[int, Dict[str, int]] = {}
+    # attempt ID -> splits so far, as (split_key, {time_base_key: value_microseconds},)
+    run_splits: Dict[int, List[Tuple[str, Dict[str, int]]]] = {}
+
+    segment_index = 0
+    for _, elem in ET.iterparse(str(path), events=("end",)):
+        if elem.tag == "AttemptHistory":
+            for attempt_id, run_start_datetime, attempt_times in _parse_lss_attempts(elem, time_base_keys):
+                run_start_datetimes[attempt_id] = run_start_datetime
+                totals[attempt_id] = {time_base_key: 0 for time_base_key in time_base_keys.values()}
+                last_split_times[attempt_id] = {time_base_key: 0 for time_base_key in time_base_keys.values()}
+                if attempt_times:
+                    final_times[attempt_id] = attempt_times
+                run_splits[attempt_id] = [(START_SPLIT_KEY, dict(last_split_times[attempt_id]),)]
+            elem.clear()
+
+        elif elem.tag == "Segment":
+            name_elem = elem.find("Name")
+            # Segments can share a name, or have none, and each needs a split type of its own
+            split_key = f"{LSS_SPLIT_KEY_PREFIX}{segment_index}:{(name_elem.text or '') if name_elem is not None else ''}"
+            segment_index += 1
+            history_elem = elem.find("SegmentHistory")
+            if history_elem is not None:
+                for time_elem in history_elem.iter("Time"):
+                    attempt_id = int(time_elem.get("id", "0"))
+                    splits = run_splits.get(attempt_id)
+                    if splits is None:
+                        continue
+
+                    # A segment with no times was skipped, and carries on into the next one
+                    total = totals[attempt_id]
+                    split_times: Dict[str, int] = {}
+                    for method, time_base_key in time_base_keys.items():
+                        segment_us = parse_lss_time(time_elem.findtext(method))
+                        if segment_us is not None:
+                            total[time_base_key] += segment_us
+                            split_times[time_base_key] = total[time_base_key]
+                    if split_times:
+                        splits.append((split_key, split_times,))
+                        last_split_times[attempt_id].update(split_times)
+            elem.clear()
+
+    # Finally, close off every run and write it
+    for attempt_id, run_start_datetime in run_start_datetimes.items():
+        splits = run_splits.pop(attempt_id)
+        if attempt_id in final_times:
+            splits.append((FINISH_SPLIT_KEY, final_times[attempt_id],))
+        else:
+            splits.append((CANCEL_SPLIT_KEY, last_split_times[attempt_id],))
+        importer.add_run(run_start_datetime=run_start_datetime, splits=splits)
+
+    importer.close()
+    return importer.get_counts()
+
+
+def _parse_lss_attempts(history_elem: ET.Element, time_base_keys: Dict[str, str]) -> Iterator[Tuple[int, str, Dict[str, int]]]:
+    """Yields (attempt_id, run_start_datetime, {time_base_key: final_microseconds},) for each attempt."""
+    seen_start_datetimes = set()
+    for attempt_elem in history_elem.iter("Attempt"):
+        attempt_id = int(attempt_elem.get("id", "0"))
+
+        # Attempts without a start date still need a unique start
+        started = parse_lss_datetime(attempt_elem.get("started"))
+        if started is None:
+            started = datetime.datetime(1970, 1, 1)
+        started += datetime.timedelta(microseconds=attempt_id % 1000000)
+        run_start_datetime = started.isoformat("T", "microseconds")
+        while run_start_datetime in seen_start_datetimes:
+            started += datetime.timedelta(microseconds=1)
+            run_start_datetime = started.isoformat("T", "microseconds")
+        seen_start_datetimes.add(run_start_datetime)
+
+        attempt_times: Dict[str, int] = {}
+        for method, time_base_key in time_base_keys.items():
+            value = parse_lss_time(attempt_elem.findtext(method))
+            if value is not None:
+                attempt_times[time_base_key] = value
+
+        yield (attempt_id, run_start_datetime, attempt_times,)
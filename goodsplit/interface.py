@@ -1,19 +1,33 @@
 from abc import ABCMeta
 from abc import abstractmethod
+import time
+from typing import Dict
 from typing import Generic
 from typing import List
 from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
 from typing import cast
 
+if TYPE_CHECKING:
+    from .records import EventRing
+
+# The constructor argument names of each event class, for __repr__
+_repr_field_names: Dict[type, Tuple[str, ...]] = {}
+
 
 class Event(metaclass=ABCMeta):
     """Something that happened."""
     __slots__ = ()
 
     def __repr__(self) -> str:
+        field_names = _repr_field_names.get(self.__class__)
+        if field_names is None:
+            code = self.__class__.__init__.__code__
+            field_names = _repr_field_names[self.__class__] = tuple(code.co_varnames[1:code.co_argcount+code.co_kwonlyargcount])
         arg_strings = [
             f"{sn}={getattr(self,sn)!r}"
-            for sn in self.__class__.__init__.__code__.co_varnames[1:]
+            for sn in field_names
         ]
         arg_list_str = ", ".join(arg_strings)
         return f"{self.__class__.__name__}({arg_list_str})"
@@ -28,6 +42,51 @@ class EventSource(metaclass=ABCMeta):
         """Pulls a sequence of events."""
         raise NotImplementedError()
 
+    def fileno(self) -> Optional[int]:
+        """
+        Gets a file descriptor which becomes readable when events are waiting.
+
+        Returns None if this source has to be polled instead.
+        """
+        return None
+
+    def pull_records(self, ring: "EventRing") -> int:
+        """
+        Pulls events into an event ring, returning how many records were written.
+
+        By default this writes whatever pull_events() gives as object records.
+        Sources which can write compact records should do so here instead.
+        """
+        events = self.pull_events()
+        if events:
+            capture_time = time.perf_counter()
+            for ev in events:
+                ring.push_event(ev, capture_time)
+        return len(events)
+
+
+class AsyncEventSource(metaclass=ABCMeta):
+    """A source of events which can be awaited on an asyncio event loop."""
+    __slots__ = ()
+
+    @abstractmethod
+    async def pull_events_async(self) -> List[Event]:
+        """Waits until there are events, then pulls them."""
+        raise NotImplementedError()
+
+    async def pull_records_async(self, ring: "EventRing") -> int:
+        """
+        Waits until there are events, then pulls them into an event ring, returning how many records were written.
+
+        By default this writes whatever pull_events_async() gives as object records.
+        """
+        events = await self.pull_events_async()
+        if events:
+            capture_time = time.perf_counter()
+            for ev in events:
+                ring.push_event(ev, capture_time)
+        return len(events)
+
 
 class TimeBase(metaclass=ABCMeta):
     """A way of keeping time."""
@@ -0,0 +1,205 @@
+"""
+Latency instrumentation.
+
+Every event is stamped with time.perf_counter() when it is read from its
+source. Each later stage records how long after that moment it happened,
+so the histograms show the total delay from the event being read to the
+split being processed, committed, and shown on screen.
+
+Metrics are off unless enabled, and then all recording costs is checking
+the enabled flag, so hot code does that first:
+
+    if METRICS.enabled:
+        METRICS.record_since(STAGE_DISPATCH, read_time)
+"""
+import logging
+import math
+from pathlib import Path
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+
+LOG = logging.getLogger("metrics")
+
+DEFAULT_METRICS_PATH = Path("~/goodsplit-metrics.txt")
+
+# Time spent reading and decoding a batch in the event source
+STAGE_SOURCE_READ = "source_read"
+# Read to the reactor handing the event to on_event
+STAGE_DISPATCH = "dispatch"
+# Read to the fuse split being recorded by the reactor
+STAGE_FUSE_SPLIT = "fuse_split"
+# Read to the split being committed to the database
+STAGE_DB_COMMIT = "db_commit"
+# Read to the split labels being updated
+STAGE_DISPLAY = "display"
+
+STAGES = [
+    STAGE_SOURCE_READ,
+    STAGE_DISPATCH,
+    STAGE_FUSE_SPLIT,
+    STAGE_DB_COMMIT,
+    STAGE_DISPLAY,
+]
+
+# Buckets per doubling, which gives about 9% resolution
+BUCKETS_PER_OCTAVE = 8
+# 1 microsecond up to about 2^28 microseconds (4.5 minutes)
+BUCKET_COUNT = BUCKETS_PER_OCTAVE*28
+
+
+class LatencyHistogram:
+    """A log-scale histogram of latencies, in seconds."""
+    __slots__ = (
+        "_buckets",
+        "count",
+        "max",
+        "total",
+    )
+
+    def __init__(self) -> None:
+        self._buckets: List[int] = [0]*BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, secs: float) -> None:
+        """Records a single latency."""
+        us = secs*1000000.0
+        if us <= 1.0:
+            idx = 0
+        else:
+            idx = min(BUCKET_COUNT-1, int(math.log2(us)*BUCKETS_PER_OCTAVE))
+        self._buckets[idx] += 1
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+
+    def get_percentile(self, pct: float) -> float:
+        """Gets an upper bound for the given percentile, in seconds."""
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(math.ceil(self.count*pct/100.0)))
+        seen = 0
+        for idx, bucket_count in enumerate(self._buckets):
+            seen += bucket_count
+            if seen >= target:
+                upper = (2.0**((idx+1)/BUCKETS_PER_OCTAVE))/1000000.0
+                return min(upper, self.max)
+        return self.max
+
+    def get_mean(self) -> float:
+        """Gets the mean latency, in seconds."""
+        if self.count == 0:
+            return 0.0
+        return self.total/self.count
+
+    def copy(self) -> "LatencyHistogram":
+        """Gets a copy of this histogram."""
+        result = LatencyHistogram()
+        result._buckets = list(self._buckets)
+        result.count = self.count
+        result.total = self.total
+        result.max = self.max
+        return result
+
+
+class LatencyMetrics:
+    """
+    A set of per-stage latency histograms.
+
+    Stages get recorded from the reactor, the database writer thread and
+    the GUI, so this is thread-safe.
+    """
+    __slots__ = (
+        "_histograms",
+        "_lock",
+        "_time_beg",
+        "enabled",
+        "report_path",
+    )
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._time_beg = time.time()
+        self.enabled = False
+        self.report_path = DEFAULT_METRICS_PATH
+
+    def enable(self) -> None:
+        """Starts recording, from now."""
+        with self._lock:
+            if not self.enabled:
+                self._time_beg = time.time()
+            self.enabled = True
+
+    def disable(self) -> None:
+        """Stops recording. Anything recorded so far is kept."""
+        self.enabled = False
+
+    def record(self, stage: str, secs: float) -> None:
+        """Records a latency for a stage, if we're recording."""
+        if not self.enabled:
+            return
+        with self._lock:
+            hist = self._histograms.get(stage)
+            if hist is None:
+                hist = LatencyHistogram()
+                self._histograms[stage] = hist
+            hist.record(secs)
+
+    def record_since(self, stage: str, origin_time: float) -> None:
+        """Records how long it has been since origin_time, which came from time.perf_counter()."""
+        self.record(stage, time.perf_counter() - origin_time)
+
+    def get_histograms(self) -> Dict[str, LatencyHistogram]:
+        """Gets a snapshot of every histogram, keyed by stage."""
+        with self._lock:
+            return {
+                stage: hist.copy()
+                for stage, hist in self._histograms.items()
+            }
+
+    def reset(self) -> None:
+        """Throws away everything recorded so far."""
+        with self._lock:
+            self._histograms = {}
+            self._time_beg = time.time()
+
+    def format_report(self) -> str:
+        """Formats every histogram as a text table."""
+        histograms = self.get_histograms()
+        stages = STAGES + sorted(set(histograms.keys()) - set(STAGES))
+        lines = [
+            f"# Goodsplit latency metrics since {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._time_beg))}",
+            f"# All times in milliseconds. Stages other than {STAGE_SOURCE_READ} are measured from when the event was read.",
+            f"{'stage':<12} {'count':>8} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10}",
+        ]
+        for stage in stages:
+            hist = histograms.get(stage)
+            if hist is None:
+                hist = LatencyHistogram()
+            lines.append(
+                f"{stage:<12} {hist.count:>8d}"
+                f" {hist.get_mean()*1000.0:>10.3f}"
+                f" {hist.get_percentile(50.0)*1000.0:>10.3f}"
+                f" {hist.get_percentile(99.0)*1000.0:>10.3f}"
+                f" {hist.max*1000.0:>10.3f}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path: Optional[Path] = None) -> None:
+        """Writes the report to a text file, by default our report path."""
+        if path is None:
+            path = self.report_path
+        path = path.expanduser()
+        LOG.info(f"Writing latency metrics to {str(path)!r}")
+        with open(path, "w") as f:
+            f.write(self.format_report())
+
+
+# The metrics for this process.
+METRICS = LatencyMetrics()
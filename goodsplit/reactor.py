@@ -1,21 +1,61 @@
 from abc import ABCMeta
 from abc import abstractmethod
+import concurrent.futures
 import logging
 import math
+from pathlib import Path
+from pathlib import PurePath
+import threading
+import time
 from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Sequence
 from typing import Tuple
 
-import sqlite3
-
+from .comparison import ComparisonEngine
+from .comparison import RunSplits
+from .comparison import SplitComparison
 from .db import DB
+from .db import DBWriter
+from .db import RunRecord
+from .db import RunSummaryRecord
+from .db import SplitRecord
 from .interface import Event
 from .interface import EventSource
 from .interface import TimeBase
+from .metrics import METRICS
+from .metrics import STAGE_DISPATCH
+from .metrics import STAGE_FUSE_SPLIT
+from .records import EventRing
+from .records import MAX_RING_KEYS
+from .records import OBJECT_KIND
+from .records import get_record_kind
+from .rules import RuleAction
+from .rules import RuleSet
+from .rules import SplitRule
+from .time_base import LoadRemovedTimeBase
+from .tracing import NULL_SPAN
+from .tracing import TRACER
 
 LOG = logging.getLogger("reactor")
+TRACE = TRACER.get_channel("reactor")
+
+# Reads the history for each reactor's comparisons. It's one thread for
+# every reactor, as each thread which reads a database keeps a connection.
+_HISTORY_LOADER: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_HISTORY_LOADER_LOCK = threading.Lock()
+
+
+def _get_history_loader() -> concurrent.futures.ThreadPoolExecutor:
+    """Gets the thread which reads the history for comparisons, starting it if necessary."""
+    global _HISTORY_LOADER
+    with _HISTORY_LOADER_LOCK:
+        if _HISTORY_LOADER is None:
+            _HISTORY_LOADER = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="goodsplit-history-loader")
+        return _HISTORY_LOADER
 
 
 class Reactor:
@@ -24,34 +64,72 @@ class Reactor:
         "_active_game_id",
         "_active_run_id",
         "_active_time_base_ids",
+        "_comparison",
+        "_comparison_loader",
         "_db",
+        "_db_writer",
+        "_event_read_time",
+        "_event_ring",
         "_event_sources",
+        "_fuse_split_version",
         "_fuse_splits",
+        "_is_key_clear_due",
         "_is_stopped",
+        "_last_split_origin_time",
         "_last_time_str",
         "_ordered_fuse_splits",
-        "_sql_conn",
+        "_ordered_split_comparisons",
+        "_split_listeners",
+        "_split_type_ids",
+        "_split_type_id_cancel",
+        "_split_type_id_finish",
+        "_split_type_id_start",
         "_time_bases",
         "_time_invalid",
+        "_load_intervals",
+        "_load_removed_time_bases",
         "_time_load_start",
+        "_rule_state",
+        "_rules",
+        "_runs_ended_while_loading",
     )
 
-    def __init__(self, time_bases: List[TimeBase], event_sources: List[EventSource]) -> None:
+    def __init__(self, time_bases: List[TimeBase], event_sources: List[EventSource], db: Optional[DB] = None) -> None:
         self._time_bases = list(time_bases)
         self._event_sources = list(event_sources)
         self._is_stopped = True
         self._time_invalid = True
         self._last_time_str: str = "--TODO-SET-TIME--"
-        self._fuse_splits: Dict[str, List[float]] = {}
+        self._fuse_splits: Dict[int, List[float]] = {}
         self._ordered_fuse_splits: List[Tuple[List[float], str]] = []
+        self._ordered_split_comparisons: List[SplitComparison] = []
+        self._fuse_split_version = 0
+        self._split_listeners: List[Callable[[List[float], str], None]] = []
+        self._event_read_time: Optional[float] = None
+        # What update() pulls event records into
+        self._event_ring = EventRing()
+        # Clear the ring's keys once the records being processed are done with
+        self._is_key_clear_due = False
+        self._last_split_origin_time: Optional[float] = None
         self._time_load_start: Optional[List[float]] = None
+        # (begin, end,) of every load this run, in microseconds on the first time base
+        self._load_intervals: List[Tuple[int, int]] = []
+        self._load_removed_time_bases = [
+            tb
+            for tb in self._time_bases
+            if isinstance(tb, LoadRemovedTimeBase)
+        ]
+        self._rules: Optional[RuleSet] = None
+        self._rule_state: Any = None
 
-        self._db = DB()
+        self._db = (db if db is not None else DB())
+        self._db_writer = DBWriter(db=self._db)
 
         self._active_game_id = self._db.ensure_game_id(
             game_key=self.get_game_key(),
             game_title=self.get_game_title(),
         )
+        self._db.preload_game(game_id=self._active_game_id)
         self._active_time_base_ids = [
             self._db.ensure_time_base_id(
                 game_id=self._active_game_id,
@@ -60,6 +138,79 @@ class Reactor:
             for tb in time_bases
         ]
         self._active_run_id: Optional[int] = None
+        # Fuse split type IDs by key, which stay the same for as long as this reactor lives
+        self._split_type_ids: Dict[str, int] = {}
+
+        self._split_type_id_start = self.intern_split_key("$system:start")
+        self._split_type_id_finish = self.intern_split_key("$system:finish")
+        self._split_type_id_cancel = self.intern_split_key("$system:cancel")
+
+        # Read the history once, so comparing a split never touches SQLite.
+        # That takes longer with every run, so it's done on another thread,
+        # and until it's done there's nothing to compare against.
+        self._comparison = self._make_comparison_engine()
+        # Runs which ended before the history was read, which get folded into it
+        self._runs_ended_while_loading: Optional[List[RunSplits]] = []
+        self._comparison_loader = _get_history_loader().submit(self._load_comparison)
+
+    def close(self) -> None:
+        """Writes out everything pending and shuts down the reactor."""
+        self._db_writer.close()
+        # Don't leave it reading a database which may be about to go away
+        self._comparison_loader.cancel()
+        concurrent.futures.wait([self._comparison_loader])
+
+    def _make_comparison_engine(self) -> ComparisonEngine:
+        """Makes an empty comparison engine for this game."""
+        return ComparisonEngine(
+            time_base_ids=self._active_time_base_ids,
+            start_type_id=self._split_type_id_start,
+            finish_type_id=self._split_type_id_finish,
+            cancel_type_id=self._split_type_id_cancel,
+        )
+
+    def _load_comparison(self) -> ComparisonEngine:
+        """Reads the history into a new comparison engine. Runs on the history loader thread."""
+        engine = self._make_comparison_engine()
+        try:
+            engine.load_history(self._db.iter_split_history(game_id=self._active_game_id))
+        except Exception as e:
+            LOG.exception(e)
+            # Carry on with what's been seen this session
+            engine = self._make_comparison_engine()
+        return engine
+
+    def _adopt_loaded_comparison(self) -> None:
+        """Switches to the comparison engine with the history in it, once it has been read."""
+        if self._runs_ended_while_loading is None or not self._comparison_loader.done() or self._comparison_loader.cancelled():
+            return
+        engine = self._comparison_loader.result()
+        for run_splits in self._runs_ended_while_loading:
+            engine.add_run(run_splits)
+        self._runs_ended_while_loading = None
+        engine.carry_on_run(self._comparison)
+        self._comparison = engine
+        # Anything showing the comparisons needs redrawing
+        self._fuse_split_version += 1
+
+    def wait_for_history(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the history has been read for the comparisons.
+
+        Call it from the thread running the reactor. Returns False if it timed out.
+        """
+        concurrent.futures.wait([self._comparison_loader], timeout)
+        self._adopt_loaded_comparison()
+        return self._runs_ended_while_loading is None
+
+    def flush_db(self) -> None:
+        """
+        Waits until every split so far has been written to the database.
+
+        This can block for a while, so don't call it from the thread running the reactor.
+        """
+        if not self._db_writer.flush(timeout=10.0):
+            LOG.error("Timed out waiting for splits to be written")
 
     @classmethod
     @abstractmethod
@@ -73,6 +224,16 @@ class Reactor:
         """Gets the unique identifier of this game."""
         raise NotImplementedError()
 
+    @classmethod
+    @abstractmethod
+    def create_for_game(cls, *, game_root_dir: Path, game_user_dir: Path, **kwargs: Any) -> "Reactor":
+        """
+        Creates a reactor from the directories the user picked for this game.
+
+        kwargs are optional overrides for the reactor (event_sources, time_bases, db).
+        """
+        raise NotImplementedError()
+
     def get_ordered_fuse_splits(self) -> List[Tuple[List[float], str]]:
         """
         Gets an ordered list of the current activated fuse splits.
@@ -84,6 +245,38 @@ class Reactor:
             self._ordered_fuse_splits,
         ))
 
+    def get_last_fuse_splits(self, count: int) -> List[Tuple[List[float], str]]:
+        """
+        Gets the last few activated fuse splits, oldest first.
+
+        Returns a list of ([ts0, ...], split_id,).
+        """
+        return list(map(
+            (lambda t: (list(t[0]), t[1],)),
+            self._ordered_fuse_splits[-count:],
+        ))
+
+    def get_last_split_comparisons(self, count: int) -> List[SplitComparison]:
+        """Gets how the last few activated fuse splits compare to history, oldest first, matching get_last_fuse_splits()."""
+        return self._ordered_split_comparisons[-count:]
+
+    def get_comparison(self) -> ComparisonEngine:
+        """Gets the personal best and best segment tables for this game, which are empty until the history has been read."""
+        self._adopt_loaded_comparison()
+        return self._comparison
+
+    def add_split_listener(self, listener: Callable[[List[float], str], None]) -> None:
+        """Adds a callback which gets called with (ts, split_id) whenever a fuse split is made."""
+        self._split_listeners.append(listener)
+
+    def get_fuse_split_version(self) -> int:
+        """Gets a number which changes whenever the list of activated fuse splits changes."""
+        return self._fuse_split_version
+
+    def get_last_split_origin_time(self) -> Optional[float]:
+        """Gets the time.perf_counter() when the event behind the latest fuse split was read, if any."""
+        return self._last_split_origin_time
+
     def is_time_invalid(self) -> bool:
         """Is the time invalid?"""
         return self._time_invalid
@@ -93,28 +286,201 @@ class Reactor:
         time_now = [tb.fetch_time() for tb in self._time_bases]
         return time_now
 
+    def get_wait_fds(self) -> List[int]:
+        """Gets the file descriptors which become readable when this reactor has events to process."""
+        fds: List[int] = []
+        for src in self._event_sources:
+            fd = src.fileno()
+            if fd is not None:
+                fds.append(fd)
+        return fds
+
+    def needs_polling(self) -> bool:
+        """Does this reactor have any event sources which can't be waited on?"""
+        return any(src.fileno() is None for src in self._event_sources)
+
+    def get_event_ring(self) -> EventRing:
+        """Gets the event ring which this reactor's sources pull records into."""
+        return self._event_ring
+
+    def get_event_sources(self) -> List[EventSource]:
+        """Gets the event sources for this reactor."""
+        return list(self._event_sources)
+
+    def wrap_event_sources(self, wrapper: Callable[[EventSource], EventSource]) -> None:
+        """Replaces each event source with a wrapped version of it, e.g. for recording."""
+        self._event_sources = [wrapper(src) for src in self._event_sources]
+
     def update(self) -> None:
         """Updates the reactor."""
         time_now = [tb.fetch_time() for tb in self._time_bases]
-        events = []
-        time_str = self.convert_times_to_str(time_now)
+        ring = self._event_ring
         for src in self._event_sources:
-            events += src.pull_events()
+            src.pull_records(ring)
+
+        self.process_records(time_now, ring)
+
+    def process_events(self, time_now: List[float], events: List[Event], *, read_time: Optional[float] = None) -> None:
+        """
+        Processes a batch of events which arrived at the given time.
+
+        read_time is the time.perf_counter() when the batch was read, and is
+        what the latency metrics are measured from.
+        """
+        self._adopt_loaded_comparison()
+        if not events:
+            return
+        if read_time is None:
+            read_time = time.perf_counter()
+        is_debug = LOG.isEnabledFor(logging.DEBUG)
+        is_metrics = METRICS.enabled
+        self._event_read_time = read_time
+        try:
+            with (TRACE.span("process_events", events=len(events)) if TRACE.enabled else NULL_SPAN):
+                for ev in events:
+                    if is_metrics:
+                        METRICS.record_since(STAGE_DISPATCH, read_time)
+                    self.on_event(time_now, ev)
+                    if is_debug:
+                        self._log_event_debug(time_now, ev)
+        finally:
+            self._event_read_time = None
 
-        for ev in events:
-            self.on_event(time_now, ev)
-            if self._time_invalid:
-                LOG.debug(f"{time_str}: {ev}")
-            else:
-                if (not self._is_stopped):
-                    self._last_time_str = time_str
-                LOG.debug(f"{self._last_time_str}: {ev}")
+    def process_records(self, time_now: List[float], ring: EventRing) -> None:
+        """
+        Processes every record waiting in an event ring, which arrived at the given time.
+
+        Latency metrics are measured from each record's capture time.
+        """
+        self._adopt_loaded_comparison()
+        begin, end = ring.take()
+        if begin == end:
+            return
+        is_debug = LOG.isEnabledFor(logging.DEBUG)
+        is_metrics = METRICS.enabled
+        capture_times = ring.capture_times
+        mask = ring.mask
+        try:
+            with (TRACE.span("process_records", records=(end - begin)) if TRACE.enabled else NULL_SPAN):
+                for pos in range(begin, end):
+                    idx = pos & mask
+                    read_time = capture_times[idx]
+                    self._event_read_time = read_time
+                    if is_metrics:
+                        METRICS.record_since(STAGE_DISPATCH, read_time)
+                    self.on_record(time_now, ring, idx)
+                    if is_debug:
+                        self._log_event_debug(time_now, ring.get_event(idx))
+        finally:
+            self._event_read_time = None
+            ring.release(begin, end)
+            # Between runs, only keys seen since need keeping, unless records were written after the take
+            if (self._is_key_clear_due or len(ring.keys) > MAX_RING_KEYS) and ring.tail == end:
+                ring.keys.clear()
+                self._is_key_clear_due = False
+
+    def _log_event_debug(self, time_now: List[float], ev: Event) -> None:
+        """Logs an event which has been processed, for debugging."""
+        time_str = self.convert_times_to_str(time_now)
+        if self._time_invalid:
+            LOG.debug(f"{time_str}: {ev}")
+        else:
+            if (not self._is_stopped):
+                self._last_time_str = time_str
+            LOG.debug(f"{self._last_time_str}: {ev}")
+
+    async def run_async(self, *, on_update: Optional[Callable[[], None]] = None) -> None:
+        """
+        Runs this reactor on the current asyncio event loop until cancelled.
+
+        on_update, if given, is called after each batch of events.
+        """
+        from .aio import run_reactor
+        await run_reactor(self, on_update=on_update)
 
     @abstractmethod
     def on_event(self, ts: List[float], ev: Event) -> None:
         """Processes the given event."""
         raise NotImplementedError()
 
+    def on_record(self, ts: List[float], ring: EventRing, idx: int) -> None:
+        """
+        Processes the event record at the given index of a ring.
+
+        By default this makes the full event and hands it to on_event().
+        Reactors which can act on the record as it is, e.g. with
+        apply_record_rules(), can override this to skip making it.
+        """
+        self.on_event(ts, ring.get_event(idx))
+
+    def set_rules(self, rules: Sequence[SplitRule], *, initial_state: Any = None) -> None:
+        """Compiles the split rules which apply_rules() follows."""
+        self._rules = RuleSet(rules)
+        self._rule_state = initial_state
+
+    def get_rule_state(self) -> Any:
+        """Gets the state the split rules are in."""
+        return self._rule_state
+
+    def apply_rules(self, ts: List[float], ev: Event) -> bool:
+        """
+        Does whatever the split rules say to do about an event.
+
+        Returns False if no rule matched it.
+        """
+        if self._rules is None:
+            return False
+        rule = self._rules.find_rule(ev, self._rule_state)
+        if rule is None:
+            return False
+        self._apply_rule(ts, rule, getattr(ev, "fpath", None))
+        return True
+
+    def apply_record_rules(self, ts: List[float], ring: EventRing, idx: int) -> bool:
+        """
+        Does whatever the split rules say to do about the event record at the given index of a ring.
+
+        Records keyed by a path are matched without making the full event.
+        Returns False if no rule matched it.
+        """
+        if self._rules is None:
+            return False
+        kind = ring.kinds[idx]
+        if kind == OBJECT_KIND:
+            return self.apply_rules(ts, ring.objects[idx])
+        key = ring.keys.get(ring.key_ids[idx])
+        fpath = (key if isinstance(key, PurePath) else None)
+        rule = self._rules.find_rule_for(get_record_kind(kind).event_type, fpath, self._rule_state)
+        if rule is None:
+            return False
+        self._apply_rule(ts, rule, fpath)
+        return True
+
+    def _apply_rule(self, ts: List[float], rule: SplitRule, fpath: Optional[PurePath]) -> None:
+        """Does the actions of a rule which matched an event on the given path."""
+        for action in rule.actions:
+            if action is RuleAction.SPLIT:
+                if rule.split_key is not None:
+                    self.do_fuse_split(ts, rule.split_key)
+                else:
+                    assert fpath is not None
+                    self.do_fuse_split(ts, f"{rule.split_prefix}:{fpath.name.lower()}")
+            elif action is RuleAction.START_LOADING:
+                self.start_loading(ts)
+            elif action is RuleAction.STOP_LOADING:
+                self.stop_loading(ts)
+            elif action is RuleAction.START:
+                self.start_run()
+            elif action is RuleAction.FINISH:
+                self.finish_run()
+            elif action is RuleAction.CANCEL:
+                self.cancel_run()
+
+        if rule.next_state is not None:
+            self._rule_state = rule.next_state
+        if rule.message is not None:
+            LOG.info(f"{self.convert_times_to_str(ts)} {rule.message}")
+
     def convert_times_to_str(self, ts: List[float]) -> str:
         """Convert a group of times to a nice string."""
         time_str = "[" + ("|".join(map(self.convert_time_to_str, ts))) + "]"
@@ -135,22 +501,32 @@ class Reactor:
 
     def start_run(self) -> None:
         """Starts a new run."""
-        self._active_run_id = self._db.create_run_id(
+        # The writer creates the run, so this doesn't wait on SQLite
+        self._active_run_id = self._db.new_local_run_id()
+        self._db_writer.submit_run(RunRecord(
+            run_id=self._active_run_id,
             game_id=self._active_game_id,
-        )
+            run_start_datetime=self._db.fetch_timestamp_now(),
+        ))
+        self._db.set_run_in_progress(True)
+        self._is_key_clear_due = True
         self._time_load_start = None
+        self._load_intervals = []
         self._is_stopped = False
         self._time_invalid = False
 
         self._fuse_splits = {}
         self._ordered_fuse_splits = []
+        self._ordered_split_comparisons = []
+        self._fuse_split_version += 1
+        self._comparison.start_run()
 
         for tb in self._time_bases:
             tb.reset_to_zero()
 
-        self.do_fuse_split(
+        self.do_fuse_split_type(
             ts=[tb.fetch_time() for tb in self._time_bases],
-            split_id="$system:start",
+            fuse_split_type_id=self._split_type_id_start,
         )
 
         LOG.info("Run started!")
@@ -158,22 +534,33 @@ class Reactor:
     def finish_run(self) -> None:
         """Finishes a successful run."""
         if not self._is_stopped:
-            self.do_fuse_split(
-                ts=[tb.fetch_time() for tb in self._time_bases],
-                split_id="$system:finish",
+            ts = [tb.fetch_time() for tb in self._time_bases]
+            self.stop_loading(ts)
+            self.do_fuse_split_type(
+                ts=ts,
+                fuse_split_type_id=self._split_type_id_finish,
             )
+            self._end_comparison_run()
+            self._submit_run_summary(is_finished=True)
         self._time_load_start = None
         self._is_stopped = True
         self._active_run_id = None
+        # The writer commits the end of the run as soon as it's idle, so don't wait on it here
+        self._db.set_run_in_progress(False)
+        self._is_key_clear_due = True
         LOG.info("Run finished!")
 
     def cancel_run(self) -> None:
         """Cancels the current run."""
         if not self._is_stopped:
-            self.do_fuse_split(
-                ts=[tb.fetch_time() for tb in self._time_bases],
-                split_id="$system:cancel",
+            ts = [tb.fetch_time() for tb in self._time_bases]
+            self.stop_loading(ts)
+            self.do_fuse_split_type(
+                ts=ts,
+                fuse_split_type_id=self._split_type_id_cancel,
             )
+            self._end_comparison_run()
+            self._submit_run_summary(is_finished=False)
         for tb in self._time_bases:
             tb.reset_to_zero()
         self._time_load_start = None
@@ -182,46 +569,114 @@ class Reactor:
         self._active_run_id = None
         self._fuse_splits = {}
         self._ordered_fuse_splits = []
+        self._ordered_split_comparisons = []
+        self._fuse_split_version += 1
+        self._db.set_run_in_progress(False)
+        self._is_key_clear_due = True
         LOG.info("Run cancelled.")
 
+    def _end_comparison_run(self) -> None:
+        """Folds the current run into the comparisons, and keeps it for the history if that's still being read."""
+        run_splits = self._comparison.end_run()
+        if self._runs_ended_while_loading is not None and run_splits:
+            self._runs_ended_while_loading.append(run_splits)
+
+    def _submit_run_summary(self, *, is_finished: bool) -> None:
+        """Queues the summary of the current run, which ends at its last split."""
+        if self._active_run_id is None:
+            return
+        final_times: List[Tuple[int, int]] = []
+        if self._ordered_fuse_splits:
+            ts, _ = self._ordered_fuse_splits[-1]
+            final_times = [
+                (time_base_id, int(math.floor(secs*1000000)))
+                for secs, time_base_id in zip(ts, self._active_time_base_ids)
+            ]
+        self._db_writer.submit_run_summary(RunSummaryRecord(
+            run_id=self._active_run_id,
+            game_id=self._active_game_id,
+            is_finished=is_finished,
+            split_count=len(self._ordered_fuse_splits),
+            final_times=final_times,
+            load_time_base_id=(self._active_time_base_ids[0] if self._load_intervals else None),
+            load_intervals=self._load_intervals,
+        ))
+        self._load_intervals = []
+
+    def intern_split_key(self, split_id: str) -> int:
+        """
+        Gets the fuse split type ID for a split key, without touching SQLite.
+
+        Keys which have been seen before for this game get their database
+        ID. New ones get a local ID, and the DB writer creates them along
+        with the first split which uses them.
+        """
+        result = self._split_type_ids.get(split_id)
+        if result is None:
+            result = self._split_type_ids[split_id] = self._db.reserve_fuse_split_type(
+                game_id=self._active_game_id,
+                type_key=split_id,
+            )
+        return result
+
     def do_fuse_split(self, ts: List[float], split_id: str) -> None:
         """Adds a fuse split if we haven't blown the fuse already."""
         if self._active_run_id is None:
             LOG.warn(f"Attempted to add a fuse split {split_id!r} when no run available!")
             return
-        if split_id in self._fuse_splits:
+        self.do_fuse_split_type(ts, self.intern_split_key(split_id))
+
+    def do_fuse_split_type(self, ts: List[float], fuse_split_type_id: int) -> None:
+        """Adds a fuse split by its interned fuse split type ID if we haven't blown the fuse already."""
+        if self._active_run_id is None:
+            LOG.warn(f"Attempted to add a fuse split type {fuse_split_type_id!r} when no run available!")
+            return
+        if fuse_split_type_id in self._fuse_splits:
             return
 
         # Blow the fuse and make a split!
-        self._fuse_splits[split_id] = list(ts)
+        # Splits made outside of an event, e.g. by the GUI, are measured from now
+        origin_time = self._event_read_time
+        if origin_time is None:
+            origin_time = time.perf_counter()
+        split_id = self._db.get_fuse_split_type_key(fuse_split_type_id=fuse_split_type_id)
+        values_microseconds = [int(math.floor(secs*1000000)) for secs in ts]
+        self._fuse_splits[fuse_split_type_id] = list(ts)
         self._ordered_fuse_splits.append((list(ts), split_id,))
+        self._ordered_split_comparisons.append(self._comparison.add_split(fuse_split_type_id, values_microseconds))
+        self._fuse_split_version += 1
+        self._last_split_origin_time = origin_time
+        if METRICS.enabled:
+            METRICS.record_since(STAGE_FUSE_SPLIT, origin_time)
+        if TRACE.enabled:
+            TRACE.event("fuse_split", split=split_id, latency=(time.perf_counter() - origin_time))
         LOG.info(f"Fuse split {self.convert_times_to_str(ts)}: {split_id!r}")
-        fuse_split_type_id = self._db.ensure_fuse_split_type(
-            game_id=self._active_game_id,
-            type_key=split_id,
-        )
-        split_db_id = self._db.create_split_id(
+        for listener in self._split_listeners:
+            listener(list(ts), split_id)
+        self._db_writer.submit_split(SplitRecord(
             run_id=self._active_run_id,
             fuse_split_type_id=fuse_split_type_id,
-        )
-        for secs, time_base_id in zip(ts, self._active_time_base_ids):
-            value_microseconds = int(math.floor(secs*1000000))
-            time_stamp_id = self._db.create_time_stamp_id(
-                split_id=split_db_id,
-                time_base_id=time_base_id,
-                value_microseconds=value_microseconds,
-            )
+            time_stamps=list(zip(self._active_time_base_ids, values_microseconds)),
+            origin_time=origin_time,
+        ))
 
     def start_loading(self, ts: List[float]) -> None:
         """Start a loading period for load removal."""
+        if self._active_run_id is None:
+            return
         if self._time_load_start is None:
             self._time_load_start = list(ts)
+            for tb in self._load_removed_time_bases:
+                tb.pause()
 
     def stop_loading(self, ts: List[float]) -> None:
         """Stops a loading period and applies load removal."""
         if self._time_load_start is not None:
-            load_beg = self._time_load_start
-            load_end = list(ts)
-            loads_to_remove = [e-b for b, e in zip(load_beg, load_end)]
-            LOG.info(f"Load removal to apply: {loads_to_remove}")
+            for tb in self._load_removed_time_bases:
+                tb.resume()
+            # Kept in memory and written once with the run summary
+            self._load_intervals.append((
+                int(math.floor(self._time_load_start[0]*1000000)),
+                int(math.floor(ts[0]*1000000)),
+            ))
             self._time_load_start = None
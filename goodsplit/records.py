@@ -0,0 +1,235 @@
+"""
+Compact event records.
+
+An EventRing holds events as fixed-size records of (kind code, key ID,
+capture time) in preallocated arrays, so a source can hand events to a
+reactor without making an object for each one. Kind codes stand for
+event classes, and key IDs for keys such as paths, interned in the
+ring's own KeyTable, so the full Event only gets made when something
+asks for it.
+
+A reactor clears its ring's key table between runs, so it only holds
+the keys seen lately. Sources which keep key IDs between pulls check
+KeyTable.generation first, and intern their keys again if it changed.
+
+Sources which only make Event objects can still write them into a ring,
+as OBJECT_KIND records which carry the object along.
+"""
+import array
+import logging
+import threading
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
+
+from .interface import Event
+
+LOG = logging.getLogger("records")
+
+# How many records a ring holds before it has to grow
+DEFAULT_RING_CAPACITY = 1024
+# How many keys a ring's key table holds before it gets cleared anyway
+MAX_RING_KEYS = 16384
+
+# Records which carry an Event object rather than a key
+OBJECT_KIND = 0
+# Key ID of records which don't have a key
+NO_KEY_ID = -1
+
+
+class RecordKind:
+    """What a kind code stands for."""
+    __slots__ = (
+        "code",
+        "event_type",
+        "make_event",
+    )
+
+    def __init__(self, *, code: int, event_type: Optional[Type[Event]], make_event: Callable[[Any], Event]) -> None:
+        self.code = code
+        self.event_type = event_type
+        # Makes the full event from the record's key
+        self.make_event = make_event
+
+
+def _make_object_event(key: Any) -> Event:
+    raise ValueError("object records carry their events, they can't be made from a key")
+
+
+_kinds: List[RecordKind] = [
+    RecordKind(code=OBJECT_KIND, event_type=None, make_event=_make_object_event),
+]
+_kinds_lock = threading.Lock()
+
+def register_record_kind(event_type: Type[Event], make_event: Callable[[Any], Event]) -> int:
+    """Registers a kind of record, returning its kind code."""
+    with _kinds_lock:
+        code = len(_kinds)
+        _kinds.append(RecordKind(code=code, event_type=event_type, make_event=make_event))
+        return code
+
+
+def get_record_kind(code: int) -> RecordKind:
+    """Gets what a kind code stands for."""
+    return _kinds[code]
+
+
+class KeyTable:
+    """
+    The interned keys of one ring's records.
+
+    clear() throws every key away, and any key IDs handed out before
+    then mean nothing afterwards.
+    """
+    __slots__ = (
+        "_key_ids",
+        "_keys",
+        "generation",
+    )
+
+    def __init__(self) -> None:
+        self._keys: List[Any] = []
+        self._key_ids: Dict[Any, int] = {}
+        # Goes up on every clear()
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def intern(self, key: Any) -> int:
+        """Gets the ID of a key, such as a path, giving it one if it doesn't have one yet."""
+        key_id = self._key_ids.get(key)
+        if key_id is None:
+            key_id = len(self._keys)
+            self._keys.append(key)
+            self._key_ids[key] = key_id
+        return key_id
+
+    def get(self, key_id: int) -> Any:
+        """Gets the key behind a key ID."""
+        return self._keys[key_id]
+
+    def clear(self) -> None:
+        """Forgets every key."""
+        self._keys = []
+        self._key_ids = {}
+        self.generation += 1
+
+
+class EventRing:
+    """
+    A ring buffer of event records, written by sources and read in place by a reactor.
+
+    Record i of the ring is kinds[i], key_ids[i], capture_times[i] (the
+    time.perf_counter() when it was read), and for OBJECT_KIND records,
+    objects[i]. Positions count up forever, and pos & mask is the index.
+    Key IDs are from the ring's keys.
+
+    It isn't thread safe. If a pull writes more than it can hold, it
+    grows, and says so in the log.
+    """
+    __slots__ = (
+        "capture_times",
+        "head",
+        "key_ids",
+        "keys",
+        "kinds",
+        "mask",
+        "objects",
+        "tail",
+    )
+
+    def __init__(self, capacity: int = DEFAULT_RING_CAPACITY) -> None:
+        # Round up to a power of two, so indices are a mask away
+        capacity = max(1, 1 << (capacity - 1).bit_length())
+        self.kinds = array.array("i", [OBJECT_KIND]) * capacity
+        self.key_ids = array.array("i", [NO_KEY_ID]) * capacity
+        self.capture_times = array.array("d", [0.0]) * capacity
+        self.objects: List[Optional[Event]] = [None] * capacity
+        self.keys = KeyTable()
+        self.mask = capacity - 1
+        # Position of the next record to read
+        self.head = 0
+        # Position of the next record to write
+        self.tail = 0
+
+    def __len__(self) -> int:
+        return self.tail - self.head
+
+    def push(self, kind: int, key_id: int, capture_time: float) -> None:
+        """Writes a record."""
+        if self.tail - self.head > self.mask:
+            self._grow()
+        idx = self.tail & self.mask
+        self.kinds[idx] = kind
+        self.key_ids[idx] = key_id
+        self.capture_times[idx] = capture_time
+        if self.objects[idx] is not None:
+            self.objects[idx] = None
+        self.tail += 1
+
+    def push_event(self, ev: Event, capture_time: float) -> None:
+        """Writes a record carrying an Event object."""
+        self.push(OBJECT_KIND, NO_KEY_ID, capture_time)
+        self.objects[(self.tail - 1) & self.mask] = ev
+
+    def drop_last(self) -> None:
+        """Takes back the record written last."""
+        assert self.tail > self.head
+        self.tail -= 1
+        self.objects[self.tail & self.mask] = None
+
+    def take(self) -> Tuple[int, int]:
+        """
+        Takes every record waiting, as the positions (begin, end,).
+
+        They stay where they are until something else gets written.
+        """
+        begin = self.head
+        self.head = self.tail
+        return (begin, self.tail,)
+
+    def release(self, begin: int, end: int) -> None:
+        """
+        Lets go of the Event objects of records taken as (begin, end,), once they've been read.
+
+        Slots written again since the take are left alone.
+        """
+        objects = self.objects
+        mask = self.mask
+        for pos in range(max(begin, self.tail - mask - 1), end):
+            objects[pos & mask] = None
+
+    def get_event(self, idx: int) -> Event:
+        """Gets the full event of the record at an index, making it if necessary."""
+        ev = self.objects[idx]
+        if ev is None:
+            ev = _kinds[self.kinds[idx]].make_event(self.keys.get(self.key_ids[idx]))
+        return ev
+
+    def _grow(self) -> None:
+        """Doubles the capacity, keeping every record waiting where its position says."""
+        old_mask = self.mask
+        new_capacity = (old_mask + 1)*2
+        LOG.info(f"Growing event ring to {new_capacity} records")
+        kinds = array.array("i", [OBJECT_KIND]) * new_capacity
+        key_ids = array.array("i", [NO_KEY_ID]) * new_capacity
+        capture_times = array.array("d", [0.0]) * new_capacity
+        objects: List[Optional[Event]] = [None] * new_capacity
+        new_mask = new_capacity - 1
+        for pos in range(self.head, self.tail):
+            old_idx = pos & old_mask
+            new_idx = pos & new_mask
+            kinds[new_idx] = self.kinds[old_idx]
+            key_ids[new_idx] = self.key_ids[old_idx]
+            capture_times[new_idx] = self.capture_times[old_idx]
+            objects[new_idx] = self.objects[old_idx]
+        self.kinds = kinds
+        self.key_ids = key_ids
+        self.capture_times = capture_times
+        self.objects = objects
+        self.mask = new_mask
@@ -0,0 +1,198 @@
+"""
+Declarative split rules.
+
+A game lists what it reacts to as SplitRule records: which events, on
+which paths, in which states, and what to do about them. A RuleSet
+compiles these once, when the reactor is made, into dictionaries keyed
+by event class and then by exact path, lowercased file name or
+lowercased extension, so finding the rule for an event costs the same
+no matter how many rules a game has.
+
+When more than one kind of key matches, an exact path beats a file
+name, which beats an extension, which beats a rule with no path at all.
+Among the rules for a key, the first one given whose states include the
+current state is used. If none of them do, the next most specific key
+gets a look, and so on down to the rules with no path. To stop an event
+falling through, give its key a last rule with no states and no actions.
+"""
+import enum
+from pathlib import PurePath
+from typing import Any
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Type
+
+from .interface import Event
+
+
+class RuleAction(enum.Enum):
+    """
+    Something a rule makes the reactor do.
+
+    CANCEL = Cancel the current run
+    START = Start a new run
+    SPLIT = Make a split, keyed by the rule's split key or split prefix
+    FINISH = Finish the current run
+    START_LOADING = Start a loading period for load removal
+    STOP_LOADING = Stop a loading period
+    """
+    CANCEL = enum.auto()
+    START = enum.auto()
+    SPLIT = enum.auto()
+    FINISH = enum.auto()
+    START_LOADING = enum.auto()
+    STOP_LOADING = enum.auto()
+
+
+class SplitRule:
+    """
+    When an event matches, do these actions.
+
+    At most one of path (the exact path), name (the file name, any case)
+    or suffix (the file extension including the dot, any case) can be
+    given. With none of them, the rule matches any event of the type,
+    whether it has a path or not.
+    """
+    __slots__ = (
+        "actions",
+        "event_type",
+        "message",
+        "name",
+        "next_state",
+        "path",
+        "split_key",
+        "split_prefix",
+        "states",
+        "suffix",
+    )
+
+    def __init__(
+        self,
+        event_type: Type[Event],
+        *,
+        path: Optional[PurePath] = None,
+        name: Optional[str] = None,
+        suffix: Optional[str] = None,
+        states: Optional[Iterable[Any]] = None,
+        actions: Sequence[RuleAction] = (),
+        split_key: Optional[str] = None,
+        split_prefix: Optional[str] = None,
+        next_state: Any = None,
+        message: Optional[str] = None,
+    ) -> None:
+        if sum(1 for key in [path, name, suffix] if key is not None) > 1:
+            raise ValueError("a rule can only have one of path, name or suffix")
+        if (RuleAction.SPLIT in actions) and (split_key is None) == (split_prefix is None):
+            raise ValueError("a splitting rule needs exactly one of split_key or split_prefix")
+
+        self.event_type = event_type
+        self.path = path
+        self.name = (name.lower() if name is not None else None)
+        self.suffix = (suffix.lower() if suffix is not None else None)
+        # States this rule applies in, or None for all of them
+        self.states: Optional[FrozenSet[Any]] = (frozenset(states) if states is not None else None)
+        self.actions = list(actions)
+        # The split is keyed by split_key, or by f"{split_prefix}:{lowercased file name}"
+        self.split_key = split_key
+        self.split_prefix = split_prefix
+        # State to move to afterwards, or None to stay in the same state
+        self.next_state = next_state
+        # Logged along with the time afterwards, if given
+        self.message = message
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.event_type.__name__}, path={self.path!r}, name={self.name!r}, suffix={self.suffix!r}, actions={self.actions!r})"
+
+
+class _EventTypeRules:
+    """The compiled rules for one event class."""
+    __slots__ = (
+        "any_path",
+        "by_name",
+        "by_path",
+        "by_suffix",
+        "has_path_keys",
+    )
+
+    def __init__(self) -> None:
+        self.by_path: Dict[str, List[SplitRule]] = {}
+        self.by_name: Dict[str, List[SplitRule]] = {}
+        self.by_suffix: Dict[str, List[SplitRule]] = {}
+        self.any_path: List[SplitRule] = []
+        self.has_path_keys = False
+
+
+def _find_rule_in_state(rules: Optional[List[SplitRule]], state: Any) -> Optional[SplitRule]:
+    """Finds the first of some rules which applies in the given state, if any."""
+    if rules is not None:
+        for rule in rules:
+            if rule.states is None or state in rule.states:
+                return rule
+    return None
+
+
+class RuleSet:
+    """A set of split rules, compiled for fast lookup."""
+    __slots__ = (
+        "_rules_by_class",
+        "_rules_by_event_type",
+    )
+
+    def __init__(self, rules: Sequence[SplitRule]) -> None:
+        self._rules_by_event_type: Dict[type, _EventTypeRules] = {}
+        for rule in rules:
+            table = self._rules_by_event_type.get(rule.event_type)
+            if table is None:
+                table = self._rules_by_event_type[rule.event_type] = _EventTypeRules()
+            if rule.path is not None:
+                table.by_path.setdefault(str(rule.path), []).append(rule)
+            elif rule.name is not None:
+                table.by_name.setdefault(rule.name, []).append(rule)
+            elif rule.suffix is not None:
+                table.by_suffix.setdefault(rule.suffix, []).append(rule)
+            else:
+                table.any_path.append(rule)
+            table.has_path_keys = bool(table.by_path or table.by_name or table.by_suffix)
+
+        # Event classes resolve to the rules of their nearest ruled base class, filled in as they turn up
+        self._rules_by_class: Dict[type, Optional[_EventTypeRules]] = {}
+
+    def find_rule(self, ev: Event, state: Any) -> Optional[SplitRule]:
+        """Finds the rule for an event in the given state, if there is one."""
+        return self.find_rule_for(ev.__class__, getattr(ev, "fpath", None), state)
+
+    def find_rule_for(self, event_type: type, fpath: Optional[PurePath], state: Any) -> Optional[SplitRule]:
+        """Finds the rule for an event of the given class on the given path (if any) in the given state, without needing the event."""
+        try:
+            table = self._rules_by_class[event_type]
+        except KeyError:
+            table = self._resolve_class(event_type)
+        if table is None:
+            return None
+
+        if table.has_path_keys and fpath is not None:
+            rule = _find_rule_in_state(table.by_path.get(str(fpath)), state)
+            if rule is None:
+                name = fpath.name.lower()
+                rule = _find_rule_in_state(table.by_name.get(name), state)
+                if rule is None:
+                    dot_idx = name.rfind(".")
+                    if dot_idx >= 0:
+                        rule = _find_rule_in_state(table.by_suffix.get(name[dot_idx:]), state)
+            if rule is not None:
+                return rule
+        return _find_rule_in_state(table.any_path, state)
+
+    def _resolve_class(self, cls: type) -> Optional[_EventTypeRules]:
+        """Finds the rules for an event class we haven't seen before."""
+        table: Optional[_EventTypeRules] = None
+        for base in cls.__mro__:
+            table = self._rules_by_event_type.get(base)
+            if table is not None:
+                break
+        self._rules_by_class[cls] = table
+        return table
@@ -1,10 +1,26 @@
+"""
+Sources based on the Linux inotify interface.
+
+Everything in the process shares one inotify file descriptor, through
+the INotifyMultiplexer. Each user of it gets an INotifySubscription,
+which only sees the events for its own watches, and has a file
+descriptor of its own to wait on.
+"""
 from abc import ABCMeta
 import logging
+import os
 from pathlib import Path
 from pathlib import PurePath
+import select
+import struct
+import threading
+import time
 from typing import Any
 from typing import Dict
+from typing import Iterable
 from typing import List
+from typing import Optional
+from typing import Set
 from typing import Tuple
 
 import inotify_simple # type: ignore
@@ -12,8 +28,38 @@ from inotify_simple import flags as inotify_flags
 
 from ..interface import Event
 from ..interface import EventSource
+from ..metrics import METRICS
+from ..metrics import STAGE_SOURCE_READ
+from ..records import EventRing
+from ..records import KeyTable
+from ..records import MAX_RING_KEYS
+from ..records import NO_KEY_ID
+from ..records import register_record_kind
+from ..tracing import TRACER
 
 LOG = logging.getLogger("inotify")
+TRACE = TRACER.get_channel("inotify")
+
+# What INotifyEventSource watches for, and nothing more, so the kernel doesn't send us the rest
+WATCH_MASK = (0
+    | inotify_flags.OPEN
+    | inotify_flags.CLOSE_NOWRITE
+    )
+# How many files an INotifyEventSource keeps the events of, before it starts again
+MAX_CACHED_FILES = 4096
+
+# How much to read from the inotify file descriptor at once
+READ_BUFFER_BYTES = 65536
+# How many file names the multiplexer keeps decoded, before it starts again
+MAX_CACHED_NAMES = 4096
+
+# (wd, mask, cookie, name,)
+RawINotifyEvent = Tuple[int, int, int, str]
+
+# struct inotify_event, less the name which follows it
+_EVENT_STRUCT = struct.Struct("iIII")
+# The biggest an event can be, with a name of NAME_MAX bytes and its terminator
+_MAX_EVENT_SIZE = _EVENT_STRUCT.size + 255 + 1
 
 
 class INotifyEvent(Event, metaclass=ABCMeta):
@@ -50,52 +96,401 @@ class CloseUnwriteableFileEvent(CloseFileEvent):
     __slots__ = ()
 
 
+# Record kinds, keyed by path
+OPEN_FILE_KIND = register_record_kind(OpenFileEvent, lambda fpath: OpenFileEvent(fpath=fpath))
+CLOSE_WRITEABLE_FILE_KIND = register_record_kind(CloseWriteableFileEvent, lambda fpath: CloseWriteableFileEvent(fpath=fpath))
+CLOSE_UNWRITEABLE_FILE_KIND = register_record_kind(CloseUnwriteableFileEvent, lambda fpath: CloseUnwriteableFileEvent(fpath=fpath))
+
+
+class INotifyMultiplexer:
+    """
+    One inotify file descriptor, shared by every inotify user in the process.
+
+    Whichever subscription reads first reads for everyone, and hands each
+    event to the subscriptions which asked for it. Any others which got
+    something are woken up through their own file descriptors.
+
+    When subscriptions share a watch, the kernel gets the union of their
+    masks. The mask stays that way until the last of them removes it.
+    """
+    __slots__ = (
+        "_inotify",
+        "_lock",
+        "_masks_by_wd",
+        "_names",
+        "_subscriptions",
+    )
+
+    def __init__(self) -> None:
+        self._inotify = inotify_simple.INotify(nonblocking=True)
+        self._lock = threading.Lock()
+        # File names as they come from the kernel (padding and all), decoded
+        self._names: Dict[bytes, str] = {}
+        # For each watch, the mask each subscription asked for
+        self._masks_by_wd: Dict[int, Dict["INotifySubscription", int]] = {}
+        self._subscriptions: Set["INotifySubscription"] = set()
+
+    def fileno(self) -> int:
+        """Gets the shared inotify file descriptor."""
+        return int(self._inotify.fileno())
+
+    def subscribe(self) -> "INotifySubscription":
+        """Makes a new subscription."""
+        subscription = INotifySubscription(self)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: "INotifySubscription") -> None:
+        """Removes a subscription and all of its watches."""
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            for wd in [wd for wd, masks in self._masks_by_wd.items() if subscription in masks]:
+                self._remove_watch_locked(subscription, wd)
+            subscription._pending = []
+
+    def add_watch(self, subscription: "INotifySubscription", path: str, mask: int) -> int:
+        """Watches a path for a subscription, returning the watch descriptor."""
+        with self._lock:
+            # Whatever anyone else is watching this path for still has to be watched for
+            wd = int(self._inotify.add_watch(path, mask | inotify_flags.MASK_ADD))
+            masks = self._masks_by_wd.setdefault(wd, {})
+            masks[subscription] = masks.get(subscription, 0) | mask
+            return wd
+
+    def remove_watch(self, subscription: "INotifySubscription", wd: int) -> None:
+        """Stops watching something for a subscription."""
+        with self._lock:
+            self._remove_watch_locked(subscription, wd)
+
+    def _remove_watch_locked(self, subscription: "INotifySubscription", wd: int) -> None:
+        masks = self._masks_by_wd.get(wd)
+        if masks is None or masks.pop(subscription, None) is None:
+            return
+        if not masks:
+            del self._masks_by_wd[wd]
+            try:
+                self._inotify.rm_watch(wd)
+            except OSError:
+                # Already gone along with its file
+                pass
+
+    def read(self, subscription: "INotifySubscription") -> List[RawINotifyEvent]:
+        """Reads whatever is waiting, and takes the events for one subscription."""
+        with self._lock:
+            subscription._clear_wake()
+
+            masks_by_wd = self._masks_by_wd
+            for raw_event in self._read_raw_events():
+                wd, mask, cookie, name = raw_event
+                masks = masks_by_wd.get(wd)
+                if masks is None:
+                    if (mask & inotify_flags.Q_OVERFLOW) != 0:
+                        LOG.warning("inotify queue overflowed, some events have been lost")
+                    continue
+                for other, other_mask in masks.items():
+                    if (mask & other_mask) != 0:
+                        other._pending.append(raw_event)
+                if (mask & inotify_flags.IGNORED) != 0:
+                    # The watch is gone, e.g. along with its file
+                    del masks_by_wd[wd]
+
+            for other in self._subscriptions:
+                if other._pending and other is not subscription:
+                    other._wake()
+
+            pending = subscription._pending
+            subscription._pending = []
+            return pending
+
+    def _read_raw_events(self) -> List[RawINotifyEvent]:
+        """Reads every event waiting on the inotify file descriptor."""
+        raw_events: List[RawINotifyEvent] = []
+        names = self._names
+        unpack_from = _EVENT_STRUCT.unpack_from
+        header_size = _EVENT_STRUCT.size
+        fd = self._inotify.fileno()
+        while True:
+            try:
+                data = os.read(fd, READ_BUFFER_BYTES)
+            except BlockingIOError:
+                break
+
+            pos = 0
+            data_len = len(data)
+            while pos < data_len:
+                wd, mask, cookie, name_size = unpack_from(data, pos)
+                pos += header_size
+                name = ""
+                if name_size != 0:
+                    raw_name = data[pos:pos+name_size]
+                    pos += name_size
+                    name = names.get(raw_name, "")
+                    if not name:
+                        if len(names) >= MAX_CACHED_NAMES:
+                            names.clear()
+                        name = names[raw_name] = os.fsdecode(raw_name.rstrip(b"\x00"))
+                raw_events.append((wd, mask, cookie, name,))
+
+            if data_len < READ_BUFFER_BYTES - _MAX_EVENT_SIZE:
+                # Short read, so that was everything
+                break
+
+        return raw_events
+
+
+_multiplexer: Optional[INotifyMultiplexer] = None
+_multiplexer_lock = threading.Lock()
+
+
+def get_inotify_multiplexer() -> INotifyMultiplexer:
+    """Gets the inotify multiplexer for this process, making it if necessary."""
+    global _multiplexer
+    with _multiplexer_lock:
+        if _multiplexer is None:
+            _multiplexer = INotifyMultiplexer()
+        return _multiplexer
+
+
+class INotifySubscription:
+    """
+    One user's share of the inotify multiplexer.
+
+    Its file descriptor becomes readable when the shared inotify file
+    descriptor does, or when another subscription has read some events
+    for this one.
+    """
+    __slots__ = (
+        "_epoll",
+        "_is_wake_pending",
+        "_multiplexer",
+        "_pending",
+        "_wake_read_fd",
+        "_wake_write_fd",
+    )
+
+    def __init__(self, multiplexer: INotifyMultiplexer) -> None:
+        self._multiplexer = multiplexer
+        # Events read for this subscription which it hasn't taken yet
+        self._pending: List[RawINotifyEvent] = []
+        self._wake_read_fd, self._wake_write_fd = os.pipe()
+        os.set_blocking(self._wake_read_fd, False)
+        os.set_blocking(self._wake_write_fd, False)
+        self._is_wake_pending = False
+        self._epoll = select.epoll()
+        self._epoll.register(multiplexer.fileno(), select.EPOLLIN)
+        self._epoll.register(self._wake_read_fd, select.EPOLLIN)
+
+    def close(self) -> None:
+        """Removes all of this subscription's watches, and closes it."""
+        self._multiplexer.unsubscribe(self)
+        self._epoll.close()
+        os.close(self._wake_read_fd)
+        os.close(self._wake_write_fd)
+
+    def fileno(self) -> int:
+        """Gets a file descriptor which becomes readable when there might be events."""
+        return int(self._epoll.fileno())
+
+    def add_watch(self, path: str, mask: int) -> int:
+        """Watches a path, returning the watch descriptor."""
+        return self._multiplexer.add_watch(self, path, mask)
+
+    def remove_watch(self, wd: int) -> None:
+        """Stops watching something."""
+        self._multiplexer.remove_watch(self, wd)
+
+    def read(self) -> List[RawINotifyEvent]:
+        """Takes every event waiting for this subscription, as (wd, mask, cookie, name,)."""
+        return self._multiplexer.read(self)
+
+    def wake(self) -> None:
+        """Makes our file descriptor readable, so the next read happens soon."""
+        with self._multiplexer._lock:
+            self._wake()
+
+    def _wake(self) -> None:
+        if not self._is_wake_pending:
+            try:
+                os.write(self._wake_write_fd, b"\x00")
+            except BlockingIOError:
+                pass
+            self._is_wake_pending = True
+
+    def _clear_wake(self) -> None:
+        if self._is_wake_pending:
+            try:
+                os.read(self._wake_read_fd, 4096)
+            except BlockingIOError:
+                pass
+            self._is_wake_pending = False
+
+
 class INotifyEventSource(EventSource):
-    """An event source based on the Linux inotify interface."""
+    """
+    An event source based on the Linux inotify interface.
+
+    Files whose names are in ignore_names (any case) are dropped before
+    anything is made for them. Other files get their path interned, and
+    events written as records keyed by it. pull_events() hands out events
+    made once per file, so don't change them.
+
+    A file which is opened and closed over and over within one read only
+    gives one open and close, as the rest would all have the same time.
+    """
     __slots__ = (
-        "_fpaths",
+        "_cached_file_count",
+        "_events_by_kind",
         "_fpath_by_id",
-        "_inotify",
+        "_fpaths",
+        "_ignore_names",
+        "_key_ids_by_wd",
+        "_keys",
+        "_keys_generation",
+        "_ring",
+        "_subscription",
     )
 
-    def __init__(self, fpaths: List[PurePath]) -> None:
+    def __init__(self, fpaths: List[PurePath], *, ignore_names: Iterable[str] = ()) -> None:
         self._fpaths = list(fpaths)
         self._fpath_by_id: Dict[int, Path] = {}
-        self._inotify = inotify_simple.INotify()
+        self._ignore_names = frozenset(name.lower() for name in ignore_names)
+        # For each watch, the key ID of each file's path, or NO_KEY_ID if it's ignored
+        self._key_ids_by_wd: Dict[int, Dict[str, int]] = {}
+        # For each record kind, the event of each file's key ID, for pull_events()
+        self._events_by_kind: Dict[int, Dict[int, Event]] = {
+            OPEN_FILE_KIND: {},
+            CLOSE_WRITEABLE_FILE_KIND: {},
+            CLOSE_UNWRITEABLE_FILE_KIND: {},
+        }
+        self._cached_file_count = 0
+        # The key table the cached key IDs are from, and its generation then
+        self._keys: Optional[KeyTable] = None
+        self._keys_generation = 0
+        # What pull_events() pulls records into
+        self._ring = EventRing()
+        self._subscription = get_inotify_multiplexer().subscribe()
         for fpath in self._fpaths:
             LOG.info(f"Resolving {fpath!r}")
             real_path = Path(fpath).resolve(strict=True)
             LOG.info(f"Watching {real_path!r}")
-            watch_id = self._inotify.add_watch(str(real_path),
-                (0
-                    | inotify_flags.OPEN
-                    | inotify_flags.CLOSE_NOWRITE
-                    ),
-            )
-            LOG.debug(f"Watch ID = {watch_id!r}")
+            mask = WATCH_MASK
+            if real_path.is_dir():
+                # Files which have been deleted but are still open don't concern us
+                mask |= inotify_flags.EXCL_UNLINK
+            watch_id = self._subscription.add_watch(str(real_path), mask)
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug(f"Watch ID = {watch_id!r}")
             self._fpath_by_id[watch_id] = real_path
+            self._key_ids_by_wd[watch_id] = {}
+
+    def close(self) -> None:
+        """Stops watching everything."""
+        self._subscription.close()
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return self._subscription.fileno()
 
     # Implementation
     def pull_events(self) -> List[Event]:
+        ring = self._ring
+        self.pull_records(ring)
+        begin, end = ring.take()
         events: List[Event] = []
+        events_by_kind = self._events_by_kind
+        for pos in range(begin, end):
+            idx = pos & ring.mask
+            ev = events_by_kind[ring.kinds[idx]].get(ring.key_ids[idx])
+            if ev is None:
+                # The cache got cleared part way through this pull
+                ev = ring.get_event(idx)
+            events.append(ev)
+        if len(ring.keys) > MAX_RING_KEYS:
+            # Nothing else is using our ring, so it can be cleared as soon as it's read
+            ring.keys.clear()
+        return events
 
-        # wd, mask, cookie, name
-        raw_events: List[Tuple[int, int, int, str]] = list(self._inotify.read(timeout=0))
+    # Implementation
+    def pull_records(self, ring: EventRing) -> int:
+        time_beg = time.perf_counter()
+        raw_events = self._subscription.read()
+        is_debug = LOG.isEnabledFor(logging.DEBUG)
+        keys = ring.keys
+        if keys is not self._keys or keys.generation != self._keys_generation:
+            # Our key IDs aren't from this ring's keys as they are now
+            self._clear_file_cache()
+            self._keys = keys
+            self._keys_generation = keys.generation
+        key_ids_by_wd = self._key_ids_by_wd
+        begin = ring.tail
         for raw_event in raw_events:
             wd, mask, cookie, name = raw_event
-            
+
             # Ignore directory reads for now --GM
             if (mask & inotify_flags.ISDIR) != 0:
                 continue
 
-            path = self._fpath_by_id[wd] / name
-            LOG.debug(f"ev: {mask:08X} {cookie:08X} {path!r}")
+            key_id = key_ids_by_wd[wd].get(name)
+            if key_id is None:
+                key_id = self._add_file(wd, name, keys)
+            if key_id == NO_KEY_ID:
+                continue
+            if is_debug:
+                LOG.debug(f"ev: {mask:08X} {cookie:08X} {keys.get(key_id)!r}")
 
             if (mask & inotify_flags.OPEN) != 0:
-                events.append(OpenFileEvent(fpath=path))
+                ring.push(OPEN_FILE_KIND, key_id, time_beg)
             if (mask & inotify_flags.CLOSE_WRITE) != 0:
-                events.append(CloseWriteableFileEvent(fpath=path))
+                ring.push(CLOSE_WRITEABLE_FILE_KIND, key_id, time_beg)
             if (mask & inotify_flags.CLOSE_NOWRITE) != 0:
-                events.append(CloseUnwriteableFileEvent(fpath=path))
-                
-        return events
+                if ring.tail - begin >= 3 and _is_repeated_open(ring, key_id):
+                    # Same open and close as just before, which changes nothing
+                    ring.drop_last()
+                else:
+                    ring.push(CLOSE_UNWRITEABLE_FILE_KIND, key_id, time_beg)
+
+        record_count = ring.tail - begin
+        if record_count != 0 and METRICS.enabled:
+            METRICS.record_since(STAGE_SOURCE_READ, time_beg)
+        if TRACE.enabled and raw_events:
+            TRACE.event("pull", raw_events=len(raw_events), records=record_count, duration=(time.perf_counter() - time_beg))
+        return record_count
+
+    def _add_file(self, wd: int, name: str, keys: KeyTable) -> int:
+        """Gets the key ID in keys of a file we haven't seen before, or NO_KEY_ID if it's ignored."""
+        if self._cached_file_count >= MAX_CACHED_FILES:
+            # Something is churning through file names, so start again rather than grow forever
+            self._clear_file_cache()
+
+        key_id = NO_KEY_ID
+        if name.lower() not in self._ignore_names:
+            path = self._fpath_by_id[wd] / name
+            key_id = keys.intern(path)
+            self._events_by_kind[OPEN_FILE_KIND][key_id] = OpenFileEvent(fpath=path)
+            self._events_by_kind[CLOSE_WRITEABLE_FILE_KIND][key_id] = CloseWriteableFileEvent(fpath=path)
+            self._events_by_kind[CLOSE_UNWRITEABLE_FILE_KIND][key_id] = CloseUnwriteableFileEvent(fpath=path)
+        self._key_ids_by_wd[wd][name] = key_id
+        self._cached_file_count += 1
+        return key_id
+
+    def _clear_file_cache(self) -> None:
+        """Forgets the key ID and events of every file seen so far."""
+        for key_ids_by_name in self._key_ids_by_wd.values():
+            key_ids_by_name.clear()
+        for events_by_key_id in self._events_by_kind.values():
+            events_by_key_id.clear()
+        self._cached_file_count = 0
+
+
+def _is_repeated_open(ring: EventRing, key_id: int) -> bool:
+    """Were the last three records an open, close and open of this file?"""
+    mask = ring.mask
+    tail = ring.tail
+    kinds = ring.kinds
+    key_ids = ring.key_ids
+    return (True
+        and kinds[(tail-1) & mask] == OPEN_FILE_KIND and key_ids[(tail-1) & mask] == key_id
+        and kinds[(tail-2) & mask] == CLOSE_UNWRITEABLE_FILE_KIND and key_ids[(tail-2) & mask] == key_id
+        and kinds[(tail-3) & mask] == OPEN_FILE_KIND and key_ids[(tail-3) & mask] == key_id
+    )
@@ -0,0 +1,307 @@
+"""
+Log file tailing, with regexes.
+
+All of a game's patterns are combined into one regex, each followed by
+a marker group of its own, so a chunk of the log is scanned once no matter how
+many patterns there are. Only the pattern which matched is run again,
+on just the matched text, to pull out its named groups.
+
+Patterns are matched against whole chunks of complete lines with
+re.MULTILINE, so ^ and $ work on lines. They shouldn't match across
+newlines.
+
+Patterns can't refer back to their own groups: not with numbered
+backreferences (\\1), named ones ((?P=name)), or conditionals
+((?(1)...)). In the combined regex their groups are renumbered and lose
+their names, so those would quietly match the wrong thing. Patterns
+which do are rejected with ValueError.
+"""
+import io
+import logging
+import os
+from pathlib import Path
+from pathlib import PurePath
+import re
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from inotify_simple import flags as inotify_flags
+
+from ..interface import Event
+from ..interface import EventSource
+from .inotify import get_inotify_multiplexer
+from ..metrics import METRICS
+from ..metrics import STAGE_SOURCE_READ
+
+LOG = logging.getLogger("logtail")
+
+# How many bytes of log get read in one pull, so a chatty game can't starve the tick
+DEFAULT_MAX_PULL_BYTES = 65536
+
+# Named groups get turned into plain groups in the combined regex, as names can't repeat
+_NAMED_GROUP_RE = re.compile(r"(?<!\\)\(\?P<\w+>")
+# Ways of referring back to a group, which can't work in the combined regex
+_GROUP_REFERENCE_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+# Global flags have to come first, so they get turned into scoped flags in the combined regex
+_GLOBAL_FLAGS_RE = re.compile(r"^\(\?([aiLmsux]+)\)")
+
+
+class LogMatchEvent(Event):
+    """A line in a log matched one of the patterns."""
+    __slots__ = (
+        "fields",
+        "fpath",
+        "pattern_key",
+    )
+
+    def __init__(self, *, fpath: PurePath, pattern_key: str, fields: Dict[str, Optional[str]]) -> None:
+        self.fpath: PurePath = fpath
+        self.pattern_key = pattern_key
+        # The named groups of the pattern, None if a group didn't take part in the match
+        self.fields = fields
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ == self.__class__:
+            if other.fpath == self.fpath and other.pattern_key == self.pattern_key and other.fields == self.fields:
+                return True
+
+        return False
+
+
+class LogPatternSet:
+    """A set of log patterns, matched with one combined regex."""
+    __slots__ = (
+        "_combined",
+        "_keys",
+        "_patterns",
+    )
+
+    def __init__(self, patterns: Dict[str, str]) -> None:
+        for key, pattern in patterns.items():
+            reference = _find_group_reference(pattern)
+            if reference is not None:
+                raise ValueError(f"Log pattern {key!r} refers back to a group with {reference!r}, which can't be combined with other patterns")
+        self._keys = list(patterns.keys())
+        self._patterns = [
+            re.compile(pattern, re.MULTILINE)
+            for pattern in patterns.values()
+        ]
+        # Each alternative ends in an empty marker group rather than being wrapped in one,
+        # so re can still pull out common prefixes and skip ahead on first characters
+        alternatives = [
+            f"(?:{_to_combinable(pattern)})(?P<_p{i}>)"
+            for i, pattern in enumerate(patterns.values())
+        ]
+        self._combined = re.compile("|".join(alternatives), re.MULTILINE)
+
+    def find_matches(self, text: str) -> Iterator[Tuple[str, Dict[str, Optional[str]]]]:
+        """Finds every match in some text, as (pattern_key, fields,)."""
+        patterns = self._patterns
+        keys = self._keys
+        for m in self._combined.finditer(text):
+            # The marker group closes last, so it's the one we get here
+            idx = int(m.lastgroup[2:])
+            sub = patterns[idx].match(text, m.start(), m.end())
+            yield (keys[idx], (sub.groupdict() if sub is not None else {}),)
+
+
+def _find_group_reference(pattern: str) -> Optional[str]:
+    """Finds a reference back to a group in a pattern, outside character classes, or None."""
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        c = pattern[i]
+        if not in_class:
+            m = _GROUP_REFERENCE_RE.match(pattern, i)
+            if m is not None:
+                return m.group(0)
+        if c == "\\":
+            # Skip whatever is escaped
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+            # A ] straight after the [ or [^ is part of the class
+            i += 1
+            if pattern.startswith("^", i):
+                i += 1
+            if pattern.startswith("]", i):
+                i += 1
+            continue
+        i += 1
+    return None
+
+
+def _to_combinable(pattern: str) -> str:
+    """Rewrites a pattern so it can go in a combined regex."""
+    pattern = _NAMED_GROUP_RE.sub("(?:", pattern)
+    m = _GLOBAL_FLAGS_RE.match(pattern)
+    if m is not None:
+        pattern = f"(?{m.group(1)}:{pattern[m.end():]})"
+    return pattern
+
+
+class LogTailEventSource(EventSource):
+    """
+    An event source which follows a log file as it gets written, based on the Linux inotify interface.
+
+    Only newly appended bytes are read, from where the last read left off,
+    into a buffer which is reused. If the file gets rotated, the rest of
+    the old file is read before moving to the new one. If it gets
+    truncated, reading starts again from the top.
+    """
+    __slots__ = (
+        "_buf",
+        "_buf_used",
+        "_buf_view",
+        "_f",
+        "_file_wd",
+        "_fpath",
+        "_max_pull_bytes",
+        "_offset",
+        "_patterns",
+        "_subscription",
+    )
+
+    def __init__(self, fpath: PurePath, patterns: Dict[str, str], *, from_start: bool = False, max_pull_bytes: int = DEFAULT_MAX_PULL_BYTES) -> None:
+        self._fpath = Path(fpath)
+        self._patterns = LogPatternSet(patterns)
+        self._max_pull_bytes = max_pull_bytes
+        self._buf = bytearray(max_pull_bytes)
+        self._buf_view = memoryview(self._buf)
+        self._buf_used = 0
+        self._f: Optional[io.FileIO] = None
+        self._file_wd: Optional[int] = None
+        self._offset = 0
+
+        self._subscription = get_inotify_multiplexer().subscribe()
+        real_dir = self._fpath.parent.resolve(strict=True)
+        LOG.info(f"Watching {real_dir!r} for {self._fpath.name!r}")
+        # Catches the log being created or rotated
+        self._subscription.add_watch(str(real_dir),
+            (0
+                | inotify_flags.CREATE
+                | inotify_flags.MOVED_TO
+                ),
+        )
+
+        if self._open(from_start=from_start):
+            LOG.info(f"Tailing {self._fpath!r} from offset {self._offset}")
+
+    def close(self) -> None:
+        """Closes the log and stops watching it."""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self._subscription.close()
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return self._subscription.fileno()
+
+    def pull_events(self) -> List[Event]:
+        events: List[Event] = []
+
+        time_beg = time.perf_counter()
+        # What the events were doesn't matter, just that something happened
+        self._subscription.read()
+
+        budget = self._max_pull_bytes
+        while budget > 0:
+            f = self._f
+            if f is None:
+                if not self._open(from_start=True):
+                    break
+                LOG.info(f"Log {self._fpath!r} appeared")
+                continue
+
+            space = min(len(self._buf) - self._buf_used, budget)
+            read_count = f.readinto(self._buf_view[self._buf_used:self._buf_used+space])
+            if not read_count:
+                if not self._check_replaced(events):
+                    break
+                continue
+
+            self._offset += read_count
+            self._buf_used += read_count
+            budget -= read_count
+            self._match_lines(events, is_final=False)
+
+        if budget <= 0:
+            # There's more to read, which inotify won't tell us about
+            self._subscription.wake()
+
+        if events and METRICS.enabled:
+            METRICS.record_since(STAGE_SOURCE_READ, time_beg)
+        return events
+
+    def _open(self, *, from_start: bool) -> bool:
+        """Opens the log if it exists, starting at the top or the end."""
+        try:
+            f = io.FileIO(self._fpath, "rb")
+        except FileNotFoundError:
+            return False
+
+        if self._file_wd is not None:
+            self._subscription.remove_watch(self._file_wd)
+        self._file_wd = self._subscription.add_watch(str(self._fpath), inotify_flags.MODIFY)
+        self._f = f
+        self._offset = (0 if from_start else f.seek(0, os.SEEK_END))
+        self._buf_used = 0
+        return True
+
+    def _check_replaced(self, events: List[Event]) -> bool:
+        """
+        Checks, at the end of the log, whether it has been rotated or truncated.
+
+        Returns True if there is something new to read.
+        """
+        assert self._f is not None
+        try:
+            st = os.stat(self._fpath)
+        except FileNotFoundError:
+            # Moved away, and the new one isn't there yet
+            return False
+        fst = os.fstat(self._f.fileno())
+
+        if (st.st_ino, st.st_dev,) != (fst.st_ino, fst.st_dev,):
+            LOG.info(f"Log {self._fpath!r} was rotated")
+            self._match_lines(events, is_final=True)
+            self._f.close()
+            self._f = None
+            return self._open(from_start=True)
+
+        if fst.st_size < self._offset:
+            LOG.info(f"Log {self._fpath!r} was truncated")
+            self._f.seek(0)
+            self._offset = 0
+            self._buf_used = 0
+            return True
+
+        return False
+
+    def _match_lines(self, events: List[Event], *, is_final: bool) -> None:
+        """Matches the complete lines in the buffer, and keeps what's left for next time."""
+        used = self._buf_used
+        end = self._buf.rfind(b"\n", 0, used) + 1
+        if end == 0 and (is_final or used == len(self._buf)):
+            # Take whatever we have, the line isn't going to get any more complete
+            end = used
+        if end == 0:
+            return
+
+        text = str(self._buf_view[:end], "utf-8", "replace")
+        for pattern_key, fields in self._patterns.find_matches(text):
+            events.append(LogMatchEvent(fpath=self._fpath, pattern_key=pattern_key, fields=fields))
+
+        remaining = used - end
+        self._buf[:remaining] = self._buf[end:used]
+        self._buf_used = remaining
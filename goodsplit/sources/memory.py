@@ -0,0 +1,564 @@
+"""
+Reading another process's memory, on Linux.
+
+A game declares a set of watches, each a pointer path in the same style
+as LiveSplit's DeepPointer: start at a module's base address (or zero),
+add the first offset, then for each further offset read a pointer there
+and add the offset to it. The value being watched is at the end.
+
+Every poll reads everything in one process_vm_readv call: the value at
+the end of each path, along with every pointer cell on the way there.
+Those cells are compared against what they held when the path was last
+walked, and only a path where one of them has changed gets walked again.
+
+Where process_vm_readv isn't available, /proc/<pid>/mem is read instead,
+one region at a time.
+
+Reading another process needs ptrace access to it. With the usual Yama
+setting of ptrace_scope=1, that means a child of ours or root, unless
+ptrace_scope is set to 0.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+from pathlib import Path
+import re
+import struct
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from ..interface import Event
+from ..interface import EventSource
+from ..metrics import METRICS
+from ..metrics import STAGE_SOURCE_READ
+
+LOG = logging.getLogger("memory")
+
+# How often to read the watches, at most
+DEFAULT_POLL_INTERVAL = 0.01
+# How often to look for the process, or for modules which haven't been loaded yet
+ATTACH_RETRY_INTERVAL = 1.0
+# The most regions process_vm_readv takes in one call (IOV_MAX)
+MAX_REGIONS_PER_CALL = 1024
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+def _load_process_vm_readv() -> Any:
+    """Gets process_vm_readv from libc, if it has it."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.process_vm_readv
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [
+        ctypes.c_int,
+        ctypes.c_void_p, ctypes.c_ulong,
+        ctypes.c_void_p, ctypes.c_ulong,
+        ctypes.c_ulong,
+    ]
+    func.restype = ctypes.c_ssize_t
+    return func
+
+
+_process_vm_readv = _load_process_vm_readv()
+
+
+class ProcessAttachEvent(Event):
+    """A memory event source found its process."""
+    __slots__ = (
+        "pid",
+    )
+
+    def __init__(self, *, pid: int) -> None:
+        self.pid = pid
+
+    def __eq__(self, other: Any) -> bool:
+        return other.__class__ == self.__class__ and other.pid == self.pid
+
+
+class ProcessDetachEvent(Event):
+    """A memory event source lost its process."""
+    __slots__ = (
+        "pid",
+    )
+
+    def __init__(self, *, pid: int) -> None:
+        self.pid = pid
+
+    def __eq__(self, other: Any) -> bool:
+        return other.__class__ == self.__class__ and other.pid == self.pid
+
+
+class MemoryValueEvent(Event):
+    """A watched value changed. The value is None if it can't currently be read."""
+    __slots__ = (
+        "key",
+        "value",
+    )
+
+    def __init__(self, *, key: str, value: Any) -> None:
+        self.key = key
+        self.value = value
+
+    def __eq__(self, other: Any) -> bool:
+        return other.__class__ == self.__class__ and other.key == self.key and other.value == self.value
+
+
+class MemoryWatch:
+    """
+    A value to watch, at the end of a pointer path.
+
+    fmt is a struct format for a single value, e.g. "<i" or "<f". If it
+    ends in "s", e.g. "32s", the value is a NUL-terminated string.
+    """
+    __slots__ = (
+        "fmt",
+        "is_string",
+        "key",
+        "module",
+        "offsets",
+        "size",
+        "value_struct",
+    )
+
+    def __init__(self, key: str, offsets: Sequence[int], *, fmt: str = "<i", module: Optional[str] = None) -> None:
+        if not offsets:
+            raise ValueError(f"Watch {key!r} needs at least one offset")
+        self.key = key
+        self.offsets = list(offsets)
+        self.fmt = fmt
+        self.value_struct = struct.Struct(fmt)
+        self.size = self.value_struct.size
+        self.is_string = fmt.endswith("s")
+        # Module whose base address the path starts from, or None to start from zero
+        self.module = module
+
+    def decode(self, buf: Any, offset: int) -> Any:
+        """Decodes this watch's value from a buffer."""
+        value = self.value_struct.unpack_from(buf, offset)[0]
+        if self.is_string:
+            return value.split(b"\x00", 1)[0].decode("utf-8", "replace")
+        return value
+
+
+class ProcessMemoryReader:
+    """Reads batches of regions from another process's memory."""
+    __slots__ = (
+        "_buf",
+        "_ends",
+        "_iovecs",
+        "_local_iovec",
+        "_mem_fd",
+        "_offsets",
+        "_regions",
+        "pid",
+    )
+
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self._buf = ctypes.create_string_buffer(0)
+        self._iovecs = (_IOVec * 0)()
+        self._local_iovec = _IOVec()
+        self._mem_fd: Optional[int] = None
+        # The layout of the last batch, which gets reused if the same list is passed in again
+        self._regions: Optional[Sequence[Tuple[int, int]]] = None
+        self._offsets: List[int] = []
+        self._ends: List[int] = []
+        if _process_vm_readv is None:
+            self._open_mem()
+
+    def close(self) -> None:
+        """Closes /proc/<pid>/mem if we were using it."""
+        if self._mem_fd is not None:
+            os.close(self._mem_fd)
+            self._mem_fd = None
+
+    def read_regions(self, regions: Sequence[Tuple[int, int]]) -> Tuple[Any, List[Optional[int]]]:
+        """
+        Reads a batch of (address, size,) regions.
+
+        Returns (buf, offsets,), where offsets[i] is where region i ended up
+        in buf, or None if it couldn't be read. buf gets reused by the
+        next read.
+
+        Passing the same list as last time skips setting the batch up again,
+        so don't change a list after passing it in.
+
+        Raises ProcessLookupError if the process has gone away.
+        """
+        if regions is not self._regions:
+            self._set_regions(regions)
+        offsets: List[Optional[int]] = list(self._offsets)
+
+        if self._mem_fd is None:
+            self._read_regions_vm(regions, offsets)
+        if self._mem_fd is not None:
+            self._read_regions_mem(regions, offsets)
+        return (self._buf, offsets,)
+
+    def _set_regions(self, regions: Sequence[Tuple[int, int]]) -> None:
+        """Sets up the buffer and iovecs for a new batch layout."""
+        self._regions = regions
+        self._offsets = []
+        self._ends = []
+        offset = 0
+        for address, size in regions:
+            self._offsets.append(offset)
+            offset += size
+            self._ends.append(offset)
+        if len(self._buf) < offset:
+            self._buf = ctypes.create_string_buffer(offset)
+
+        if len(self._iovecs) < len(regions):
+            self._iovecs = (_IOVec * len(regions))()
+        iovecs = self._iovecs
+        for i, (address, size) in enumerate(regions):
+            iovecs[i].iov_base = address
+            iovecs[i].iov_len = size
+
+    def _read_regions_vm(self, regions: Sequence[Tuple[int, int]], offsets: List[Optional[int]]) -> None:
+        """Reads with process_vm_readv, as few calls as possible."""
+        iovecs = self._iovecs
+        buf_address = ctypes.addressof(self._buf)
+
+        idx = 0
+        while idx < len(regions):
+            count = min(len(regions) - idx, MAX_REGIONS_PER_CALL)
+            beg_offset = self._offsets[idx]
+            self._local_iovec.iov_base = buf_address + beg_offset
+            self._local_iovec.iov_len = self._ends[idx+count-1] - beg_offset
+            result = _process_vm_readv(self.pid,
+                ctypes.addressof(self._local_iovec), 1,
+                ctypes.addressof(iovecs) + idx*ctypes.sizeof(_IOVec), count,
+                0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.ESRCH:
+                    raise ProcessLookupError(err, os.strerror(err))
+                elif err == errno.EFAULT:
+                    # The first region isn't mapped, so skip it and carry on
+                    result = 0
+                else:
+                    LOG.warning(f"process_vm_readv failed ({os.strerror(err)}), falling back to /proc/{self.pid}/mem")
+                    self._open_mem()
+                    return
+
+            # Reading stops at the first region which couldn't be read in full
+            done = 0
+            while done < count and result >= regions[idx+done][1]:
+                result -= regions[idx+done][1]
+                done += 1
+            idx += done
+            if done < count:
+                offsets[idx] = None
+                idx += 1
+
+    def _read_regions_mem(self, regions: Sequence[Tuple[int, int]], offsets: List[Optional[int]]) -> None:
+        """Reads from /proc/<pid>/mem, one region at a time."""
+        assert self._mem_fd is not None
+        view = memoryview(self._buf).cast("B")
+        for i, (address, size) in enumerate(regions):
+            offset = offsets[i]
+            if offset is None:
+                continue
+            try:
+                data = os.pread(self._mem_fd, size, address)
+            except OSError:
+                data = b""
+            if len(data) != size:
+                if not Path(f"/proc/{self.pid}").exists():
+                    raise ProcessLookupError(errno.ESRCH, os.strerror(errno.ESRCH))
+                offsets[i] = None
+                continue
+            view[offset:offset+size] = data
+
+    def _open_mem(self) -> None:
+        """Switches to reading /proc/<pid>/mem."""
+        try:
+            self._mem_fd = os.open(f"/proc/{self.pid}/mem", os.O_RDONLY)
+        except FileNotFoundError:
+            raise ProcessLookupError(errno.ESRCH, os.strerror(errno.ESRCH))
+
+
+class _WatchState:
+    """Where a watch was last resolved to, and what it last read."""
+    __slots__ = (
+        "cells",
+        "last_value",
+        "value_address",
+        "watch",
+    )
+
+    def __init__(self, watch: MemoryWatch) -> None:
+        self.watch = watch
+        # (address, pointer_value,) for every pointer read on the way, pointer_value None if unreadable
+        self.cells: List[Tuple[int, Optional[int]]] = []
+        self.value_address: Optional[int] = None
+        self.last_value: Any = None
+
+
+def find_process_ids(name: str) -> List[int]:
+    """
+    Finds processes by name, matching either the command name or the
+    executable in the first argument (so Wine games can be found by their
+    .exe name). Not case sensitive.
+    """
+    name = name.lower()
+    pids: List[int] = []
+    for proc_dir in Path("/proc").iterdir():
+        if not proc_dir.name.isdigit():
+            continue
+        try:
+            comm = (proc_dir / "comm").read_text().strip().lower()
+            argv0 = (proc_dir / "cmdline").read_bytes().split(b"\x00", 1)[0].decode("utf-8", "replace")
+        except OSError:
+            continue
+        exe_name = re.split(r"[/\\]", argv0)[-1].lower()
+        if comm == name[:15] or exe_name == name:
+            pids.append(int(proc_dir.name))
+    return sorted(pids)
+
+
+def find_module_bases(pid: int) -> Dict[str, int]:
+    """Gets the lowest address each file is mapped at in a process, keyed by lowercased file name."""
+    bases: Dict[str, int] = {}
+    with open(f"/proc/{pid}/maps", "r") as f:
+        for line in f:
+            fields = line.split(None, 5)
+            if len(fields) < 6:
+                continue
+            module = re.split(r"[/\\]", fields[5].strip())[-1].lower()
+            address = int(fields[0].split("-", 1)[0], 16)
+            if module not in bases or address < bases[module]:
+                bases[module] = address
+    return bases
+
+
+class MemoryEventSource(EventSource):
+    """
+    An event source which watches values in another process's memory.
+
+    The process is found by pid or by name, and is looked for again if it
+    goes away. This can't be waited on, so it gets polled, but reads at
+    most once per poll_interval.
+    """
+    __slots__ = (
+        "_last_attach_time",
+        "_last_poll_time",
+        "_missing_modules",
+        "_module_bases",
+        "_pid",
+        "_pointer_size",
+        "_pointer_struct",
+        "_poll_interval",
+        "_process_name",
+        "_reader",
+        "_regions",
+        "_states",
+    )
+
+    def __init__(self, watches: List[MemoryWatch], *, pid: Optional[int] = None, process_name: Optional[str] = None, pointer_size: int = 8, poll_interval: float = DEFAULT_POLL_INTERVAL) -> None:
+        if (pid is None) == (process_name is None):
+            raise ValueError("Need exactly one of pid and process_name")
+        self._pid = pid
+        self._process_name = process_name
+        self._pointer_size = pointer_size
+        self._pointer_struct = struct.Struct({4: "<I", 8: "<Q"}[pointer_size])
+        self._poll_interval = poll_interval
+        self._states = [_WatchState(watch) for watch in watches]
+        self._reader: Optional[ProcessMemoryReader] = None
+        self._module_bases: Dict[str, int] = {}
+        self._missing_modules = False
+        self._last_attach_time: Optional[float] = None
+        self._last_poll_time: Optional[float] = None
+        # What gets read on each poll, rebuilt whenever a path gets walked
+        self._regions: Optional[List[Tuple[int, int]]] = None
+
+    def close(self) -> None:
+        """Lets go of the process."""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def get_pid(self) -> Optional[int]:
+        """Gets the pid of the process we're attached to, if any."""
+        return (self._reader.pid if self._reader is not None else None)
+
+    # Implementation
+    def pull_events(self) -> List[Event]:
+        events: List[Event] = []
+
+        now = time.monotonic()
+        if self._last_poll_time is not None and now - self._last_poll_time < self._poll_interval:
+            return events
+        self._last_poll_time = now
+
+        time_beg = time.perf_counter()
+        retry_due = (self._last_attach_time is None or now - self._last_attach_time >= ATTACH_RETRY_INTERVAL)
+        if self._reader is None:
+            if not retry_due:
+                return events
+            self._last_attach_time = now
+            if not self._attach():
+                return events
+            assert self._reader is not None
+            events.append(ProcessAttachEvent(pid=self._reader.pid))
+        elif self._missing_modules and retry_due:
+            self._last_attach_time = now
+            try:
+                self._load_modules()
+            except OSError:
+                pass
+
+        try:
+            self._poll(events)
+        except ProcessLookupError:
+            self._detach(events)
+
+        if events and METRICS.enabled:
+            METRICS.record_since(STAGE_SOURCE_READ, time_beg)
+        return events
+
+    def _attach(self) -> bool:
+        """Finds the process and starts reading from it."""
+        pid = self._pid
+        if pid is None:
+            assert self._process_name is not None
+            pids = find_process_ids(self._process_name)
+            if not pids:
+                return False
+            # The newest one, if there are several
+            pid = pids[-1]
+        try:
+            self._reader = ProcessMemoryReader(pid)
+            self._load_modules()
+        except (OSError, ProcessLookupError) as e:
+            LOG.info(f"Could not attach to process {pid}: {e}")
+            self.close()
+            return False
+        LOG.info(f"Attached to process {pid}")
+        return True
+
+    def _detach(self, events: List[Event]) -> None:
+        """Forgets about a process which has gone away."""
+        assert self._reader is not None
+        pid = self._reader.pid
+        LOG.info(f"Process {pid} went away")
+        self.close()
+        self._module_bases = {}
+        self._regions = None
+        for state in self._states:
+            state.cells = []
+            state.value_address = None
+            if state.last_value is not None:
+                state.last_value = None
+                events.append(MemoryValueEvent(key=state.watch.key, value=None))
+        events.append(ProcessDetachEvent(pid=pid))
+
+    def _load_modules(self) -> None:
+        """Reads the module base addresses, and re-walks any paths which were waiting on one."""
+        assert self._reader is not None
+        self._module_bases = find_module_bases(self._reader.pid)
+        self._missing_modules = False
+        self._regions = None
+        for state in self._states:
+            module = state.watch.module
+            if module is not None and module.lower() not in self._module_bases:
+                self._missing_modules = True
+            # Make sure every path gets walked on the next poll
+            state.cells = []
+            state.value_address = None
+
+    def _poll(self, events: List[Event]) -> None:
+        """Reads every watch in one go, and emits events for values which have changed."""
+        assert self._reader is not None
+        regions = self._regions
+        if regions is None:
+            pointer_size = self._pointer_size
+            regions = []
+            for state in self._states:
+                for address, pointer in state.cells:
+                    regions.append((address, pointer_size,))
+                if state.value_address is not None:
+                    regions.append((state.value_address, state.watch.size,))
+            self._regions = regions
+
+        buf, offsets = self._reader.read_regions(regions)
+        unpack_pointer = self._pointer_struct.unpack_from
+        stale_states: List[_WatchState] = []
+        idx = 0
+        for state in self._states:
+            # Any pointer on the way changing means the path needs walking again
+            is_stale = (not state.cells and state.value_address is None)
+            for address, pointer in state.cells:
+                offset = offsets[idx]
+                idx += 1
+                current = (None if offset is None else unpack_pointer(buf, offset)[0])
+                if current != pointer:
+                    is_stale = True
+
+            value: Any = None
+            if state.value_address is not None:
+                offset = offsets[idx]
+                idx += 1
+                if offset is not None:
+                    value = state.watch.decode(buf, offset)
+
+            if is_stale:
+                stale_states.append(state)
+            elif value != state.last_value:
+                state.last_value = value
+                events.append(MemoryValueEvent(key=state.watch.key, value=value))
+
+        # Walking reuses the read buffer, so this waits until everything else is decoded
+        for state in stale_states:
+            had_layout = (state.cells or state.value_address is not None)
+            value = self._walk(state)
+            if had_layout or state.cells or state.value_address is not None:
+                self._regions = None
+            if value != state.last_value:
+                state.last_value = value
+                events.append(MemoryValueEvent(key=state.watch.key, value=value))
+
+    def _walk(self, state: _WatchState) -> Any:
+        """Walks a watch's pointer path, and reads its value."""
+        assert self._reader is not None
+        watch = state.watch
+        state.cells = []
+        state.value_address = None
+
+        address = 0
+        if watch.module is not None:
+            base = self._module_bases.get(watch.module.lower())
+            if base is None:
+                return None
+            address = base
+        address += watch.offsets[0]
+
+        for offset in watch.offsets[1:]:
+            buf, offsets = self._reader.read_regions([(address, self._pointer_size,)])
+            pointer = (None if offsets[0] is None else self._pointer_struct.unpack_from(buf, offsets[0])[0])
+            state.cells.append((address, pointer,))
+            if not pointer:
+                # Not set up yet, so check this pointer again on every poll
+                return None
+            address = pointer + offset
+
+        state.value_address = address
+        buf, offsets = self._reader.read_regions([(address, watch.size,)])
+        if offsets[0] is None:
+            return None
+        return watch.decode(buf, offsets[0])
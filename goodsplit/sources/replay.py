@@ -0,0 +1,409 @@
+"""
+Event recording and replay.
+
+An event log is an append-only binary file. It starts with a magic
+number, followed by a sequence of records, each starting with a one-byte
+record type:
+
+- CLASS: u16 class ID, then the class path and its field names as
+  strings. Written the first time an event class is seen.
+- STRING: u32 string ID, then the string. Written the first time a
+  string or path value is seen, so repeated paths cost 4 bytes.
+- BATCH: f64 capture time (monotonic seconds), u32 event count, then per
+  event a u16 class ID and one tagged value per field.
+
+All integers are little-endian. Strings are a u16 length followed by
+UTF-8 bytes.
+
+Logs only get to name subclasses of Event, which are looked up among
+those already imported, and in Goodsplit's own source modules. Nothing
+else named in a log gets imported or called.
+"""
+import importlib
+import inspect
+import logging
+from pathlib import Path
+from pathlib import PurePath
+import struct
+import time
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Type
+from typing import TYPE_CHECKING
+
+from ..interface import Event
+from ..interface import EventSource
+from ..reactor import Reactor
+from ..time_base import VirtualFloatSeconds
+
+if TYPE_CHECKING:
+    from ..records import EventRing
+
+LOG = logging.getLogger("replay")
+
+LOG_MAGIC = b"GSEVLOG1"
+
+RECORD_CLASS = 1
+RECORD_STRING = 2
+RECORD_BATCH = 3
+
+VALUE_NONE = 0
+VALUE_STR = 1
+VALUE_PATH = 2
+VALUE_INT = 3
+VALUE_FLOAT = 4
+VALUE_BOOL = 5
+VALUE_DICT = 6
+
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+_BATCH_HEADER = struct.Struct("<dI")
+
+# Modules which event logs may have us import to find their event classes
+EVENT_MODULES = [
+    "goodsplit.sources.inotify",
+    "goodsplit.sources.logtail",
+    "goodsplit.sources.memory",
+    "goodsplit.sources.visual",
+]
+
+
+def get_event_field_names(cls: Type[Event]) -> List[str]:
+    """Gets the names of the keyword arguments an event class is constructed with."""
+    code = cls.__init__.__code__
+    return list(code.co_varnames[1:code.co_argcount+code.co_kwonlyargcount])
+
+
+def _find_loaded_event_classes() -> Dict[str, Type[Event]]:
+    """Gets every concrete Event subclass imported so far, by "module:qualname" path."""
+    result: Dict[str, Type[Event]] = {}
+    pending: List[Type[Event]] = [Event]
+    while pending:
+        cls = pending.pop()
+        pending += cls.__subclasses__()
+        if not inspect.isabstract(cls):
+            result[f"{cls.__module__}:{cls.__qualname__}"] = cls
+    return result
+
+
+def get_event_class(class_path: str) -> Type[Event]:
+    """
+    Gets the event class named by a "module:qualname" path from a log.
+
+    Raises ValueError if it isn't a concrete Event subclass, or it's in a
+    module which isn't imported yet and isn't in EVENT_MODULES.
+    """
+    cls = _find_loaded_event_classes().get(class_path)
+    if cls is None:
+        module_name = class_path.partition(":")[0]
+        if module_name in EVENT_MODULES:
+            importlib.import_module(module_name)
+            cls = _find_loaded_event_classes().get(class_path)
+    if cls is None:
+        raise ValueError(f"Event log names {class_path!r}, which is not a known event class")
+    return cls
+
+
+class EventLogWriter:
+    """Writes batches of events to an append-only event log."""
+    __slots__ = (
+        "_class_ids",
+        "_f",
+        "_string_ids",
+    )
+
+    def __init__(self, path: Path) -> None:
+        LOG.info(f"Recording events to {path}")
+        self._f: BinaryIO = open(path, "wb")
+        self._f.write(LOG_MAGIC)
+        self._class_ids: Dict[Type[Event], Tuple[int, List[str]]] = {}
+        self._string_ids: Dict[str, int] = {}
+
+    def close(self) -> None:
+        """Closes the log."""
+        self._f.close()
+
+    def write_batch(self, capture_time: float, events: List[Event]) -> None:
+        """Writes a batch of events which were all captured at the same time."""
+        # Make sure we've defined everything this batch refers to
+        body: List[bytes] = []
+        for ev in events:
+            class_id, field_names = self._get_class_id(ev.__class__)
+            body.append(_U16.pack(class_id))
+            for field_name in field_names:
+                body.append(self._encode_value(getattr(ev, field_name)))
+
+        self._f.write(_U8.pack(RECORD_BATCH))
+        self._f.write(_BATCH_HEADER.pack(capture_time, len(events)))
+        self._f.write(b"".join(body))
+        self._f.flush()
+
+    def _get_class_id(self, cls: Type[Event]) -> Tuple[int, List[str]]:
+        """Gets the ID for an event class, defining it in the log if necessary."""
+        result = self._class_ids.get(cls)
+        if result is None:
+            class_id = len(self._class_ids)
+            field_names = get_event_field_names(cls)
+            self._f.write(_U8.pack(RECORD_CLASS))
+            self._f.write(_U16.pack(class_id))
+            self._f.write(_encode_str(f"{cls.__module__}:{cls.__qualname__}"))
+            self._f.write(_U8.pack(len(field_names)))
+            for field_name in field_names:
+                self._f.write(_encode_str(field_name))
+            result = (class_id, field_names,)
+            self._class_ids[cls] = result
+        return result
+
+    def _get_string_id(self, s: str) -> int:
+        """Gets the ID for a string, defining it in the log if necessary."""
+        result = self._string_ids.get(s)
+        if result is None:
+            result = len(self._string_ids)
+            self._f.write(_U8.pack(RECORD_STRING))
+            self._f.write(_U32.pack(result))
+            self._f.write(_encode_str(s))
+            self._string_ids[s] = result
+        return result
+
+    def _encode_value(self, value: Any) -> bytes:
+        """Encodes a single event field value."""
+        if value is None:
+            return _U8.pack(VALUE_NONE)
+        elif isinstance(value, bool):
+            return _U8.pack(VALUE_BOOL) + _U8.pack(int(value))
+        elif isinstance(value, int):
+            return _U8.pack(VALUE_INT) + _I64.pack(value)
+        elif isinstance(value, float):
+            return _U8.pack(VALUE_FLOAT) + _F64.pack(value)
+        elif isinstance(value, PurePath):
+            return _U8.pack(VALUE_PATH) + _U32.pack(self._get_string_id(str(value)))
+        elif isinstance(value, str):
+            return _U8.pack(VALUE_STR) + _U32.pack(self._get_string_id(value))
+        elif isinstance(value, dict):
+            # String keys, then values the same as fields
+            parts = [_U8.pack(VALUE_DICT), _U32.pack(len(value))]
+            for k, v in value.items():
+                parts.append(_U32.pack(self._get_string_id(k)))
+                parts.append(self._encode_value(v))
+            return b"".join(parts)
+        else:
+            raise TypeError(f"Cannot record event field value {value!r}")
+
+
+def _encode_str(s: str) -> bytes:
+    """Encodes a length-prefixed string."""
+    data = s.encode("utf-8")
+    return _U16.pack(len(data)) + data
+
+
+class EventLogReader:
+    """Reads batches of events back out of an event log."""
+    __slots__ = (
+        "_classes",
+        "_data",
+        "_offset",
+        "_strings",
+    )
+
+    def __init__(self, path: Path) -> None:
+        with open(path, "rb") as f:
+            self._data = f.read()
+        if not self._data.startswith(LOG_MAGIC):
+            raise ValueError(f"{path} is not a Goodsplit event log")
+        self._offset = len(LOG_MAGIC)
+        self._classes: Dict[int, Tuple[Type[Event], List[str]]] = {}
+        self._strings: Dict[int, str] = {}
+
+    def __iter__(self) -> Iterator[Tuple[float, List[Event]]]:
+        return self
+
+    def __next__(self) -> Tuple[float, List[Event]]:
+        """Gets the next (capture_time, events,) batch."""
+        while self._offset < len(self._data):
+            record_type = self._read(_U8)
+            if record_type == RECORD_CLASS:
+                class_id = self._read(_U16)
+                class_path = self._read_str()
+                field_names = [self._read_str() for i in range(self._read(_U8))]
+                cls = get_event_class(class_path)
+                if sorted(field_names) != sorted(get_event_field_names(cls)):
+                    raise ValueError(f"Event log has fields {field_names!r} for {class_path!r}, which takes {get_event_field_names(cls)!r}")
+                self._classes[class_id] = (cls, field_names,)
+
+            elif record_type == RECORD_STRING:
+                string_id = self._read(_U32)
+                self._strings[string_id] = self._read_str()
+
+            elif record_type == RECORD_BATCH:
+                capture_time, count = _BATCH_HEADER.unpack_from(self._data, self._offset)
+                self._offset += _BATCH_HEADER.size
+                events: List[Event] = []
+                for i in range(count):
+                    event_cls, field_names = self._classes[self._read(_U16)]
+                    kwargs = {
+                        field_name: self._read_value()
+                        for field_name in field_names
+                    }
+                    events.append(event_cls(**kwargs))
+                return (capture_time, events,)
+
+            else:
+                raise ValueError(f"Unknown event log record type {record_type!r} at offset {self._offset-1}")
+
+        raise StopIteration()
+
+    def _read(self, st: struct.Struct) -> Any:
+        """Reads a single value."""
+        (value,) = st.unpack_from(self._data, self._offset)
+        self._offset += st.size
+        return value
+
+    def _read_str(self) -> str:
+        """Reads a length-prefixed string."""
+        length = self._read(_U16)
+        result = self._data[self._offset:self._offset+length].decode("utf-8")
+        self._offset += length
+        return result
+
+    def _read_value(self) -> Any:
+        """Reads a single event field value."""
+        tag = self._read(_U8)
+        if tag == VALUE_NONE:
+            return None
+        elif tag == VALUE_BOOL:
+            return bool(self._read(_U8))
+        elif tag == VALUE_INT:
+            return self._read(_I64)
+        elif tag == VALUE_FLOAT:
+            return self._read(_F64)
+        elif tag == VALUE_PATH:
+            return Path(self._strings[self._read(_U32)])
+        elif tag == VALUE_STR:
+            return self._strings[self._read(_U32)]
+        elif tag == VALUE_DICT:
+            result: Dict[str, Any] = {}
+            for i in range(self._read(_U32)):
+                k = self._strings[self._read(_U32)]
+                result[k] = self._read_value()
+            return result
+        else:
+            raise ValueError(f"Unknown event log value tag {tag!r} at offset {self._offset-1}")
+
+
+class RecordingEventSource(EventSource):
+    """
+    Wraps an event source, recording everything it produces.
+
+    Sources which write compact records still do so, but each of those
+    records gets made into a full event so it can be recorded.
+    """
+    __slots__ = (
+        "_log",
+        "_source",
+    )
+
+    def __init__(self, source: EventSource, log: EventLogWriter) -> None:
+        self._source = source
+        self._log = log
+
+    # Implementation
+    def pull_events(self) -> List[Event]:
+        events = self._source.pull_events()
+        if events:
+            self._log.write_batch(time.monotonic(), events)
+        return events
+
+    # Implementation
+    def pull_records(self, ring: "EventRing") -> int:
+        pos_beg = ring.tail
+        count = self._source.pull_records(ring)
+        if count:
+            # Positions are kept even if the ring grew
+            events = [
+                ring.get_event(pos & ring.mask)
+                for pos in range(pos_beg, pos_beg + count)
+            ]
+            self._log.write_batch(time.monotonic(), events)
+        return count
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return self._source.fileno()
+
+
+class ReplayEventSource(EventSource):
+    """
+    Plays back an event log against a virtual clock.
+
+    Each pull returns every batch whose capture time has been reached by
+    the clock. Capture times are shifted so the first batch lands at the
+    clock's time when the source was created.
+    """
+    __slots__ = (
+        "_clock",
+        "_next_batch",
+        "_reader",
+        "_time_offset",
+    )
+
+    def __init__(self, path: Path, *, clock: VirtualFloatSeconds) -> None:
+        self._clock = clock
+        self._reader = EventLogReader(path)
+        self._next_batch: Optional[Tuple[float, List[Event]]] = next(self._reader, None)
+        self._time_offset = 0.0
+        if self._next_batch is not None:
+            self._time_offset = clock.fetch_time_unzeroed() - self._next_batch[0]
+
+    def peek_time(self) -> Optional[float]:
+        """Gets the clock time of the next batch, or None if we've run out."""
+        if self._next_batch is None:
+            return None
+        return self._next_batch[0] + self._time_offset
+
+    # Implementation
+    def pull_events(self) -> List[Event]:
+        events: List[Event] = []
+        now = self._clock.fetch_time_unzeroed()
+        while self._next_batch is not None and self._next_batch[0] + self._time_offset <= now:
+            events += self._next_batch[1]
+            self._next_batch = next(self._reader, None)
+        return events
+
+
+def run_replay(reactor: Reactor, source: ReplayEventSource, clock: VirtualFloatSeconds, *, speed: Optional[float] = None) -> int:
+    """
+    Feeds a recorded session through a reactor.
+
+    With speed=None this goes as fast as possible. Otherwise it sleeps so
+    that the session plays back at the given multiple of real time.
+
+    Returns the number of batches played back.
+    """
+    batch_count = 0
+    first_time = source.peek_time()
+    wall_beg = time.monotonic()
+    while True:
+        batch_time = source.peek_time()
+        if batch_time is None:
+            break
+        assert first_time is not None
+
+        if speed is not None:
+            wall_due = wall_beg + (batch_time - first_time)/speed
+            wait_secs = wall_due - time.monotonic()
+            if wait_secs > 0.0:
+                time.sleep(wait_secs)
+
+        clock.set_time_unzeroed(batch_time)
+        reactor.update()
+        batch_count += 1
+
+    return batch_count
@@ -0,0 +1,430 @@
+"""
+Visual autosplitting, done with NumPy.
+
+Frames come from a FrameProvider as (height, width, channels,) arrays of
+uint8, which are usually views over a buffer the provider reuses. Only
+the regions the templates look at get cut out, summed down in blocks by
+their scale, and turned to grey.
+
+Each template is compared against its region with normalised cross
+correlation (NCC), giving a score from -1 to 1 which doesn't care about
+brightness or contrast. The reference side of that is worked out once up
+front. A coarse score over a sparse subset of the pixels is worked out
+first, and the full score is skipped when the coarse one is nowhere near
+the threshold.
+
+Needs NumPy, which you can get with: pip install goodsplit-iamgreaser[visual]
+"""
+from abc import ABCMeta
+from abc import abstractmethod
+import logging
+import os
+from pathlib import Path
+import re
+import stat
+import time
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy # type: ignore
+
+from ..interface import Event
+from ..interface import EventSource
+from ..metrics import METRICS
+from ..metrics import STAGE_SOURCE_READ
+
+LOG = logging.getLogger("visual")
+
+# How many frames get matched in one pull, so a backlog can't starve the tick
+DEFAULT_MAX_FRAMES_PER_PULL = 4
+# Every this many pixels goes into the coarse score
+COARSE_STRIDE = 8
+# How far under the threshold the coarse score has to be for the full score to be skipped
+COARSE_MARGIN = 0.15
+# How far under the threshold a match has to drop before it stops matching
+DEFAULT_HYSTERESIS = 0.05
+
+# Luma weights for turning RGB into grey (ITU-R BT.601)
+_GREY_WEIGHTS = numpy.array([0.299, 0.587, 0.114], dtype=numpy.float32)
+
+# Block weights for extract_region, keyed by (scale, channels,)
+_BLOCK_WEIGHTS: Dict[Tuple[int, int], "numpy.ndarray"] = {}
+
+# (x, y, width, height,) in frame pixels
+Region = Tuple[int, int, int, int]
+
+
+class VisualMatchEvent(Event):
+    """A template started or stopped matching."""
+    __slots__ = (
+        "is_matched",
+        "key",
+        "score",
+    )
+
+    def __init__(self, *, key: str, is_matched: bool, score: float) -> None:
+        self.key = key
+        self.is_matched = is_matched
+        self.score = score
+
+    def __eq__(self, other: Any) -> bool:
+        if other.__class__ == self.__class__:
+            if other.key == self.key and other.is_matched == self.is_matched:
+                return True
+
+        return False
+
+
+#
+# Frame providers
+#
+
+class FrameProvider(metaclass=ABCMeta):
+    """A source of frames."""
+    __slots__ = ()
+
+    @abstractmethod
+    def read_frame(self) -> Optional["numpy.ndarray"]:
+        """
+        Reads the next frame, as a (height, width, channels,) uint8 array.
+
+        Returns None if there isn't a whole frame available yet, or the
+        frames have run out. The array may be reused by the next read.
+        """
+        raise NotImplementedError()
+
+    def fileno(self) -> Optional[int]:
+        """
+        Gets a file descriptor which becomes readable when there are frames waiting.
+
+        Returns None if this provider has to be polled instead.
+        """
+        return None
+
+    def close(self) -> None:
+        """Closes anything this provider has open."""
+        pass
+
+
+class RawRGBFrameProvider(FrameProvider):
+    """
+    Frames of raw packed RGB from a pipe or file, e.g. from:
+    ffmpeg -i ... -f rawvideo -pix_fmt rgb24 -
+
+    Pipes are read without blocking, so part of a frame can arrive at a
+    time. Frames are read straight into a buffer which gets reused.
+    """
+    __slots__ = (
+        "_buf",
+        "_buf_used",
+        "_buf_view",
+        "_fd",
+        "_frame",
+        "_is_pipe",
+    )
+
+    def __init__(self, fd: int, *, width: int, height: int) -> None:
+        self._fd = fd
+        # Pipes get waited on, but plain files are always readable so they get polled
+        self._is_pipe = not stat.S_ISREG(os.fstat(fd).st_mode)
+        if self._is_pipe:
+            os.set_blocking(fd, False)
+        self._buf = bytearray(width*height*3)
+        self._buf_view = memoryview(self._buf)
+        self._buf_used = 0
+        self._frame = numpy.frombuffer(self._buf, dtype=numpy.uint8).reshape((height, width, 3))
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return (self._fd if self._is_pipe else None)
+
+    def read_frame(self) -> Optional["numpy.ndarray"]:
+        while self._buf_used < len(self._buf):
+            try:
+                read_count = os.readv(self._fd, [self._buf_view[self._buf_used:]])
+            except BlockingIOError:
+                return None
+            if read_count == 0:
+                return None
+            self._buf_used += read_count
+
+        self._buf_used = 0
+        return self._frame
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class Y4MFrameProvider(FrameProvider):
+    """Frames from a YUV4MPEG2 (.y4m) file. Only the luma plane is used, as one grey channel."""
+    __slots__ = (
+        "_buf",
+        "_chroma_size",
+        "_f",
+        "_frame",
+        "_luma_size",
+    )
+
+    def __init__(self, path: Path) -> None:
+        self._f: BinaryIO = open(path, "rb")
+        header = self._f.readline().decode("ascii").split()
+        if not header or header[0] != "YUV4MPEG2":
+            raise ValueError(f"{path} is not a YUV4MPEG2 file")
+        params = {p[0]: p[1:] for p in header[1:]}
+        width = int(params["W"])
+        height = int(params["H"])
+        colour_space = params.get("C", "420jpeg")
+        self._luma_size = width*height
+        if colour_space.startswith("mono"):
+            self._chroma_size = 0
+        elif colour_space.startswith("444"):
+            self._chroma_size = 2*width*height
+        elif colour_space.startswith("422"):
+            self._chroma_size = 2*((width+1)//2)*height
+        elif colour_space.startswith("420"):
+            self._chroma_size = 2*((width+1)//2)*((height+1)//2)
+        else:
+            raise ValueError(f"Unsupported Y4M colour space {colour_space!r}")
+        self._buf = bytearray(self._luma_size)
+        self._frame = numpy.frombuffer(self._buf, dtype=numpy.uint8).reshape((height, width, 1))
+
+    # Implementation
+    def read_frame(self) -> Optional["numpy.ndarray"]:
+        frame_header = self._f.readline()
+        if not frame_header.startswith(b"FRAME"):
+            return None
+        if self._f.readinto(self._buf) != self._luma_size:
+            return None
+        self._f.seek(self._chroma_size, os.SEEK_CUR)
+        return self._frame
+
+    def close(self) -> None:
+        self._f.close()
+
+
+class ImageSequenceFrameProvider(FrameProvider):
+    """Frames from a sequence of binary PPM (RGB) or PGM (grey) images."""
+    __slots__ = (
+        "_paths",
+        "_next_idx",
+    )
+
+    def __init__(self, paths: Sequence[Path]) -> None:
+        self._paths = list(paths)
+        self._next_idx = 0
+
+    # Implementation
+    def read_frame(self) -> Optional["numpy.ndarray"]:
+        if self._next_idx >= len(self._paths):
+            return None
+        path = self._paths[self._next_idx]
+        self._next_idx += 1
+        return read_netpbm(path)
+
+
+def read_netpbm(path: Path) -> "numpy.ndarray":
+    """Reads a binary PPM (P6) or PGM (P5) image with 8-bit samples, as a (height, width, channels,) array."""
+    with open(path, "rb") as f:
+        data = f.read()
+    # Magic, width, height, maxval, each separated by whitespace and maybe comments
+    m = re.match(rb"(P[56])(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)\s", data)
+    if m is None:
+        raise ValueError(f"{path} is not a binary PPM or PGM image")
+    if int(m.group(4)) > 255:
+        raise ValueError(f"{path} has more than 8 bits per sample")
+    channels = (3 if m.group(1) == b"P6" else 1)
+    width = int(m.group(2))
+    height = int(m.group(3))
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8, count=width*height*channels, offset=m.end())
+    return pixels.reshape((height, width, channels))
+
+
+#
+# Matching
+#
+
+def check_region(region: Region, frame_shape: Tuple[int, ...], *, what: str) -> None:
+    """Raises ValueError, saying what the region is for, if it doesn't fit in frames of this shape."""
+    x, y, width, height = region
+    frame_height, frame_width = frame_shape[:2]
+    if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > frame_width or y + height > frame_height:
+        raise ValueError(f"Region {region!r} of {what} doesn't fit in a {frame_width}x{frame_height} frame")
+
+
+def extract_region(frame: "numpy.ndarray", region: Region, scale: int) -> "numpy.ndarray":
+    """
+    Cuts a region out of a frame, sums it down by scale in each direction,
+    and turns it grey. Returns a flat float32 array.
+
+    The region has to fit in the frame, which check_region() can check.
+
+    Rows get summed as integers, then a single matrix multiply does the
+    columns and the grey conversion together.
+    """
+    x, y, width, height = region
+    out_width = width // scale
+    out_height = height // scale
+    pixels = frame[y:y+out_height*scale, x:x+out_width*scale, :]
+    channels = pixels.shape[2]
+    sum_dtype = (numpy.uint16 if scale*255 <= 0xFFFF else numpy.uint32)
+    rows = pixels.reshape((out_height, scale, out_width*scale*channels)).sum(axis=1, dtype=sum_dtype)
+    blocks = rows.reshape((out_height, out_width, scale*channels)).astype(numpy.float32)
+    return (blocks @ _get_block_weights(scale, channels)).ravel()
+
+
+def _get_block_weights(scale: int, channels: int) -> "numpy.ndarray":
+    """Gets the weights which turn scale pixels in a row into one grey value."""
+    key = (scale, channels,)
+    weights = _BLOCK_WEIGHTS.get(key)
+    if weights is None:
+        channel_weights = (_GREY_WEIGHTS if channels == 3 else numpy.ones((channels,), dtype=numpy.float32)/channels)
+        weights = numpy.tile(channel_weights, scale)
+        _BLOCK_WEIGHTS[key] = weights
+    return weights
+
+
+class VisualTemplate:
+    """
+    A reference image to look for in one region of the frame.
+
+    The reference can either be the same size as the region, or a whole
+    frame which the region gets cut out of.
+    """
+    __slots__ = (
+        "_coarse_template",
+        "_template",
+        "hysteresis",
+        "key",
+        "region",
+        "scale",
+        "threshold",
+    )
+
+    def __init__(self, key: str, *, region: Region, reference: "numpy.ndarray", threshold: float = 0.9, scale: int = 4, hysteresis: float = DEFAULT_HYSTERESIS) -> None:
+        self.key = key
+        self.region = region
+        self.scale = scale
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+
+        x, y, width, height = region
+        if reference.shape[:2] == (height, width,):
+            reference = extract_region(reference, (0, 0, width, height,), scale)
+        else:
+            check_region(region, reference.shape, what=f"template {key!r}")
+            reference = extract_region(reference, region, scale)
+        if reference.size == 0:
+            raise ValueError(f"Region for template {key!r} is smaller than its scale")
+
+        # Zero mean and unit length, so scoring a region is one dot product
+        self._template = _normalise(reference)
+        if self._template is None:
+            raise ValueError(f"Reference for template {key!r} is flat, and needs some contrast to match against")
+        coarse_template = _normalise(reference[::COARSE_STRIDE])
+        self._coarse_template = (coarse_template if coarse_template is not None else numpy.zeros((0,), dtype=numpy.float32))
+
+    def score(self, pixels: "numpy.ndarray", *, is_matched: bool = False) -> float:
+        """
+        Scores a region from extract_region against this template.
+
+        If the coarse score is too far under the threshold, that's what
+        gets returned.
+        """
+        threshold = self.threshold - (self.hysteresis if is_matched else 0.0)
+        if self._coarse_template.size >= 16:
+            coarse = _normalise(pixels[::COARSE_STRIDE])
+            coarse_score = (0.0 if coarse is None else float(coarse @ self._coarse_template))
+            if coarse_score < threshold - COARSE_MARGIN:
+                return coarse_score
+        normalised = _normalise(pixels)
+        return (0.0 if normalised is None else float(normalised @ self._template))
+
+
+def _normalise(pixels: "numpy.ndarray") -> Optional["numpy.ndarray"]:
+    """Gets a zero mean, unit length copy of some pixels, or None if they're all the same."""
+    centred = pixels - pixels.mean(dtype=numpy.float32)
+    norm = float(numpy.sqrt(centred @ centred))
+    if norm < 1e-6:
+        return None
+    centred /= norm
+    return centred
+
+
+class VisualEventSource(EventSource):
+    """
+    An event source which matches frames against templates.
+
+    Emits a VisualMatchEvent whenever a template starts or stops
+    matching. Templates looking at the same region at the same scale
+    share the work of cutting it out.
+    """
+    __slots__ = (
+        "_checked_frame_shape",
+        "_groups",
+        "_is_matched",
+        "_max_frames_per_pull",
+        "_provider",
+    )
+
+    def __init__(self, provider: FrameProvider, templates: List[VisualTemplate], *, max_frames_per_pull: int = DEFAULT_MAX_FRAMES_PER_PULL) -> None:
+        self._provider = provider
+        self._max_frames_per_pull = max_frames_per_pull
+        self._groups: Dict[Tuple[Region, int], List[VisualTemplate]] = {}
+        for template in templates:
+            self._groups.setdefault((template.region, template.scale,), []).append(template)
+        self._is_matched: Dict[str, bool] = {
+            template.key: False
+            for template in templates
+        }
+        # Regions only get checked against the frame size when it changes
+        self._checked_frame_shape: Optional[Tuple[int, ...]] = None
+
+    def close(self) -> None:
+        """Closes the frame provider."""
+        self._provider.close()
+
+    # Implementation
+    def fileno(self) -> Optional[int]:
+        return self._provider.fileno()
+
+    def pull_events(self) -> List[Event]:
+        events: List[Event] = []
+
+        time_beg = time.perf_counter()
+        for i in range(self._max_frames_per_pull):
+            frame = self._provider.read_frame()
+            if frame is None:
+                break
+            self.match_frame(frame, events)
+
+        if events and METRICS.enabled:
+            METRICS.record_since(STAGE_SOURCE_READ, time_beg)
+        return events
+
+    def match_frame(self, frame: "numpy.ndarray", events: List[Event]) -> None:
+        """
+        Matches one frame against every template, adding events for any which changed.
+
+        Raises ValueError if a template's region doesn't fit in the frame.
+        """
+        if frame.shape != self._checked_frame_shape:
+            for (region, scale), templates in self._groups.items():
+                keys_str = ", ".join(repr(template.key) for template in templates)
+                check_region(region, frame.shape, what=f"template {keys_str}")
+            self._checked_frame_shape = frame.shape
+        is_matched_by_key = self._is_matched
+        for (region, scale), templates in self._groups.items():
+            pixels = extract_region(frame, region, scale)
+            for template in templates:
+                was_matched = is_matched_by_key[template.key]
+                score = template.score(pixels, is_matched=was_matched)
+                threshold = template.threshold - (template.hysteresis if was_matched else 0.0)
+                is_matched = (score >= threshold)
+                if is_matched != was_matched:
+                    is_matched_by_key[template.key] = is_matched
+                    events.append(VisualMatchEvent(key=template.key, is_matched=is_matched, score=score))
@@ -1,4 +1,6 @@
 import time
+from typing import Callable
+from typing import Optional
 
 from .interface import TimeBase
 
@@ -33,3 +35,78 @@ class MonotonicFloatSeconds(TimeBase):
 
     def reset_to_zero(self) -> None:
         self._last_zero_time = self.fetch_time_unzeroed()
+
+
+class VirtualFloatSeconds(TimeBase):
+    """A clock which only moves when it's told to, for replaying recorded events."""
+    __slots__ = (
+        "_last_zero_time",
+        "_now",
+    )
+
+    def __init__(self) -> None:
+        self._now = 0.0
+        self.reset_to_zero()
+
+    def fetch_time(self) -> float:
+        return self._now - self._last_zero_time
+
+    def fetch_time_unzeroed(self) -> float:
+        return self._now
+
+    def set_time_unzeroed(self, now: float) -> None:
+        """Moves the clock to the given time."""
+        self._now = now
+
+    def reset_to_zero(self) -> None:
+        self._last_zero_time = self._now
+
+
+class LoadRemovedTimeBase(TimeBase):
+    """
+    A monotonic clock which stops while the game is loading.
+
+    Paused time is kept as a running total, so fetching the time costs
+    the same no matter how many loads there have been.
+    """
+    __slots__ = (
+        "_last_zero_time",
+        "_now",
+        "_pause_start",
+        "_paused_total",
+    )
+
+    def __init__(self, *, now: Optional[Callable[[], float]] = None) -> None:
+        # Where the unzeroed time comes from, e.g. a VirtualFloatSeconds when replaying
+        self._now: Callable[[], float] = (now if now is not None else time.monotonic)
+        self._last_zero_time = 0.0
+        self._paused_total = 0.0
+        # When the current load began, if we're in one
+        self._pause_start: Optional[float] = None
+        self.reset_to_zero()
+
+    def fetch_time(self) -> float:
+        pause_start = self._pause_start
+        now = (pause_start if pause_start is not None else self._now())
+        return now - self._last_zero_time - self._paused_total
+
+    def reset_to_zero(self) -> None:
+        self._last_zero_time = self._now()
+        self._paused_total = 0.0
+        self._pause_start = None
+
+    def is_paused(self) -> bool:
+        """Is the clock stopped for a load?"""
+        return self._pause_start is not None
+
+    def pause(self) -> None:
+        """Stops the clock until resume() is called."""
+        if self._pause_start is None:
+            self._pause_start = self._now()
+
+    def resume(self) -> None:
+        """Starts the clock again, leaving out the time spent paused."""
+        pause_start = self._pause_start
+        if pause_start is not None:
+            self._paused_total += self._now() - pause_start
+            self._pause_start = None
@@ -0,0 +1,400 @@
+"""
+Structured tracing, and the async log sink.
+
+Hot code records spans (something which took a while) and events
+(something which happened) as structured records, which are kept in
+memory in a ring buffer and only written out as JSON lines when asked
+for: on exit, with F8 in a game window, or SIGUSR1 in headless mode.
+
+Records go to channels named after the logger of the code recording
+them (reactor, db, inotify, tk_game). Tracing is off unless enabled, and
+then all it costs is checking a channel's enabled flag, so hot code
+does that before building any fields:
+
+    if TRACE.enabled:
+        TRACE.event("fuse_split", split=split_id)
+
+    with (TRACE.span("process_records", records=count) if TRACE.enabled else NULL_SPAN):
+        ...
+
+Each channel can also keep only one in every N of its records. Sampling
+isn't locked, so with several threads on one channel it's approximate.
+
+install_async_logging() moves the root logger's handlers onto a thread
+of their own, so log lines are never written from the reactor's thread.
+"""
+import collections
+import logging
+from pathlib import Path
+import queue
+import threading
+import time
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from logging.handlers import QueueHandler
+    from logging.handlers import QueueListener
+
+LOG = logging.getLogger("tracing")
+
+DEFAULT_TRACE_PATH = Path("~/goodsplit-trace.jsonl")
+
+# How many records are kept before the oldest ones get dropped
+DEFAULT_TRACE_CAPACITY = 65536
+
+KIND_EVENT = "event"
+KIND_SPAN = "span"
+
+# How records are kept in the buffer, as making a TraceRecord costs more:
+# (kind, channel, name, time, duration, thread ident, fields,)
+RawTraceRecord = Tuple[str, str, str, float, Optional[float], int, Dict[str, Any]]
+
+
+class TraceRecord:
+    """A span or event. Times are from time.perf_counter(), in seconds."""
+    __slots__ = (
+        "channel",
+        "duration",
+        "fields",
+        "kind",
+        "name",
+        "thread_id",
+        "time",
+    )
+
+    def __init__(self, *, kind: str, channel: str, name: str, time: float, duration: Optional[float], thread_id: int, fields: Dict[str, Any]) -> None:
+        self.kind = kind
+        self.channel = channel
+        self.name = name
+        # When the span began, or when the event happened
+        self.time = time
+        # How long the span took, or None for events
+        self.duration = duration
+        self.fields = fields
+        # Names get looked up when dumping, as that's much slower
+        self.thread_id = thread_id
+
+    @classmethod
+    def from_raw(cls, raw: RawTraceRecord) -> "TraceRecord":
+        """Makes a record from how it was kept in the buffer."""
+        kind, channel, name, time, duration, thread_id, fields = raw
+        return cls(kind=kind, channel=channel, name=name, time=time, duration=duration, thread_id=thread_id, fields=fields)
+
+    def to_json(self, *, thread_names: Dict[int, str]) -> Dict[str, Any]:
+        """Gets this record as something json.dumps() can take, given the names of threads by ident."""
+        result: Dict[str, Any] = {
+            "kind": self.kind,
+            "channel": self.channel,
+            "name": self.name,
+            "time": self.time,
+        }
+        if self.duration is not None:
+            result["duration"] = self.duration
+        result["thread"] = thread_names.get(self.thread_id, str(self.thread_id))
+        if self.fields:
+            result["fields"] = {
+                key: (value if isinstance(value, (int, float, str, bool, type(None))) else repr(value))
+                for key, value in self.fields.items()
+            }
+        return result
+
+
+class TraceSpan:
+    """A span being timed. Use it as a context manager."""
+    __slots__ = (
+        "_channel",
+        "_fields",
+        "_name",
+        "_time_beg",
+    )
+
+    def __init__(self, *, channel: "TraceChannel", name: str, fields: Dict[str, Any]) -> None:
+        self._channel = channel
+        self._name = name
+        self._fields = fields
+        self._time_beg = 0.0
+
+    def __enter__(self) -> "TraceSpan":
+        self._time_beg = time.perf_counter()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        time_end = time.perf_counter()
+        self._channel.add_raw_record((KIND_SPAN, self._channel.name, self._name, self._time_beg, time_end - self._time_beg, threading.get_ident(), self._fields,))
+
+    def set(self, **fields: Any) -> None:
+        """Adds fields which are only known once the span has started."""
+        self._fields.update(fields)
+
+
+class _NullSpan(TraceSpan):
+    """A span which isn't being recorded."""
+    __slots__ = ()
+
+    def __init__(self) -> None:
+        pass
+
+    # Implementation
+    def __enter__(self) -> "TraceSpan":
+        return self
+
+    # Implementation
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    # Implementation
+    def set(self, **fields: Any) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class TraceChannel:
+    """Where the spans and events of one part of Goodsplit go."""
+    __slots__ = (
+        "_sample_count",
+        "_tracer",
+        "enabled",
+        "name",
+        "sample_every",
+    )
+
+    def __init__(self, *, tracer: "Tracer", name: str) -> None:
+        self._tracer = tracer
+        self.name = name
+        self.enabled = False
+        # Keep one in this many records
+        self.sample_every = 1
+        self._sample_count = 0
+
+    def event(self, name: str, **fields: Any) -> None:
+        """Records that something happened."""
+        if self.enabled and self._is_sampled():
+            self._tracer.add_raw_record((KIND_EVENT, self.name, name, time.perf_counter(), None, threading.get_ident(), fields,))
+
+    def span(self, name: str, **fields: Any) -> TraceSpan:
+        """Starts timing something, if this channel is recording it."""
+        if self.enabled and self._is_sampled():
+            return TraceSpan(channel=self, name=name, fields=fields)
+        return NULL_SPAN
+
+    def add_raw_record(self, raw: RawTraceRecord) -> None:
+        """Adds a record to the tracer's ring buffer."""
+        self._tracer.add_raw_record(raw)
+
+    def _is_sampled(self) -> bool:
+        """Should the next record be kept?"""
+        if self.sample_every <= 1:
+            return True
+        self._sample_count += 1
+        if self._sample_count >= self.sample_every:
+            self._sample_count = 0
+            return True
+        return False
+
+
+class Tracer:
+    """
+    A ring buffer of trace records, and the channels which write to it.
+
+    Records get added from the reactor, the database writer thread and
+    the GUI, so this is thread-safe. Adding a record doesn't lock, as
+    appending to and copying a deque are each atomic, but with several
+    threads the count of dropped records can come out a little low.
+    """
+    __slots__ = (
+        "_added_count",
+        "_channels",
+        "_is_enabled",
+        "_lock",
+        "_records",
+        "_sample_every",
+        "dump_path",
+    )
+
+    def __init__(self, *, capacity: int = DEFAULT_TRACE_CAPACITY) -> None:
+        self._lock = threading.Lock()
+        self._records: Deque[RawTraceRecord] = collections.deque(maxlen=capacity)
+        self._added_count = 0
+        self._channels: Dict[str, TraceChannel] = {}
+        self._is_enabled = False
+        # Sampling for channels, including ones which haven't been made yet
+        self._sample_every: Dict[str, int] = {}
+        self.dump_path = DEFAULT_TRACE_PATH
+
+    def get_channel(self, name: str) -> TraceChannel:
+        """Gets a channel by name, making it if necessary."""
+        with self._lock:
+            channel = self._channels.get(name)
+            if channel is None:
+                channel = self._channels[name] = TraceChannel(tracer=self, name=name)
+                channel.enabled = self._is_enabled
+                channel.sample_every = self._sample_every.get(name, 1)
+            return channel
+
+    def enable(self, *, capacity: Optional[int] = None) -> None:
+        """Starts recording on every channel, optionally with a new buffer size."""
+        with self._lock:
+            if capacity is not None:
+                self._records = collections.deque(self._records, maxlen=capacity)
+            self._is_enabled = True
+            for channel in self._channels.values():
+                channel.enabled = True
+
+    def disable(self) -> None:
+        """Stops recording. Anything recorded so far is kept."""
+        with self._lock:
+            self._is_enabled = False
+            for channel in self._channels.values():
+                channel.enabled = False
+
+    def is_enabled(self) -> bool:
+        """Is tracing on?"""
+        return self._is_enabled
+
+    def set_sampling(self, name: str, sample_every: int) -> None:
+        """Makes a channel keep only one in every sample_every records."""
+        if sample_every < 1:
+            raise ValueError(f"sample_every must be at least 1, not {sample_every!r}")
+        with self._lock:
+            self._sample_every[name] = sample_every
+            channel = self._channels.get(name)
+            if channel is not None:
+                channel.sample_every = sample_every
+
+    def add_raw_record(self, raw: RawTraceRecord) -> None:
+        """Adds a record, dropping the oldest one if the buffer is full."""
+        self._records.append(raw)
+        self._added_count += 1
+
+    def get_records(self) -> List[TraceRecord]:
+        """Gets a snapshot of every record in the buffer, oldest first."""
+        return [TraceRecord.from_raw(raw) for raw in self._records.copy()]
+
+    def clear(self) -> None:
+        """Throws away everything recorded so far."""
+        with self._lock:
+            self._records.clear()
+            self._added_count = 0
+
+    def format_dump(self) -> str:
+        """Formats every record as JSON lines, after a line saying how many were dropped."""
+        import json
+
+        records = self.get_records()
+        dropped_count = max(0, self._added_count - len(records))
+        # Threads which have finished since only get their idents
+        thread_names = {
+            thread.ident: thread.name
+            for thread in threading.enumerate()
+            if thread.ident is not None
+        }
+        lines = [json.dumps({
+            "kind": "header",
+            "records": len(records),
+            "dropped": dropped_count,
+            "wall_time": time.time(),
+            "time": time.perf_counter(),
+        }, separators=(",", ":"))]
+        for record in records:
+            lines.append(json.dumps(record.to_json(thread_names=thread_names), separators=(",", ":")))
+        return "\n".join(lines) + "\n"
+
+    def write_dump(self, path: Optional[Path] = None) -> None:
+        """Writes the dump to a file, by default our dump path."""
+        if path is None:
+            path = self.dump_path
+        path = path.expanduser()
+        LOG.info(f"Writing trace to {str(path)!r}")
+        with open(path, "w") as f:
+            f.write(self.format_dump())
+
+
+# The tracer for this process.
+TRACER = Tracer()
+
+_log_listener: Optional["QueueListener"] = None
+_log_queue_handler: Optional[logging.Handler] = None
+# The root logger's handlers from before, which the listener writes to
+_log_handlers: List[logging.Handler] = []
+
+
+def make_log_queue_handler(log_queue: "queue.SimpleQueue[Any]") -> "QueueHandler":
+    """
+    Makes a handler which puts log records on a queue, mostly as they are.
+
+    Unlike a plain QueueHandler, formatting is left to the listener's
+    thread too. Goodsplit logs with f-strings, so a record's message is
+    usually a finished string. Records with arguments, a message which
+    isn't a string, or exception info could change or go stale before
+    the listener got to them, so those still get prepared here.
+    """
+    from logging.handlers import QueueHandler
+
+    class _LogQueueHandler(QueueHandler):
+        # Implementation
+        def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+            if record.args or record.exc_info or record.stack_info or not isinstance(record.msg, str):
+                return super().prepare(record)
+            return record
+
+    return _LogQueueHandler(log_queue)
+
+
+def install_async_logging() -> None:
+    """
+    Moves the root logger's handlers onto a thread of their own.
+
+    Log records are queued by whichever thread logs them, and formatted
+    and written by the listener thread. Call stop_async_logging() to
+    write out anything still queued; it also happens at exit.
+    """
+    global _log_listener
+    global _log_queue_handler
+    global _log_handlers
+    if _log_listener is not None:
+        return
+
+    # Pulls in a fair few modules, so only when it's wanted
+    import atexit
+    from logging.handlers import QueueListener
+
+    root_logger = logging.getLogger()
+    handlers = list(root_logger.handlers)
+    if not handlers:
+        return
+    log_queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+    for handler in handlers:
+        root_logger.removeHandler(handler)
+    _log_queue_handler = make_log_queue_handler(log_queue)
+    root_logger.addHandler(_log_queue_handler)
+    _log_handlers = handlers
+    _log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_async_logging)
+
+
+def stop_async_logging() -> None:
+    """Writes out everything queued, and puts the root logger's handlers back."""
+    global _log_listener
+    global _log_queue_handler
+    global _log_handlers
+    if _log_listener is None:
+        return
+
+    root_logger = logging.getLogger()
+    if _log_queue_handler is not None:
+        root_logger.removeHandler(_log_queue_handler)
+    _log_listener.stop()
+    for handler in _log_handlers:
+        root_logger.addHandler(handler)
+    _log_listener = None
+    _log_queue_handler = None
+    _log_handlers = []
@@ -16,6 +16,10 @@ setuptools.setup(
     install_requires=[
         "sqlalchemy",
     ],
+    extras_require={
+        "analysis": ["numpy"],
+        "visual": ["numpy"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: Zlib License",